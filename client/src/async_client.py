@@ -0,0 +1,251 @@
+import asyncio
+from socket import socket, AF_INET, SOCK_STREAM
+from itertools import count
+
+import helpers
+import jim
+from storage import DBStorageClient
+from client import ClientVerifierMeta, check_response
+import security
+
+
+class AsyncClient(metaclass=ClientVerifierMeta):
+    """
+    Client API built on asyncio streams: the same requests as in Client, but as coroutines.
+    Responses are read by one task per connection instead of a thread, so one event loop can drive
+    thousands of clients. Incoming user messages are got with "async for message in client".
+    """
+    def __init__(self, username, password, storage_file, max_message_size=helpers.MAX_MESSAGE_SIZE):
+        self.__username = username
+        self.__security_key = security.create_password_hash(password)
+        self.__storage = DBStorageClient(storage_file)
+        self.__decoder = jim.JimStreamDecoder(jim.response_from_bytes, max_message_size)
+        self.__reader = None
+        self.__writer = None
+        self.__reader_task = None
+        self.__server_features = set()
+        self.__service_messages = asyncio.Queue()  # None in both queues marks closed connection
+        self.__user_messages = asyncio.Queue()
+        self.__request_ids = count(1)
+        self.__pending_requests = {}  # request id -> Future of response, completed by reader task
+        self.__requests_lock = asyncio.Lock()  # without request ids responses are matched only by order
+
+    @property
+    def username(self):
+        return self.__username
+
+    @property
+    def storage(self):
+        return self.__storage
+
+    @property
+    def server_features(self):
+        """ Optional protocol features server advertised on successful presence or authentication """
+        return self.__server_features
+
+    async def connect(self, server_ip: str, server_port: int):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, (server_ip, server_port))
+        except BaseException:
+            sock.close()
+            raise
+        self.__reader, self.__writer = await asyncio.open_connection(sock=sock)
+        self.__reader_task = asyncio.create_task(self.read_messages())
+        await self.check_connection()
+
+    async def close_client(self):
+        if self.__writer is None:
+            return
+        self.__writer.close()
+        self.__reader_task.cancel()
+        try:
+            await self.__reader_task
+        except asyncio.CancelledError:
+            pass
+        self.__writer = None
+
+    async def read_messages(self):
+        try:
+            while True:
+                data = await self.__reader.read(helpers.TCP_MSG_BUFFER_SIZE)
+                if not data:
+                    raise EOFError('connection closed by peer')
+                for msg in self.__decoder.feed(data):
+                    if msg.datadict.get('action') == 'msg':  # user message
+                        self.__user_messages.put_nowait(msg)
+                    elif not self.complete_pending_request(msg):  # service message without request id
+                        self.__service_messages.put_nowait(msg)
+        except (EOFError, OSError, ValueError) as e:
+            self.fail_pending_requests(e)
+        except asyncio.CancelledError:  # connection closed by close_client
+            self.fail_pending_requests('connection closed by client')
+            raise
+        finally:
+            self.__service_messages.put_nowait(None)
+            self.__user_messages.put_nowait(None)
+
+    async def receive_service_message(self) -> jim.JimResponse:
+        msg = await self.__service_messages.get()
+        if msg is None:
+            self.__service_messages.put_nowait(None)  # for other waiting coroutines
+            raise ConnectionError('Connection to server lost')
+        return msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> jim.JimResponse:
+        msg = await self.__user_messages.get()
+        if msg is None:
+            self.__user_messages.put_nowait(None)  # let other iterators stop too
+            raise StopAsyncIteration
+        return msg
+
+    def complete_pending_request(self, response: jim.JimResponse) -> bool:
+        """ Passes response to future of request with the same id, returns False if there is no such request """
+        future = self.__pending_requests.pop(response.request_id, None) if response.request_id is not None else None
+        if future is None:
+            return False
+        if not future.done():  # waiting coroutine may be cancelled
+            future.set_result(response)
+        return True
+
+    def fail_pending_requests(self, reason):
+        futures = list(self.__pending_requests.values())
+        self.__pending_requests.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError(f'Connection to server lost: {reason}'))
+
+    async def request(self, request: jim.JimRequest) -> jim.JimResponse:
+        """
+        Sends request and waits for its response. Requests of concurrent coroutines are pipelined
+        if server echoes request ids, otherwise they are sent one at a time.
+        """
+        if self.__reader_task.done():
+            raise ConnectionError('Connection to server lost')
+        if jim.FEATURE_REQUEST_ID not in self.__server_features:
+            async with self.__requests_lock:
+                self.__writer.write(request.to_frame())
+                await self.__writer.drain()
+                return await self.receive_service_message()
+        request.request_id = next(self.__request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.__pending_requests[request.request_id] = future
+        self.__writer.write(request.to_frame())
+        await self.__writer.drain()
+        return await future
+
+    async def check_connection(self):
+        async with self.__requests_lock:  # features are not known yet
+            self.__writer.write(jim.presence_request(self.__username).to_frame())
+            response = await self.receive_service_message()
+        if response.response == 200:  # all ok
+            self.__server_features = set(response.datadict.get('features', []))
+            return
+        elif response.response == 401:  # authentication needed
+            await self.authenticate(response.datadict['token'])
+        else:
+            raise RuntimeError(f'Presence: expected 200, '
+                               f'received {response.response}, error: {response.datadict["error"]}')
+
+    async def authenticate(self, auth_token: str):
+        auth_digest = security.create_auth_digest(self.__security_key, auth_token)
+        async with self.__requests_lock:
+            self.__writer.write(jim.auth_client_message(self.__username, auth_digest).to_frame())
+            response = await self.receive_service_message()
+        if response.response != 200:
+            raise RuntimeError(f'Authenticate: expected 200, '
+                               f'received {response.response}, error: {response.datadict["error"]}')
+        self.__server_features = set(response.datadict.get('features', []))
+
+    async def update_contacts_from_server(self):
+        if jim.FEATURE_CONTACTS_BATCH in self.__server_features:
+            self.storage.update_contacts(await self.get_contacts_batched())
+            return
+        async with self.__requests_lock:  # contacts come as separate messages after the response
+            self.__writer.write(jim.get_contacts_request().to_frame())
+            response = check_response(await self.receive_service_message(), 202, 'Get contacts')
+            contacts_server = []
+            for _ in range(0, response.datadict['quantity']):
+                contact_message = await self.receive_service_message()
+                if contact_message.datadict['action'] != 'contact_list':
+                    raise RuntimeError(f'Get contacts: expected action "contact_list", '
+                                       f'received: {contact_message.datadict["action"]}')
+                if contact_message.datadict['user_id'] not in contacts_server:
+                    contacts_server.append(contact_message.datadict['user_id'])
+        self.storage.update_contacts(contacts_server)
+
+    async def get_contacts_batched(self, page_size=helpers.CONTACTS_PAGE_LIMIT) -> list:
+        """ Gets contact list from server page by page, one response per page """
+        contacts_server = []
+        cursor = None
+        while True:
+            request = jim.get_contacts_request(batch=True, limit=page_size, cursor=cursor)
+            response = check_response(await self.request(request), 202, 'Get contacts')
+            contacts_server += response.datadict['contacts']
+            cursor = response.datadict['cursor']
+            if cursor is None:
+                return contacts_server
+
+    async def add_contact_on_server(self, login: str):
+        await self.add_contacts_on_server([login])
+
+    async def add_contacts_on_server(self, logins: list):
+        """ Sends all requests at once, then waits for their responses """
+        if not all(logins):
+            raise RuntimeError('Login cannot be empty')
+        responses = await asyncio.gather(*(self.request(jim.add_contact_request(login)) for login in logins))
+        for response in responses:
+            check_response(response, 200, 'Add contact')
+
+    async def delete_contact_on_server(self, login: str):
+        if not login:
+            raise RuntimeError('Login cannot be empty')
+        check_response(await self.request(jim.delete_contact_request(login)), 200, 'Delete contact')
+
+    def get_current_contacts(self) -> list:
+        contacts = self.storage.get_contacts()
+        return contacts if contacts else []
+
+    async def send_message_to_contact(self, login: str, message: str):
+        await self.send_messages_to_contact(login, [message])
+
+    async def send_messages_to_contact(self, login: str, messages: list):
+        """ Sends all messages at once, then waits for their responses """
+        if not all(messages):
+            raise RuntimeError('Message cannot be empty')
+        responses = await asyncio.gather(
+            *(self.request(jim.message_request(self.username, login, message)) for message in messages))
+        for message, response in zip(messages, responses):
+            check_response(response, 200, 'Send message')
+            self.storage.add_message(login, message)
+
+    async def create_room_on_server(self, room: str):
+        await self.request_room_action(jim.create_room_request(room), 'Create room')
+
+    async def join_room_on_server(self, room: str):
+        await self.request_room_action(jim.join_room_request(room), 'Join room')
+
+    async def leave_room_on_server(self, room: str):
+        await self.request_room_action(jim.leave_room_request(room), 'Leave room')
+
+    async def request_room_action(self, request: jim.JimRequest, action_name: str):
+        if not jim.is_room_name(request.datadict['room']):
+            raise RuntimeError(f'Room name must start with {jim.ROOM_PREFIX}')
+        check_response(await self.request(request), 200, action_name)
+
+    async def send_message_to_room(self, room: str, message: str):
+        """ Message is written once and server delivers it to all room members """
+        if not message:
+            raise RuntimeError('Message cannot be empty')
+        if not jim.is_room_name(room):
+            raise RuntimeError(f'Room name must start with {jim.ROOM_PREFIX}')
+        request = jim.message_request(self.username, room, message)
+        check_response(await self.request(request), 200, 'Send room message')
+
+    def get_messages(self, login: str) -> list:
+        messages = self.storage.get_messages(login)
+        return [{'text': item[0], 'incoming': bool(item[1])} for item in messages]
@@ -1,11 +1,14 @@
 import sys
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
+import selectors
 import argparse
 import logging
 import inspect
 import os
-from threading import Thread
+from threading import Thread, Lock
 from queue import Queue
+from concurrent.futures import Future
+from itertools import count
 
 import helpers
 import jim
@@ -25,6 +28,13 @@ def parse_commandline_args(cmd_args):
     return parser.parse_args(cmd_args)
 
 
+def check_response(response: jim.JimResponse, expected_code: int, action_name: str) -> jim.JimResponse:
+    if response.response != expected_code:
+        raise RuntimeError(f'{action_name}: expected response {expected_code}, '
+                           f'received: {response.response}, error: {response.datadict["error"]}')
+    return response
+
+
 class ClientVerifierMeta(type):
     def __init__(cls, clsname, bases, clsdict):
         tcp_found = False
@@ -50,37 +60,54 @@ class ClientVerifierMeta(type):
 
 
 class Client(metaclass=ClientVerifierMeta):
-    def __init__(self, username, password, storage_file):
+    def __init__(self, username, password, storage_file, max_message_size=helpers.MAX_MESSAGE_SIZE):
         self.__username = username
         self.__security_key = security.create_password_hash(password)
         self.__socket = socket(AF_INET, SOCK_STREAM)
         self.__storage = DBStorageClient(storage_file)
-        self.__service_messages = Queue()
+        self.__decoder = jim.JimStreamDecoder(jim.response_from_bytes, max_message_size)
+        self.__server_features = set()
+        self.__service_messages = Queue()  # helpers.QUEUE_STOP in both queues marks closed connection
+        self.__request_ids = count(1)
+        self.__pending_requests = {}  # request id -> Future of response, completed by reader thread
+        self.__pending_lock = Lock()
         self.__user_messages = Queue()
         self.__reader_thread = Thread(target=self.read_messages_thread_function)
         self.__reader_thread.daemon = True
-        self.__need_terminate = False
+        self.__wakeup_sockets = socketpair()  # lets close_client() interrupt reader thread waiting for data
 
     def __del__(self):
         self.close_client()
 
     def close_client(self):
+        if self.__reader_thread.is_alive():
+            self.__wakeup_sockets[1].send(b'\0')
+            self.__reader_thread.join()
         self.__socket.close()
-        self.__need_terminate = True
-        self.__reader_thread.join()
+        for wakeup_socket in self.__wakeup_sockets:
+            wakeup_socket.close()
 
     def read_messages_thread_function(self):
-        while True:
-            if self.__need_terminate:
-                return
-            try:
-                msg = self.receive_message_from_server()
-                if 'action' in msg.datadict.keys() and msg.datadict['action'] == 'msg':  # user message
-                    self.__user_messages.put(msg)
-                else:  # service message
-                    self.__service_messages.put(msg)
-            except OSError:
-                pass
+        """ Blocks until server sends data or close_client() wakes it up, so idle client does not use CPU """
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.__socket, selectors.EVENT_READ)
+                selector.register(self.__wakeup_sockets[0], selectors.EVENT_READ)
+                while True:
+                    events = selector.select()
+                    if any(key.fileobj is self.__wakeup_sockets[0] for key, _ in events):
+                        return
+                    for msg in self.__decoder.recv_into(self.__socket):
+                        if 'action' in msg.datadict.keys() and msg.datadict['action'] == 'msg':  # user message
+                            self.__user_messages.put(msg)
+                        elif not self.complete_pending_request(msg):  # service message without request id
+                            self.__service_messages.put(msg)
+        except (EOFError, OSError, ValueError) as e:  # server closed connection or sent broken data
+            log.error(f'Connection to server lost: {e}')
+        finally:
+            self.fail_pending_requests('connection closed')
+            self.__service_messages.put(helpers.QUEUE_STOP)
+            self.__user_messages.put(helpers.QUEUE_STOP)
 
     @property
     def user_messages_queue(self):
@@ -94,6 +121,11 @@ class Client(metaclass=ClientVerifierMeta):
     def storage(self):
         return self.__storage
 
+    @property
+    def server_features(self):
+        """ Optional protocol features server advertised on successful presence or authentication """
+        return self.__server_features
+
     def send_data(self, data: bytes) -> int:
         if type(data) is not bytes:
             raise TypeError
@@ -105,21 +137,63 @@ class Client(metaclass=ClientVerifierMeta):
         return self.__socket.recv(size)
 
     def send_message_to_server(self, msg: jim.JimRequest):
-        msg_bytes = msg.to_bytes()
+        msg_bytes = msg.to_frame()
         msg_bytes_len = len(msg_bytes)
         bytes_sent = self.send_data(msg_bytes)
         if bytes_sent != msg_bytes_len:
             raise RuntimeError(f'socket.send() returned {bytes_sent}, but expected {msg_bytes_len}')
 
-    def receive_message_from_server(self) -> jim.JimResponse:
-        received_data = self.receive_data()
-        return jim.response_from_bytes(received_data)
+    def receive_service_message(self) -> jim.JimResponse:
+        msg = self.__service_messages.get()
+        if msg is helpers.QUEUE_STOP:
+            self.__service_messages.put(helpers.QUEUE_STOP)  # for other waiting threads
+            raise ConnectionError('Connection to server lost')
+        return msg
+
+    def send_request(self, request: jim.JimRequest) -> Future:
+        """
+        Sends request and returns future of its response without waiting, so several requests may be in flight.
+        If server does not echo request ids, waits for response here, as responses can be matched only by order.
+        """
+        future = Future()
+        if jim.FEATURE_REQUEST_ID not in self.__server_features:
+            self.send_message_to_server(request)
+            future.set_result(self.receive_service_message())
+            return future
+        request.request_id = next(self.__request_ids)
+        with self.__pending_lock:
+            self.__pending_requests[request.request_id] = future
+        self.send_message_to_server(request)
+        return future
+
+    def complete_pending_request(self, response: jim.JimResponse) -> bool:
+        """ Passes response to future of request with the same id, returns False if there is no such request """
+        if response.request_id is None:
+            return False
+        with self.__pending_lock:
+            future = self.__pending_requests.pop(response.request_id, None)
+        if future is None:
+            return False
+        future.set_result(response)
+        return True
+
+    def fail_pending_requests(self, reason):
+        with self.__pending_lock:
+            futures = list(self.__pending_requests.values())
+            self.__pending_requests.clear()
+        for future in futures:
+            future.set_exception(ConnectionError(f'Connection to server lost: {reason}'))
+
+    def wait_responses(self, futures: list, expected_code: int, action_name: str) -> list:
+        """ Waits for responses of pipelined requests, raises on the first unexpected one """
+        return [check_response(future.result(), expected_code, action_name) for future in futures]
 
     def check_connection(self):
         request = jim.presence_request(self.__username)
         self.send_message_to_server(request)
-        response = self.__service_messages.get()
+        response = self.receive_service_message()
         if response.response == 200:  # all ok
+            self.__server_features = set(response.datadict.get('features', []))
             return
         elif response.response == 401:  # authentication needed
             self.authenticate(response.datadict['token'])
@@ -131,10 +205,11 @@ class Client(metaclass=ClientVerifierMeta):
         auth_digest = security.create_auth_digest(self.__security_key, auth_token)
         auth_message = jim.auth_client_message(self.__username, auth_digest)
         self.send_message_to_server(auth_message)
-        response = self.__service_messages.get()
+        response = self.receive_service_message()
         if response.response != 200:
             raise RuntimeError(f'Authenticate: expected 200, '
                                f'received {response.response}, error: {response.datadict["error"]}')
+        self.__server_features = set(response.datadict.get('features', []))
 
     def connect(self, server_ip: str, server_port: int):
         self.__socket.connect((server_ip, server_port))
@@ -142,15 +217,18 @@ class Client(metaclass=ClientVerifierMeta):
         self.check_connection()
 
     def update_contacts_from_server(self):
+        if jim.FEATURE_CONTACTS_BATCH in self.__server_features:
+            self.storage.update_contacts(self.get_contacts_batched())
+            return
         request = jim.get_contacts_request()
         self.send_message_to_server(request)
-        response = self.__service_messages.get()
+        response = self.receive_service_message()
         if response.response != 202:
             raise RuntimeError(f'Get contacts: expected 202, '
                                f'received: {response.response}, error: {response.datadict["error"]}')
         contacts_server = []
         for _ in range(0, response.datadict['quantity']):
-            contact_message = self.__service_messages.get()
+            contact_message = self.receive_service_message()
 
             if contact_message.datadict['action'] != 'contact_list':
                 raise RuntimeError(f'Get contacts: expected action "contact_list", '
@@ -160,40 +238,71 @@ class Client(metaclass=ClientVerifierMeta):
 
         self.storage.update_contacts(contacts_server)
 
+    def get_contacts_batched(self, page_size=helpers.CONTACTS_PAGE_LIMIT) -> list:
+        """ Gets contact list from server page by page, one response per page """
+        contacts_server = []
+        cursor = None
+        while True:
+            request = jim.get_contacts_request(batch=True, limit=page_size, cursor=cursor)
+            response = check_response(self.send_request(request).result(), 202, 'Get contacts')
+            contacts_server += response.datadict['contacts']
+            cursor = response.datadict['cursor']
+            if cursor is None:
+                return contacts_server
+
     def add_contact_on_server(self, login: str):
-        if not login:
+        self.add_contacts_on_server([login])
+
+    def add_contacts_on_server(self, logins: list):
+        """ Sends all requests at once, then waits for their responses """
+        if not all(logins):
             raise RuntimeError('Login cannot be empty')
-        request = jim.add_contact_request(login)
-        self.send_message_to_server(request)
-        response = self.__service_messages.get()
-        if response.response != 200:
-            raise RuntimeError(f'Add contact: expected response 200, '
-                               f'received: {response.response}, error: {response.datadict["error"]}')
+        futures = [self.send_request(jim.add_contact_request(login)) for login in logins]
+        self.wait_responses(futures, 200, 'Add contact')
 
     def delete_contact_on_server(self, login: str):
         if not login:
             raise RuntimeError('Login cannot be empty')
-        request = jim.delete_contact_request(login)
-        self.send_message_to_server(request)
-        response = self.__service_messages.get()
-        if response.response != 200:
-            raise RuntimeError(f'Delete contact: expected response 200, '
-                               f'received: {response.response}, error: {response.datadict["error"]}')
+        check_response(self.send_request(jim.delete_contact_request(login)).result(), 200, 'Delete contact')
 
     def get_current_contacts(self) -> list:
         contacts = self.storage.get_contacts()
         return contacts if contacts else []
 
     def send_message_to_contact(self, login: str, message: str):
+        self.send_messages_to_contact(login, [message])
+
+    def send_messages_to_contact(self, login: str, messages: list):
+        """ Sends all messages at once, then waits for their responses """
+        if not all(messages):
+            raise RuntimeError('Message cannot be empty')
+        futures = [self.send_request(jim.message_request(self.username, login, message)) for message in messages]
+        for message, future in zip(messages, futures):
+            check_response(future.result(), 200, 'Send message')
+            self.storage.add_message(login, message)
+
+    def create_room_on_server(self, room: str):
+        self.request_room_action(jim.create_room_request(room), 'Create room')
+
+    def join_room_on_server(self, room: str):
+        self.request_room_action(jim.join_room_request(room), 'Join room')
+
+    def leave_room_on_server(self, room: str):
+        self.request_room_action(jim.leave_room_request(room), 'Leave room')
+
+    def request_room_action(self, request: jim.JimRequest, action_name: str):
+        if not jim.is_room_name(request.datadict['room']):
+            raise RuntimeError(f'Room name must start with {jim.ROOM_PREFIX}')
+        check_response(self.send_request(request).result(), 200, action_name)
+
+    def send_message_to_room(self, room: str, message: str):
+        """ Message is written once and server delivers it to all room members """
         if not message:
             raise RuntimeError('Message cannot be empty')
-        request = jim.message_request(self.username, login, message)
-        self.send_message_to_server(request)
-        response = self.__service_messages.get()
-        if response.response != 200:
-            raise RuntimeError(f'Send message: expected response 200, '
-                               f'received: {response.response}, error: {response.datadict["error"]}')
-        self.storage.add_message(login, message)
+        if not jim.is_room_name(room):
+            raise RuntimeError(f'Room name must start with {jim.ROOM_PREFIX}')
+        request = jim.message_request(self.username, room, message)
+        check_response(self.send_request(request).result(), 200, 'Send room message')
 
     def get_messages(self, login: str) -> list:
         messages = self.storage.get_messages(login)
@@ -201,11 +310,15 @@ class Client(metaclass=ClientVerifierMeta):
 
 
 def check_new_incoming_messages_thread_function(message_queue: Queue):
-        while True:
-            if message_queue:
-                msg = message_queue.get()
-                formatted_message = f"New message from {msg.datadict['from']}: {msg.datadict['message']}"
-                print(formatted_message)
+    while True:
+        msg = message_queue.get()
+        if msg is helpers.QUEUE_STOP:  # connection closed
+            return
+        formatted_message = f"New message from {msg.datadict['from']}: {msg.datadict['message']}"
+        if jim.is_room_name(msg.datadict['to']):
+            formatted_message = f"New message in {msg.datadict['to']} " \
+                                f"from {msg.datadict['from']}: {msg.datadict['message']}"
+        print(formatted_message)
 
 
 if __name__ == '__main__':
@@ -225,7 +338,8 @@ if __name__ == '__main__':
         incoming_monitor.start()
 
         # console command loop
-        supported_commands = ['show_contacts', 'add_contact', 'delete_contact', 'send_message']
+        supported_commands = ['show_contacts', 'add_contact', 'delete_contact', 'send_message',
+                              'create_room', 'join_room', 'leave_room', 'send_room_message']
         main_menu = helpers.Menu(supported_commands)
         while True:
             user_choice = None
@@ -247,6 +361,16 @@ if __name__ == '__main__':
                     login_to = input('Print user login: >')
                     text = input('Print text: >')
                     client.send_message_to_contact(login_to, text)
+                elif command == 'create_room':
+                    client.create_room_on_server(input('Print room name, starting with #: >'))
+                elif command == 'join_room':
+                    client.join_room_on_server(input('Print room name: >'))
+                elif command == 'leave_room':
+                    client.leave_room_on_server(input('Print room name: >'))
+                elif command == 'send_room_message':
+                    room = input('Print room name: >')
+                    text = input('Print text: >')
+                    client.send_message_to_room(room, text)
             except KeyboardInterrupt:
                 exit(1)
             except BaseException as e:
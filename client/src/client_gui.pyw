@@ -7,7 +7,7 @@ import logging
 import client_pyqt
 from client import Client
 import helpers
-from jim import request_from_bytes
+from jim import request_from_bytes, is_room_name
 import log_confing
 
 log = logging.getLogger(helpers.CLIENT_LOGGER_NAME)
@@ -28,9 +28,10 @@ class ClientMonitor(QObject):
 
     def check_new_messages(self):
         while True:
-            if self._user_messages_queue:
-                msg = self._user_messages_queue.get()
-                self.gotUserMessage.emit(msg.to_bytes())
+            msg = self._user_messages_queue.get()
+            if msg is helpers.QUEUE_STOP:  # client closed, thread event loop quits then
+                return
+            self.gotUserMessage.emit(msg.to_bytes())
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -67,7 +68,13 @@ class MainWindow(QtWidgets.QMainWindow):
         msg = request_from_bytes(msg_bytes)
         login = msg.datadict['from']
         text = msg.datadict['message']
-        if not self.client.storage.get_contact_id(login):
+        if is_room_name(msg.datadict['to']):  # room chat keeps messages of all members, they do not become contacts
+            text = f'{login}: {text}'
+            login = msg.datadict['to']
+            if not self.client.storage.get_contact_id(login):
+                self.client.storage.add_contact(login)
+                self.update_contacts_widget()
+        elif not self.client.storage.get_contact_id(login):
             self.client.add_contact_on_server(login)
             self.client.update_contacts_from_server()
             self.update_contacts_widget()
@@ -82,8 +89,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.textBrowser_service_info.moveCursor(QtGui.QTextCursor.End)
 
     def clear_state(self):
-        self.monitor.set_queue(None)
         self.client.close_client()
+        self.thread.quit()
+        self.thread.wait()
+        self.monitor.set_queue(None)
         self.client = None
         self.username = None
         self.password = None
@@ -159,8 +168,13 @@ class MainWindow(QtWidgets.QMainWindow):
     def add_contact_click(self):
         try:
             login = self.ui.lineEdit_add_contact.text()
-            self.client.add_contact_on_server(login)
-            self.client.update_contacts_from_server()
+            if is_room_name(login):  # room is joined and its chat added to contacts list
+                self.client.join_room_on_server(login)
+                if not self.client.storage.get_contact_id(login):
+                    self.client.storage.add_contact(login)
+            else:
+                self.client.add_contact_on_server(login)
+                self.client.update_contacts_from_server()
             self.update_contacts_widget()
         except BaseException as e:
             self.print_info(ERROR_FORMAT.format(str(e)))
@@ -168,8 +182,12 @@ class MainWindow(QtWidgets.QMainWindow):
     def delete_contact_click(self):
         try:
             login = self.ui.listWidget_contacts.selectedItems()[0].text()
-            self.client.delete_contact_on_server(login)
-            self.client.update_contacts_from_server()
+            if is_room_name(login):
+                self.client.leave_room_on_server(login)
+                self.client.storage.delete_contact(login)
+            else:
+                self.client.delete_contact_on_server(login)
+                self.client.update_contacts_from_server()
             self.update_contacts_widget()
             self.clear_messages_widget()
         except BaseException as e:
@@ -186,7 +204,11 @@ class MainWindow(QtWidgets.QMainWindow):
             if not text:
                 self.print_info('Message text cannot be empty')
                 return
-            self.client.send_message_to_contact(login, text)
+            if is_room_name(login):
+                self.client.send_message_to_room(login, text)
+                self.client.storage.add_message(login, text)
+            else:
+                self.client.send_message_to_contact(login, text)
             self.update_messages_widget(login)
             self.ui.textEdit_input.clear()
         except BaseException as e:
@@ -194,6 +216,8 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def format_message(self, login: str, message: dict) -> str:
         """Format message dict returned by Client.get_messages()"""
+        if is_room_name(login) and message['incoming']:  # text starts with login of member who sent it
+            return f'{login}:\n{message["text"]}'
         login_from = login if message['incoming'] else self.username
         login_to = self.username if message['incoming'] else login
         return f'{login_from} -> {login_to}:\n{message["text"]}'
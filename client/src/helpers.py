@@ -5,9 +5,19 @@ import binascii
 
 DEFAULT_SERVER_PORT = 7777
 TCP_MSG_BUFFER_SIZE = 1024
+MAX_MESSAGE_SIZE = 1024 * 1024
+OUTBOX_HIGH_WATERMARK = 256 * 1024
+OUTBOX_LOW_WATERMARK = 64 * 1024
+OUTBOX_LIMIT = 4 * 1024 * 1024
+QUEUED_REQUESTS_LIMIT = 64
 DEFAULT_SERVER_IP = '127.0.0.1'
 SERVER_SOCKET_TIMEOUT = 0.2
 CLIENTS_COUNT_LIMIT = 100
+CONTACTS_PAGE_LIMIT = 1000
+MAX_SESSIONS_PER_LOGIN = 8  # connections of one client at the same time, e.g. desktop and console
+OFFLINE_QUEUE_LIMIT = 1000  # messages kept for one client while it is not online
+OFFLINE_MESSAGE_TTL = 30 * 24 * 60 * 60  # seconds
+QUEUE_STOP = None  # put into queue to make its consumer thread return
 APP_NAME = 'messenger'
 SERVER_LOGGER_NAME = f'{APP_NAME}.server'
 CLIENT_LOGGER_NAME = f'{APP_NAME}.client'
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from async_client import AsyncClient
+import jim
+
+
+class FakeServer:
+    """ Answers client requests like messenger server does, echoes request ids if features tell so """
+    def __init__(self, features):
+        self.features = features
+        self.requests = []
+        self.contacts = []
+        self.unanswered_actions = set()
+        self.writers = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def disconnect_clients(self):
+        for writer in self.writers:
+            writer.close()
+
+    async def handle_connection(self, reader, writer):
+        decoder = jim.JimStreamDecoder()
+        self.writers.append(writer)
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            for request in decoder.feed(data):
+                self.requests.append(request)
+                for resp in self.respond(request):
+                    if isinstance(resp, jim.JimResponse) and jim.FEATURE_REQUEST_ID in self.features:
+                        resp.request_id = request.request_id
+                    writer.write(resp.to_frame())
+            await writer.drain()
+        writer.close()
+
+    def respond(self, request) -> list:
+        if request.action in self.unanswered_actions:
+            return []
+        if request.action == 'presence':
+            return [jim.auth_server_message('cafebeef')]
+        if request.action == 'get_contacts':
+            return [jim.contacts_batch_response(self.contacts)]
+        resp = jim.JimResponse(200)
+        if request.action == 'authenticate':
+            resp.set_field('features', self.features)
+            return [resp]
+        if request.action == 'add_contact':
+            self.contacts.append(request.datadict['user_id'])
+        if request.action == 'msg':  # echo message back as incoming one
+            return [resp, jim.message_request(request.datadict['to'], request.datadict['from'],
+                                              request.datadict['message'])]
+        return [resp]
+
+
+class TestAsyncClient:
+    features = [jim.FEATURE_CONTACTS_BATCH, jim.FEATURE_REQUEST_ID]
+
+    def run(self, test_coroutine):
+        async def run_with_server():
+            self.server = FakeServer(self.features)
+            address = await self.server.start()
+            client = AsyncClient('TestLogin', 'TestPassword', ':memory:')
+            try:
+                await client.connect(*address)
+                await test_coroutine(client)
+            finally:
+                await client.close_client()
+                await self.server.close()
+        asyncio.run(run_with_server())
+
+    def test__connect__authenticated_and_features_known(self):
+        async def test(client):
+            assert client.server_features == set(self.features)
+        self.run(test)
+
+    def test__add_contacts_then_update__contacts_stored(self):
+        async def test(client):
+            await client.add_contacts_on_server(['Login1', 'Login2', 'Login3'])
+            await client.update_contacts_from_server()
+            assert sorted(client.get_current_contacts()) == ['Login1', 'Login2', 'Login3']
+        self.run(test)
+
+    def test__add_contacts__requests_pipelined_with_ids(self):
+        async def test(client):
+            await client.add_contacts_on_server(['Login1', 'Login2', 'Login3'])
+            ids = [request.request_id for request in self.server.requests if request.action == 'add_contact']
+            expected = [1, 2, 3] if jim.FEATURE_REQUEST_ID in self.features else [None] * 3
+            assert ids == expected
+        self.run(test)
+
+    def test__send_messages__stored_and_incoming_messages_iterated(self):
+        async def test(client):
+            await client.add_contact_on_server('Login1')
+            await client.update_contacts_from_server()
+            await client.send_messages_to_contact('Login1', ['first', 'second'])
+            assert [item['text'] for item in client.get_messages('Login1')] == ['first', 'second']
+            received = []
+            async for message in client:
+                received.append(message.datadict['message'])
+                if len(received) == 2:
+                    break
+            assert received == ['first', 'second']
+        self.run(test)
+
+    def test__connection_closed__iteration_stops_and_requests_fail(self):
+        async def test(client):
+            self.server.disconnect_clients()
+            assert [message async for message in client] == []
+            with pytest.raises(ConnectionError):
+                await client.add_contact_on_server('Login1')
+        self.run(test)
+
+    def test__close_client__request_outstanding__request_fails(self):
+        async def test(client):
+            self.server.unanswered_actions.add('del_contact')
+            request = asyncio.create_task(client.delete_contact_on_server('Login1'))
+            while not any(item.action == 'del_contact' for item in self.server.requests):
+                await asyncio.sleep(0.01)
+            await client.close_client()
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(request, 5)
+        self.run(test)
+
+
+class TestAsyncClientWithoutRequestIds(TestAsyncClient):
+    features = [jim.FEATURE_CONTACTS_BATCH]
@@ -1,8 +1,12 @@
+from socket import create_server
+from threading import Thread
+import time
+
 import pytest
 
 from client import parse_commandline_args, Client
 import helpers
-from jim import JimRequest
+from jim import JimRequest, JimResponse, JimStreamDecoder
 
 
 # tests for: parse_commandline_args
@@ -91,3 +95,42 @@ class TestClient:
     def test__send_message_to_server__incorrect_input_type_raises(self):
         with pytest.raises(AttributeError):
             self.test_client.send_message_to_server([1, 2, 3])
+
+
+class TestClientConnection:
+    test_username = helpers.DEFAULT_CLIENT_LOGIN
+
+    @pytest.fixture(autouse=True)
+    def server(self):
+        self.listener = create_server(('127.0.0.1', 0))
+        self.connections = []
+        self.client = Client(self.test_username, helpers.DEFAULT_CLIENT_PASSWORD, ':memory:')
+        server_thread = Thread(target=self.answer_presence, daemon=True)
+        server_thread.start()
+        self.client.connect(*self.listener.getsockname())
+        server_thread.join()
+        yield
+        self.client.close_client()
+        for connection in self.connections:
+            connection.close()
+        self.listener.close()
+
+    def answer_presence(self):
+        connection, _ = self.listener.accept()
+        self.connections.append(connection)
+        decoder = JimStreamDecoder()
+        while not decoder.recv_into(connection):
+            pass
+        connection.sendall(JimResponse(200).to_frame())
+
+    def test__close_client__idle_reader_woken_up_and_queue_consumers_stopped(self):
+        start_time = time.monotonic()
+        self.client.close_client()
+        assert time.monotonic() - start_time < 1
+        assert self.client.user_messages_queue.get(timeout=1) is helpers.QUEUE_STOP
+
+    def test__server_closed_connection__queue_consumers_stopped_and_requests_fail(self):
+        self.connections[0].close()
+        assert self.client.user_messages_queue.get(timeout=5) is helpers.QUEUE_STOP
+        with pytest.raises(ConnectionError):
+            self.client.add_contact_on_server('TestContact')
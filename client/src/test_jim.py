@@ -1,3 +1,5 @@
+from socket import socketpair
+
 import pytest
 
 from jim import *
@@ -120,3 +122,128 @@ def test__jim_response_from_bytes__response_set__correct_result():
     byte_data = test.to_bytes()
     actual = response_from_bytes(byte_data)
     assert test == actual
+
+
+class TestJimStreamDecoder:
+    def make_messages(self, count):
+        messages = []
+        for i in range(count):
+            message = JimRequest('msg')
+            message.set_field('message', f'text {i}')
+            messages.append(message)
+        return messages
+
+    def test_feed__one_whole_frame__one_message(self):
+        message = self.make_messages(1)[0]
+        assert JimStreamDecoder().feed(message.to_frame()) == [message]
+
+    def test_feed__several_frames_in_one_chunk__all_messages_in_order(self):
+        messages = self.make_messages(3)
+        data = b''.join(message.to_frame() for message in messages)
+        assert JimStreamDecoder().feed(data) == messages
+
+    def test_feed__frame_split_between_chunks__message_after_last_chunk(self):
+        message = self.make_messages(1)[0]
+        data = message.to_frame()
+        decoder = JimStreamDecoder()
+        for byte_index in range(len(data) - 1):
+            assert decoder.feed(data[byte_index:byte_index + 1]) == []
+        assert decoder.feed(data[-1:]) == [message]
+        assert decoder.pending_bytes == 0
+
+    def test_feed__response_factory__responses_created(self):
+        response = JimResponse(200)
+        actual = JimStreamDecoder(response_from_bytes).feed(response.to_frame())
+        assert isinstance(actual[0], JimResponse)
+        assert actual[0].response == 200
+
+    def test_recv_into__message_larger_than_buffer__buffer_grows(self):
+        message = JimRequest('msg')
+        message.set_field('message', 'x' * 10000)
+        decoder = JimStreamDecoder(buffer_size=16)
+        sender, receiver = socketpair()
+        with sender, receiver:
+            sender.sendall(message.to_frame())
+            messages = []
+            while not messages:
+                messages = decoder.recv_into(receiver)
+        assert messages == [message]
+        assert decoder.buffer_size >= len(message.to_frame())
+
+    def test_recv_into__peer_closed__raises(self):
+        sender, receiver = socketpair()
+        with receiver:
+            sender.close()
+            with pytest.raises(EOFError):
+                JimStreamDecoder().recv_into(receiver)
+
+    def test_feed__message_larger_than_limit__raises(self):
+        message = JimRequest('msg')
+        message.set_field('message', 'x' * 100)
+        with pytest.raises(ValueError):
+            JimStreamDecoder(max_message_size=50).feed(message.to_frame())
+
+    def test_feed__many_small_chunks__buffer_does_not_grow(self):
+        messages = self.make_messages(100)
+        decoder = JimStreamDecoder(buffer_size=64)
+        decoded = []
+        for message in messages:
+            decoded += decoder.feed(message.to_frame())
+        assert decoded == messages
+        assert decoder.buffer_size == 64
+
+
+# tests for: request_from_frame
+def test__request_from_frame__msg__relay_message_with_original_frame():
+    message = message_request('TestFrom', 'TestTo', 'text')
+    frame = message.to_frame()
+    actual = request_from_frame(memoryview(frame))
+    assert isinstance(actual, JimRelayMessage)
+    assert (actual.login_to, actual.login_from) == ('TestTo', 'TestFrom')
+    assert bytes(actual.to_frame()) == frame
+    assert actual.datadict == message.datadict
+
+
+def test__request_from_frame__msg_with_request_id__relay_message_with_id():
+    message = message_request('TestFrom', 'TestTo', 'text')
+    message.request_id = 7
+    actual = request_from_frame(memoryview(message.to_frame()))
+    assert isinstance(actual, JimRelayMessage)
+    assert (actual.login_to, actual.login_from, actual.request_id) == ('TestTo', 'TestFrom', 7)
+
+
+@pytest.mark.parametrize('duplicate_key', ['"from"', '"\\u0066rom"', '"to"'])
+def test__request_from_frame__msg_with_duplicate_routing_key__parsed_request(duplicate_key):
+    payload = '{"action": "msg", "time": "1", "to": "TestTo", "from": "TestFrom", "encoding": "utf-8", ' \
+              f'"message": "text", {duplicate_key}: "TestOther"}}'
+    actual = request_from_frame(memoryview(frame_bytes(payload.encode('utf-8'))))
+    assert isinstance(actual, JimRequest)
+    assert 'TestOther' in (actual.datadict['to'], actual.datadict['from'])
+
+
+def test__request_from_frame__msg_text_looks_like_routing_key__relay_message():
+    message = message_request('TestFrom', 'TestTo', '"from": "TestOther"')
+    actual = request_from_frame(memoryview(message.to_frame()))
+    assert isinstance(actual, JimRelayMessage)
+    assert actual.login_from == actual.datadict['from'] == 'TestFrom'
+
+
+def test__request_id__set_on_request__placed_after_action():
+    message = message_request('TestFrom', 'TestTo', 'text')
+    message.request_id = 7
+    assert list(message.datadict)[:2] == ['action', 'id']
+    assert request_from_bytes(message.to_bytes()).request_id == 7
+
+
+def test__request_from_frame__not_msg__parsed_request():
+    message = get_contacts_request()
+    actual = request_from_frame(memoryview(message.to_frame()))
+    assert isinstance(actual, JimRequest)
+    assert actual == message
+
+
+def test__request_from_frame__msg_with_escaped_login__parsed_request():
+    message = message_request('TestFrom', 'Test"To', 'text')
+    actual = request_from_frame(memoryview(message.to_frame()))
+    assert isinstance(actual, JimRequest)
+    assert actual.datadict['to'] == 'Test"To'
@@ -1,7 +1,13 @@
+import gc
+import os
+import sys
+
 import pytest
 import sqlite3
+from threading import Event, Thread
 
-from storage import DBStorageServer, DBStorageClient
+from storage import DBStorageServer, DBStorageClient, DBPresenceDirectory, LockedStorage, BloomFilter, \
+    ClientIdentityCache, DURABILITY_GROUP, SERVER_MIGRATIONS, CLIENT_MIGRATIONS
 
 
 class TestDBStorageServer:
@@ -137,6 +143,321 @@ class TestDBStorageServer:
             self.storage.check_client_in_contacts(None, None)
 
 
+class TestDBStorageServerOfflineMessages:
+    test_login = 'TestLogin'
+    test_frames = [b'first', b'second', b'third']
+    test_ttl = 60
+
+    def setup_method(self):
+        self.storage = DBStorageServer(':memory:')
+        self.storage.add_client(self.test_login, 'test_hash')
+
+    def test__pop_offline_messages__frames_returned_in_order_and_removed(self):
+        for frame in self.test_frames:
+            assert self.storage.add_offline_message(self.test_login, frame, 10, self.test_ttl)
+        assert self.storage.pop_offline_messages(self.test_login, self.test_ttl) == self.test_frames
+        assert self.storage.pop_offline_messages(self.test_login, self.test_ttl) == []
+
+    def test__add_offline_message__queue_full__returns_false(self):
+        assert self.storage.add_offline_message(self.test_login, self.test_frames[0], 1, self.test_ttl)
+        assert not self.storage.add_offline_message(self.test_login, self.test_frames[1], 1, self.test_ttl)
+        assert self.storage.pop_offline_messages(self.test_login, self.test_ttl) == self.test_frames[:1]
+
+    def test__pop_offline_messages__expired_messages_dropped(self):
+        self.storage.add_offline_message(self.test_login, self.test_frames[0], 10, self.test_ttl)
+        self.storage.cursor.execute('UPDATE `OfflineMessages` SET `time` = `time` - ?', (self.test_ttl * 2,))
+        assert self.storage.pop_offline_messages(self.test_login, self.test_ttl) == []
+        self.storage.cursor.execute('SELECT COUNT() FROM `OfflineMessages`')
+        assert self.storage.cursor.fetchall()[0][0] == 0
+
+
+class TestDBStorageServerRooms:
+    test_logins = ['TestLogin1', 'TestLogin2']
+    test_room = '#test_room'
+
+    def setup_method(self):
+        self.storage = DBStorageServer(':memory:')
+        for login in self.test_logins:
+            self.storage.add_client(login, 'test_hash')
+        self.storage.add_room(self.test_room, self.test_logins[0])
+
+    def test__add_room__owner_is_member(self):
+        assert self.storage.check_room_exists(self.test_room)
+        assert self.storage.get_room_members(self.test_room) == self.test_logins[:1]
+
+    def test__add_room__already_exists__raises(self):
+        with pytest.raises(RuntimeError):
+            self.storage.add_room(self.test_room, self.test_logins[1])
+
+    def test__add_and_del_room_member__members_updated(self):
+        self.storage.add_room_member(self.test_room, self.test_logins[1])
+        assert self.storage.check_client_in_room(self.test_room, self.test_logins[1])
+        assert sorted(self.storage.get_room_members(self.test_room)) == self.test_logins
+        self.storage.del_room_member(self.test_room, self.test_logins[1])
+        assert not self.storage.check_client_in_room(self.test_room, self.test_logins[1])
+
+    def test__add_client__login_with_room_prefix__raises(self):
+        with pytest.raises(ValueError):
+            self.storage.add_client(self.test_room, 'test_hash')
+        assert not self.storage.check_client_exists(self.test_room)
+
+    def test__update_contacts__client_storage__rooms_kept(self):
+        storage = DBStorageClient(':memory:')
+        for contact in self.test_logins[:1] + [self.test_room]:
+            storage.add_contact(contact)
+        storage.add_message(self.test_room, 'TestLogin2: hello', True)
+        storage.update_contacts(self.test_logins[1:])
+        assert sorted(storage.get_contacts()) == [self.test_room, self.test_logins[1]]
+        assert storage.get_messages(self.test_room) == [('TestLogin2: hello', 1)]
+
+
+class TestClientIdentityCache:
+    def test__put_over_capacity__least_recently_used_evicted(self):
+        cache = ClientIdentityCache(2)
+        cache.put('Login1', 1)
+        cache.put('Login2', 2)
+        assert cache.get_id('Login1') == 1
+        cache.put('Login3', 3)
+        assert cache.get_id('Login2') is None
+        assert cache.get_login(1) == 'Login1'
+        assert cache.get_login(2) is None
+        assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test__bloom_filter__added_items_always_found():
+    bloom = BloomFilter(1000)
+    logins = [f'Login{i}' for i in range(1000)]
+    for login in logins:
+        bloom.add(login)
+    assert all(login in bloom for login in logins)
+    assert sum(f'Unknown{i}' in bloom for i in range(1000)) < 50
+
+
+class TestDBStorageServerClientIdCache:
+    test_logins = ['TestLogin1', 'TestLogin2']
+
+    @pytest.fixture(autouse=True)
+    def storage(self, tmp_path):
+        self.storage_file = str(tmp_path / 'server.sqlite')
+        self.storage = DBStorageServer(self.storage_file)
+        for login in self.test_logins:
+            self.storage.add_client(login, 'test_hash')
+
+    def test__add_client_to_contacts__client_ids_read_from_cache(self):
+        misses = self.storage.client_id_cache_stats['misses']
+        self.storage.add_client_to_contacts(*self.test_logins)
+        assert self.storage.check_client_in_contacts(*self.test_logins)
+        assert self.storage.client_id_cache_stats['misses'] == misses
+        assert self.storage.get_client_login(self.storage.get_client_id(self.test_logins[1])) == self.test_logins[1]
+
+    def test__check_client_exists__unknown_login_filtered_without_query(self):
+        filtered_logins = self.storage.client_id_cache_stats['filtered_logins']
+        assert not self.storage.check_client_exists('UnknownLogin')
+        assert self.storage.client_id_cache_stats['filtered_logins'] == filtered_logins + 1
+        assert self.storage.check_client_exists(self.test_logins[0])
+
+    def test__check_client_exists__client_added_by_other_connection__found(self):
+        self.storage = DBStorageServer(self.storage_file, logins_refresh_interval=0)
+        assert not self.storage.check_client_exists('NewLogin')
+        DBStorageServer(self.storage_file).add_client('NewLogin', 'test_hash')
+        assert self.storage.check_client_exists('NewLogin')
+        assert self.storage.get_client_id('NewLogin') == len(self.test_logins) + 1
+
+    def test__check_client_exists__filter_full__filter_grows(self):
+        assert not self.storage.check_client_exists('UnknownLogin')
+        for i in range(2000):
+            self.storage.add_client(f'Login{i}', 'test_hash')
+        assert all(self.storage.check_client_exists(f'Login{i}') for i in range(2000))
+
+
+class TestDBStorageServerGroupCommit:
+    test_logins = ['TestLogin1', 'TestLogin2']
+
+    @pytest.fixture(autouse=True)
+    def storage(self, tmp_path):
+        self.storage_file = str(tmp_path / 'server.sqlite')
+        DBStorageServer(self.storage_file)  # schema is created by sync storage, so other connection can read it
+        self.storage = DBStorageServer(self.storage_file, durability=DURABILITY_GROUP, flush_interval=60, flush_limit=5)
+        for login in self.test_logins:
+            self.storage.add_client(login, 'test_hash')
+        self.reader = DBStorageServer(self.storage_file)
+
+    def test__init__unknown_durability__raises(self):
+        with pytest.raises(ValueError):
+            DBStorageServer(':memory:', durability='unknown')
+
+    def test__update_client__updates_of_client_coalesced_and_committed_by_flush(self):
+        self.storage.update_client(self.test_logins[0], 1.0, '1.1.1.1')
+        self.storage.update_client(self.test_logins[0], 2.0, '2.2.2.2')
+        self.storage.add_client_to_contacts(*self.test_logins)
+        assert self.storage.check_client_in_contacts(*self.test_logins)
+        assert ('TestLogin1', 2.0, '2.2.2.2') in self.storage.get_clients()
+        assert not self.reader.check_client_in_contacts(*self.test_logins)
+        assert ('TestLogin1', None, None) in self.reader.get_clients()
+        self.storage.flush()
+        assert self.reader.check_client_in_contacts(*self.test_logins)
+        assert ('TestLogin1', 2.0, '2.2.2.2') in self.reader.get_clients()
+        assert self.storage.write_stats == {'unflushed_changes': 0, 'flushes': 1}
+
+    def test__update_client__flush_limit_reached__committed(self):
+        for i in range(5):
+            self.storage.update_client(self.test_logins[i % 2], float(i), '1.1.1.1')
+        assert ('TestLogin2', 3.0, '1.1.1.1') in self.reader.get_clients()
+
+    def test__flush_if_due__interval_passed__committed(self):
+        self.storage.update_client(self.test_logins[0], 1.0, '1.1.1.1')
+        self.storage.flush_if_due()
+        assert self.storage.write_stats['unflushed_changes'] == 1
+        self.storage.flush()
+        storage = DBStorageServer(self.storage_file, durability=DURABILITY_GROUP, flush_interval=0)
+        storage.update_client(self.test_logins[1], 1.0, '1.1.1.1')
+        storage.flush_if_due()
+        assert ('TestLogin2', 1.0, '1.1.1.1') in self.reader.get_clients()
+
+    def test__close__changes_committed_and_connection_closed(self):
+        self.storage.update_client(self.test_logins[0], 1.0, '1.1.1.1')
+        self.storage.close()
+        assert ('TestLogin1', 1.0, '1.1.1.1') in self.reader.get_clients()
+        with pytest.raises(sqlite3.ProgrammingError):
+            self.storage.get_clients()
+
+
+class TestDBStorageServerWal:
+    test_logins = ['TestLogin1', 'TestLogin2']
+
+    @pytest.fixture(autouse=True)
+    def storage(self, tmp_path):
+        self.storage_file = str(tmp_path / 'server.sqlite')
+        self.storage = DBStorageServer(self.storage_file, durability=DURABILITY_GROUP, wal=True)
+        for login in self.test_logins:
+            self.storage.add_client(login, 'test_hash')
+
+    def read_in_thread(self, function, *args):
+        results = []
+        thread = Thread(target=lambda: results.append(function(*args)))
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test__init__memory_database__raises(self, monkeypatch):
+        unraisable = []
+        monkeypatch.setattr(sys, 'unraisablehook', unraisable.append)
+        with pytest.raises(ValueError):
+            DBStorageServer(':memory:', wal=True)
+        gc.collect()
+        assert unraisable == []  # failed storage is finalized without errors
+
+    def test__init__journal_mode_is_wal(self):
+        assert self.storage.wal
+        self.storage.cursor.execute('PRAGMA journal_mode')
+        assert self.storage.cursor.fetchall()[0][0] == 'wal'
+
+    def test__read__other_thread_reads_committed_data_while_changes_pending(self):
+        self.storage.add_client_to_contacts(*self.test_logins)
+        assert self.storage.get_client_contacts(self.test_logins[0]) == self.test_logins[1:]
+        assert self.read_in_thread(self.storage.get_client_contacts, self.test_logins[0]) == []
+        self.storage.flush()
+        assert self.read_in_thread(self.storage.get_client_contacts, self.test_logins[0]) == self.test_logins[1:]
+        assert self.storage.get_client_contacts(self.test_logins[0]) == self.test_logins[1:]
+
+    def test__locked_storage__read_while_other_thread_writes__not_blocked(self, tmp_path):
+        storage = DBStorageServer(str(tmp_path / 'sync.sqlite'), check_same_thread=False, wal=True)
+        locked_storage = LockedStorage(storage)
+        for login in self.test_logins:
+            locked_storage.add_client(login, 'test_hash')
+        in_transaction, done = Event(), Event()
+
+        def add_contact_slowly():  # holds lock of storage with write transaction open
+            storage.cursor.execute('INSERT INTO `ClientContacts` VALUES (1, 2)')
+            in_transaction.set()
+            done.wait(5)
+            storage.conn.commit()
+        storage.add_contact_slowly = add_contact_slowly
+        writer = Thread(target=locked_storage.add_contact_slowly)
+        writer.start()
+        assert in_transaction.wait(5)
+        results = []
+        reader = Thread(target=lambda: results.append(locked_storage.get_client_contacts(self.test_logins[0])))
+        reader.start()
+        reader.join(5)
+        assert results == [[]]  # committed data is read while transaction is open
+        assert storage.conn.in_transaction
+        done.set()
+        writer.join()
+        assert locked_storage.get_client_contacts(self.test_logins[0]) == self.test_logins[1:]
+        storage.close()
+
+    def test__close__writer_and_reader_connections_closed(self):
+        self.storage.add_client_to_contacts(*self.test_logins)
+        assert self.read_in_thread(self.storage.get_client_contacts, self.test_logins[0]) == []
+        self.storage.close()
+        assert not os.path.exists(self.storage_file + '-wal')  # removed when the last connection is closed
+        assert DBStorageServer(self.storage_file).get_client_contacts(self.test_logins[0]) == self.test_logins[1:]
+
+
+class TestStorageMigrations:
+    @pytest.fixture(autouse=True)
+    def database(self, tmp_path):
+        self.database = str(tmp_path / 'storage.sqlite')
+
+    def index_names(self, storage) -> set:
+        storage.cursor.execute("SELECT `name` FROM `sqlite_master` WHERE `type` == 'index'")
+        return {item[0] for item in storage.cursor.fetchall()}
+
+    def test__init__new_database__all_migrations_applied(self):
+        assert DBStorageServer(self.database).schema_version == len(SERVER_MIGRATIONS)
+        assert DBStorageClient(':memory:').schema_version == len(CLIENT_MIGRATIONS)
+
+    def test__init__database_created_before_versioning__data_kept_and_indexes_added(self):
+        conn = sqlite3.connect(self.database)
+        conn.executescript(SERVER_MIGRATIONS[0])
+        conn.execute("INSERT INTO `Clients` VALUES (NULL, 'TestLogin', 'test_hash', NULL, NULL)")
+        conn.commit()
+        conn.close()
+        storage = DBStorageServer(self.database)
+        assert storage.schema_version == len(SERVER_MIGRATIONS)
+        assert storage.check_client_exists('TestLogin')
+        assert 'ClientsLastConnect' in self.index_names(storage)
+
+    def test__init__older_schema_version__upgraded_when_opened_again(self):
+        storage = DBStorageClient(self.database, schema_version=1)
+        assert storage.schema_version == 1
+        assert 'MessagesContact' not in self.index_names(storage)
+        storage = DBStorageClient(self.database)
+        assert storage.schema_version == len(CLIENT_MIGRATIONS)
+        assert 'MessagesContact' in self.index_names(storage)
+
+    def test__presence_directory__older_schema_version__presence_table_added_by_migration(self):
+        storage = DBStorageServer(self.database, schema_version=2)
+        storage.add_client('TestLogin', 'test_hash')
+        storage.close()
+        directory = DBPresenceDirectory(self.database)
+        assert directory.schema_version == len(SERVER_MIGRATIONS)
+        directory.add_session('TestLogin', 1)
+        assert directory.count_sessions('TestLogin') == 1
+        assert DBStorageServer(self.database).check_client_exists('TestLogin')
+
+    def test__init__newer_schema_version__raises(self):
+        sqlite3.connect(self.database).execute(f'PRAGMA user_version = {len(SERVER_MIGRATIONS) + 1}')
+        with pytest.raises(RuntimeError):
+            DBStorageServer(self.database)
+
+    def test__migrate__failed_migration__rolled_back(self):
+        storage = DBStorageServer(self.database)
+        failing_migration = 'CREATE TABLE `NewTable`(`value` INTEGER); INSERT INTO `UnknownTable` VALUES (1);'
+        with pytest.raises(sqlite3.OperationalError):
+            storage._migrate(SERVER_MIGRATIONS + (failing_migration,))
+        assert storage.schema_version == len(SERVER_MIGRATIONS)
+        storage.cursor.execute("SELECT COUNT() FROM `sqlite_master` WHERE `name` == 'NewTable'")
+        assert storage.cursor.fetchall()[0][0] == 0
+
+    def test__get_messages__reads_messages_of_contact_by_index(self):
+        storage = DBStorageClient(':memory:')
+        storage.cursor.execute('EXPLAIN QUERY PLAN SELECT `text`, `incoming` FROM `Messages` WHERE `contact_id` == ? '
+                               'ORDER BY `id`', (1,))
+        assert 'MessagesContact' in str(storage.cursor.fetchall())
+
+
 class TestDBStorageClient:
     test_db = ':memory:'
     test_login = 'TestLogin'
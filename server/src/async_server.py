@@ -0,0 +1,205 @@
+import asyncio
+from socket import socket, AF_INET, SOCK_STREAM
+import sys
+import logging
+import os
+from threading import Thread
+from queue import Queue
+
+import helpers
+from jim import JimStreamDecoder, request_from_frame
+from storage import DURABILITY_SYNC
+from storage_backends import create_server_storage, STORAGE_SQLITE
+from sessions import Session, SessionRegistry
+from handlers import RequestContext, default_dispatcher
+from rooms import RoomMembersCache
+from metrics import ServerMetrics
+from server import ServerVerifierMeta, parse_commandline_args, check_new_print_data_thread_function
+import log_confing
+
+log = logging.getLogger(helpers.SERVER_LOGGER_NAME)
+
+
+class AsyncConnection(Session):
+    """ Session of one client connection served by AsyncServer, outbox is the transport write buffer """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_message_size: int,
+                 **outbox_settings):
+        decoder = JimStreamDecoder(request_from_frame, max_message_size, pass_frames=True)
+        super().__init__(writer, writer.get_extra_info('peername'), decoder, **outbox_settings)
+        self.reader = reader
+        self.writer = writer
+        writer.transport.set_write_buffer_limits(high=self.high_watermark, low=self.low_watermark)
+
+    @property
+    def has_pending_output(self) -> bool:
+        return self.writer.transport.get_write_buffer_size() > 0
+
+    def send(self, data) -> bool:
+        if self.close_reason is not None or self.writer.transport.is_closing():
+            return False
+        if self.writer.transport.get_write_buffer_size() + len(data) > self.outbox_limit:
+            self.close_reason = f'outbox limit exceeded: {self.outbox_limit} bytes'
+            self.writer.transport.abort()  # drop everything queued, reader of this connection will finish it
+            return False
+        if isinstance(data, memoryview):  # transport may keep it unsent, while decoder reuses the buffer under it
+            data = bytes(data)
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+        return True
+
+
+class AsyncServer(metaclass=ServerVerifierMeta):
+    """
+    Server engine built on asyncio streams: every connection is served by its own coroutine,
+    so there is no accept timeout and no select() polling. Public surface is the same as in Server.
+    """
+    def __init__(self, host, port, storage, clients_limit=helpers.CLIENTS_COUNT_LIMIT,
+                 max_message_size=helpers.MAX_MESSAGE_SIZE, dispatcher=None,
+                 outbox_high_watermark=helpers.OUTBOX_HIGH_WATERMARK, outbox_low_watermark=helpers.OUTBOX_LOW_WATERMARK,
+                 outbox_limit=helpers.OUTBOX_LIMIT, max_sessions_per_login=helpers.MAX_SESSIONS_PER_LOGIN,
+                 durability=DURABILITY_SYNC, wal=False, storage_backend=STORAGE_SQLITE):
+        self.__host = host
+        self.__port = port
+        self.__storage_name = storage
+        self.__clients_limit = clients_limit
+        self.__max_message_size = max_message_size
+        self.__outbox_settings = {'high_watermark': outbox_high_watermark, 'low_watermark': outbox_low_watermark,
+                                  'outbox_limit': outbox_limit}
+        self.__dispatcher = dispatcher if dispatcher is not None else default_dispatcher()
+        self.__durability = durability
+        self.__wal = wal
+        self.__storage_backend = storage_backend
+
+        self.__socket = None
+        self.__storage = None
+        self.__loop = None
+        self.__stop_event = None
+        self.__worker_thread = None
+        self.__print_queue = Queue()
+        self.__sessions = SessionRegistry(max_sessions_per_login)
+        self.__rooms = None
+        self.__metrics = ServerMetrics(self.__dispatcher)
+        self.__metrics.add_gauge('print_queue', self.__print_queue.qsize)
+        self.__metrics.add_gauge_group(
+            'client_id_cache', lambda: self.__storage.client_id_cache_stats if self.__storage is not None else {})
+        self.__metrics.add_gauge_group(
+            'storage', lambda: self.__storage.write_stats if self.__storage is not None else {})
+
+    def start(self):
+        if self.__socket:
+            raise RuntimeError('Already started')
+        self.__socket = socket(AF_INET, SOCK_STREAM)
+        self.__socket.bind((self.__host, self.__port))
+        self.__socket.listen(self.__clients_limit)
+        self.__socket.setblocking(False)
+        self.__loop = asyncio.new_event_loop()
+        self.__stop_event = asyncio.Event()
+        self.__worker_thread = Thread(target=self.worker_thread_function)
+        self.__worker_thread.daemon = True
+        self.__worker_thread.start()
+
+    def close_server(self):
+        if not self.__socket:
+            raise RuntimeError('Not running')
+        self.__loop.call_soon_threadsafe(self.__stop_event.set)
+        self.__worker_thread.join()
+        self.__worker_thread = None
+        self.__socket = None
+        self.__loop = None
+
+    def worker_thread_function(self):
+        self.__storage = create_server_storage(self.__storage_backend, self.__storage_name,
+                                               durability=self.__durability, wal=self.__wal)
+        self.__rooms = RoomMembersCache()
+        asyncio.set_event_loop(self.__loop)
+        try:
+            self.__loop.run_until_complete(self.mainloop())
+        finally:
+            self.__loop.close()
+            self.__storage.close()
+            self.__storage = None
+
+    @property
+    def print_queue(self):
+        return self.__print_queue
+
+    @property
+    def storage(self):
+        return self.__storage
+
+    @property
+    def metrics(self) -> ServerMetrics:
+        return self.__metrics
+
+    @property
+    def dispatcher(self):
+        return self.__dispatcher
+
+    @property
+    def address(self):
+        """ Actual (host, port) the server listens on, useful when started with port 0 """
+        return self.__socket.getsockname() if self.__socket else None
+
+    async def mainloop(self):
+        server = await asyncio.start_server(self.handle_connection, sock=self.__socket)
+        while not self.__stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.__stop_event.wait(), helpers.SERVER_SOCKET_TIMEOUT)
+            except asyncio.TimeoutError:  # wakes up to commit storage changes waiting for group commit
+                self.__storage.flush_if_due()
+        server.close()
+        for connection in self.__sessions:
+            connection.writer.close()
+        await server.wait_closed()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = AsyncConnection(reader, writer, self.__max_message_size, **self.__outbox_settings)
+        self.__sessions.add(connection)
+        self.__print_queue.put(f'Client connected: {str(connection.address)}')
+        self.__metrics.increment('connections_opened')
+        context = RequestContext(connection, self.__sessions, self.storage, self.__rooms, self.__metrics)
+        try:
+            while True:
+                data = await reader.read(helpers.TCP_MSG_BUFFER_SIZE)
+                if not data:
+                    raise ConnectionError('connection closed by client')
+                for request in connection.decoder.feed(data):
+                    self.__print_queue.put(f'Request:\n{request}')
+                    responses = self.__dispatcher.dispatch(request, context)
+                    self.__print_queue.put('Response:')
+                    for resp in responses:
+                        self.__print_queue.put(str(resp))
+                    connection.send(b''.join(resp.to_frame() for resp in responses))
+                await writer.drain()  # waits while transport buffer is above high watermark
+        except Exception as e:  # cancellation of task propagates
+            reason = connection.close_reason if connection.close_reason is not None else e
+            self.__print_queue.put(f'Client disconnected: {connection.address}, {reason}')
+        finally:
+            if self.__sessions.remove(connection):
+                self.__metrics.session_closed(connection)
+            writer.close()
+
+
+if __name__ == '__main__':
+    try:
+        args = parse_commandline_args(sys.argv[1:])
+        storage_file = os.path.join(helpers.get_this_script_full_dir(), 'server.sqlite')
+        server = AsyncServer(args.listen_address, args.listen_port, storage_file, durability=args.durability,
+                             wal=args.wal, storage_backend=args.storage_backend)
+        print_monitor = Thread(target=check_new_print_data_thread_function,
+                               args=(server.print_queue,))
+        print_monitor.daemon = True
+        print_monitor.start()
+        supported_commands = ['start', 'stop']
+        main_menu = helpers.Menu(supported_commands)
+        while True:
+            user_choice = int(input(main_menu))
+            command = main_menu.get_command(user_choice)
+            if command == 'start':
+                server.start()
+            if command == 'stop':
+                server.close_server()
+    except Exception as e:
+        print(f'Error: {str(e)}')
+        log.critical(str(e))
+        raise e
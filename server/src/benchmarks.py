@@ -0,0 +1,444 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from itertools import count
+from statistics import median
+
+import helpers
+import jim
+import security
+from storage import ServerStorage, DBStorageServer, DBStorageClient, DURABILITY_GROUP
+from storage_backends import create_server_storage, STORAGE_SQLITE, STORAGE_BACKENDS
+
+RESULTS_FORMAT = 1
+DEFAULT_ROWS = '1000,10000'
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.1
+ROOM_SIZE = 100  # members of every room in populated server database
+MESSAGE_CONTACTS = 100  # populated client messages are spread between that many contacts
+
+# name -> (setup, kind, max_rows), setup returns function to time:
+# setup() for kind None, setup(storage, rows) for server, server_group and client storage benchmarks,
+# server ones run against storage of selected backend
+BENCHMARKS = {}
+
+
+def benchmark(name: str, kind: str=None, max_rows: int=None):
+    """ Registers benchmark setup, storage benchmarks are skipped for databases larger than max_rows """
+    def register(setup):
+        if name in BENCHMARKS:
+            raise RuntimeError(f'Benchmark already registered: {name}')
+        BENCHMARKS[name] = (setup, kind, max_rows)
+        return setup
+    return register
+
+
+def parse_commandline_args(cmd_args):
+    parser = argparse.ArgumentParser(description='Runs microbenchmarks of jim, security and storage, '
+                                                 'optionally compares results with saved baseline')
+    parser.add_argument('-r', dest='rows', type=str, default=DEFAULT_ROWS,
+                        help=f'comma separated row counts of benchmark databases, default {DEFAULT_ROWS}')
+    parser.add_argument('-k', dest='filter', type=str, default='', help='run only benchmarks with this in name')
+    parser.add_argument('-n', dest='repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'timing repeats of every benchmark, default {DEFAULT_REPEAT}')
+    parser.add_argument('-o', dest='output', type=str, default=None, help='file to write results to, default stdout')
+    parser.add_argument('-b', dest='baseline', type=str, default=None, help='results file to compare with')
+    parser.add_argument('-t', dest='threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'relative slowdown reported as regression, default {DEFAULT_THRESHOLD}')
+    parser.add_argument('-s', dest='storage_backend', choices=STORAGE_BACKENDS, default=STORAGE_SQLITE,
+                        help='backend of server storage benchmarks, default sqlite')
+    parser.add_argument('-v', dest='schema_version', type=int, default=None,
+                        help='schema version of benchmark databases, to compare queries with older schema, '
+                             'default the latest')
+    return parser.parse_args(cmd_args)
+
+
+# jim benchmarks
+def sample_message() -> jim.JimRequest:
+    return jim.message_request('SenderLogin', 'RecipientLogin', 'Hello, this is a typical chat message text')
+
+
+@benchmark('jim.to_bytes')
+def bench_to_bytes():
+    return sample_message().to_bytes
+
+
+@benchmark('jim.from_bytes')
+def bench_from_bytes():
+    data = sample_message().to_bytes()
+    message = jim.JimRequest()
+    return lambda: message.from_bytes(data)
+
+
+@benchmark('jim.request_from_bytes')
+def bench_request_from_bytes():
+    data = sample_message().to_bytes()
+    return lambda: jim.request_from_bytes(data)
+
+
+@benchmark('jim.response_from_bytes')
+def bench_response_from_bytes():
+    data = jim.JimResponse(200).to_bytes()
+    return lambda: jim.response_from_bytes(data)
+
+
+@benchmark('jim.request_from_frame')
+def bench_request_from_frame():
+    frame = memoryview(sample_message().to_frame())
+    return lambda: jim.request_from_frame(frame)
+
+
+@benchmark('jim.stream_decoder_feed')
+def bench_stream_decoder_feed():
+    decoder = jim.JimStreamDecoder()
+    chunk = sample_message().to_frame() * 10
+    return lambda: decoder.feed(chunk)
+
+
+@benchmark('jim.message_request')
+def bench_message_request():
+    return sample_message
+
+
+@benchmark('jim.presence_request')
+def bench_presence_request():
+    return lambda: jim.presence_request('SenderLogin')
+
+
+@benchmark('jim.auth_client_message')
+def bench_auth_client_message():
+    return lambda: jim.auth_client_message('SenderLogin', 'cafebeef' * 4)
+
+
+@benchmark('jim.add_contact_request')
+def bench_add_contact_request():
+    return lambda: jim.add_contact_request('RecipientLogin')
+
+
+@benchmark('jim.get_contacts_request')
+def bench_get_contacts_request():
+    return lambda: jim.get_contacts_request(batch=True, limit=helpers.CONTACTS_PAGE_LIMIT)
+
+
+@benchmark('jim.contacts_batch_response')
+def bench_contacts_batch_response():
+    contacts = [f'Login{i}' for i in range(100)]
+    return lambda: jim.contacts_batch_response(contacts).to_bytes()
+
+
+# security benchmarks
+@benchmark('security.create_auth_digest')
+def bench_create_auth_digest():
+    secret = security.create_password_hash('TestPassword')
+    token = security.create_auth_token()
+    return lambda: security.create_auth_digest(secret, token)
+
+
+@benchmark('security.create_password_hash')
+def bench_create_password_hash():
+    return lambda: security.create_password_hash('TestPassword')
+
+
+@benchmark('security.create_auth_token')
+def bench_create_auth_token():
+    return security.create_auth_token
+
+
+# server storage benchmarks, database holds rows clients, each has one contact and is a member of one room
+def login(i: int) -> str:
+    return f'Login{i}'
+
+
+def room(i: int) -> str:
+    return f'#room{i}'
+
+
+def populate_server_storage(storage: DBStorageServer, rows: int):
+    cursor = storage.cursor
+    cursor.executemany('INSERT INTO `Clients` VALUES (?, ?, ?, ?, ?)',
+                       ((i + 1, login(i), 'cafebeef', i, '127.0.0.1') for i in range(rows)))
+    cursor.executemany('INSERT INTO `ClientContacts` VALUES (?, ?)', ((i + 1, (i + 1) % rows + 1) for i in range(rows)))
+    rooms = (rows + ROOM_SIZE - 1) // ROOM_SIZE
+    cursor.executemany('INSERT INTO `Rooms` VALUES (?, ?, ?)',
+                       ((i + 1, room(i), i * ROOM_SIZE + 1) for i in range(rooms)))
+    cursor.executemany('INSERT INTO `RoomMembers` VALUES (?, ?)', ((i // ROOM_SIZE + 1, i + 1) for i in range(rows)))
+    storage.conn.commit()
+
+
+@benchmark('storage.server.get_client_id', 'server')
+def bench_get_client_id(storage, rows):
+    return lambda: storage.get_client_id(login(rows // 2))
+
+
+@benchmark('storage.server.get_client_login', 'server')
+def bench_get_client_login(storage, rows):
+    return lambda: storage.get_client_login(rows // 2 + 1)  # id of login(rows // 2)
+
+
+@benchmark('storage.server.get_clients', 'server')
+def bench_get_clients(storage, rows):
+    return storage.get_clients
+
+
+@benchmark('storage.server.get_client_hash', 'server')
+def bench_get_client_hash(storage, rows):
+    return lambda: storage.get_client_hash(login(rows // 2))
+
+
+@benchmark('storage.server.check_client_exists', 'server')
+def bench_check_client_exists(storage, rows):
+    return lambda: storage.check_client_exists('UnknownLogin')
+
+
+@benchmark('storage.server.add_client', 'server')
+def bench_add_client(storage, rows):
+    new_logins = (f'NewLogin{i}' for i in count())
+    return lambda: storage.add_client(next(new_logins), 'cafebeef')
+
+
+@benchmark('storage.server.update_client', 'server')
+def bench_update_client(storage, rows):
+    return lambda: storage.update_client(login(rows // 2), 1.0, '127.0.0.1')
+
+
+@benchmark('storage.server.update_client_group_commit', 'server_group')
+def bench_update_client_group_commit(storage, rows):
+    logins = (login(i % rows) for i in count())  # login storm: every client connects once
+    return lambda: storage.update_client(next(logins), 1.0, '127.0.0.1')
+
+
+@benchmark('storage.server.check_client_in_contacts', 'server')
+def bench_check_client_in_contacts(storage, rows):
+    return lambda: storage.check_client_in_contacts(login(0), login(1))
+
+
+@benchmark('storage.server.add_and_del_client_contact', 'server')
+def bench_add_and_del_client_contact(storage, rows):
+    def add_and_del():
+        storage.add_client_to_contacts(login(0), login(2))
+        storage.del_client_from_contacts(login(0), login(2))
+    return add_and_del
+
+
+@benchmark('storage.server.get_client_contacts', 'server')
+def bench_get_client_contacts(storage, rows):
+    return lambda: storage.get_client_contacts(login(rows // 2))
+
+
+@benchmark('storage.server.get_client_contacts_page', 'server')
+def bench_get_client_contacts_page(storage, rows):
+    return lambda: storage.get_client_contacts(login(rows // 2), limit=helpers.CONTACTS_PAGE_LIMIT)
+
+
+@benchmark('storage.server.add_and_pop_offline_message', 'server')
+def bench_add_and_pop_offline_message(storage, rows):
+    frame = sample_message().to_frame()
+
+    def add_and_pop():
+        storage.add_offline_message(login(0), frame, helpers.OFFLINE_QUEUE_LIMIT, helpers.OFFLINE_MESSAGE_TTL)
+        storage.pop_offline_messages(login(0), helpers.OFFLINE_MESSAGE_TTL)
+    return add_and_pop
+
+
+@benchmark('storage.server.add_offline_messages_to_room', 'server')
+def bench_add_offline_messages_to_room(storage, rows):
+    frame = sample_message().to_frame()
+    members = storage.get_room_members(room(0))
+
+    def add_and_pop():
+        storage.add_offline_messages(members, frame, helpers.OFFLINE_QUEUE_LIMIT, helpers.OFFLINE_MESSAGE_TTL)
+        for member in members:
+            storage.pop_offline_messages(member, helpers.OFFLINE_MESSAGE_TTL)
+    return add_and_pop
+
+
+@benchmark('storage.server.get_room_id', 'server')
+def bench_get_room_id(storage, rows):
+    return lambda: storage.get_room_id(room(rows // ROOM_SIZE // 2))
+
+
+@benchmark('storage.server.check_room_exists', 'server')
+def bench_check_room_exists(storage, rows):
+    return lambda: storage.check_room_exists('#unknown_room')
+
+
+@benchmark('storage.server.add_room', 'server')
+def bench_add_room(storage, rows):
+    new_rooms = (f'#new_room{i}' for i in count())
+    return lambda: storage.add_room(next(new_rooms), login(0))
+
+
+@benchmark('storage.server.check_client_in_room', 'server')
+def bench_check_client_in_room(storage, rows):
+    return lambda: storage.check_client_in_room(room(0), login(1))
+
+
+@benchmark('storage.server.add_and_del_room_member', 'server')
+def bench_add_and_del_room_member(storage, rows):
+    def add_and_del():
+        storage.add_room_member(room(0), login(rows - 1))
+        storage.del_room_member(room(0), login(rows - 1))
+    return add_and_del
+
+
+@benchmark('storage.server.get_room_members', 'server')
+def bench_get_room_members(storage, rows):
+    return lambda: storage.get_room_members(room(0))
+
+
+# client storage benchmarks, database holds rows contacts and rows messages
+def populate_client_storage(storage: DBStorageClient, rows: int):
+    cursor = storage.cursor
+    cursor.executemany('INSERT INTO `Contacts` VALUES (?, ?)', ((i + 1, login(i)) for i in range(rows)))
+    message_contacts = min(rows, MESSAGE_CONTACTS)
+    cursor.executemany('INSERT INTO `Messages` VALUES (NULL, ?, ?, ?)',
+                       ((i % message_contacts + 1, i % 2, 'Hello, this is a typical chat message text')
+                        for i in range(rows)))
+    storage.conn.commit()
+
+
+@benchmark('storage.client.add_and_delete_contact', 'client')
+def bench_add_and_delete_contact(storage, rows):
+    def add_and_delete():
+        storage.add_contact('NewLogin')
+        storage.delete_contact('NewLogin')
+    return add_and_delete
+
+
+@benchmark('storage.client.get_contact_id', 'client')
+def bench_get_contact_id(storage, rows):
+    return lambda: storage.get_contact_id(login(rows // 2))
+
+
+@benchmark('storage.client.add_message', 'client')
+def bench_add_message(storage, rows):
+    return lambda: storage.add_message(login(0), 'Hello, this is a typical chat message text')
+
+
+@benchmark('storage.client.get_messages', 'client')
+def bench_get_messages(storage, rows):
+    return lambda: storage.get_messages(login(0))
+
+
+@benchmark('storage.client.get_contacts', 'client')
+def bench_get_contacts(storage, rows):
+    return storage.get_contacts
+
+
+@benchmark('storage.client.update_contacts', 'client', max_rows=10000)  # compares contact lists in O(n^2)
+def bench_update_contacts(storage, rows):
+    contacts = storage.get_contacts()
+    return lambda: storage.update_contacts(contacts)
+
+
+def time_function(func, repeat: int) -> dict:
+    """ Calls func enough times to take about 0.2 s, repeat times, returns seconds per call """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [total / number for total in timer.repeat(repeat, number)]
+    return {'seconds_per_op': min(times), 'median_seconds_per_op': median(times), 'ops_per_sec': 1 / min(times),
+            'number': number, 'repeat': repeat}
+
+
+def run_benchmarks(rows_list: list, name_filter='', repeat=DEFAULT_REPEAT, work_dir=None,
+                   storage_backend=STORAGE_SQLITE, schema_version=None) -> dict:
+    """
+    Runs registered benchmarks, storage ones on temporary database files with every rows count.
+    Results of different backends have the same names, so they can be compared as baseline and current results.
+    """
+    results = {}
+    selected = {name: item for name, item in BENCHMARKS.items() if name_filter in name}
+    for name, (setup, kind, _) in selected.items():
+        if kind is None:
+            results[name] = time_function(setup(), repeat)
+    with tempfile.TemporaryDirectory(prefix=f'{helpers.APP_NAME}-benchmarks-', dir=work_dir) as temp_dir:
+        for rows in rows_list:
+            storages = {}
+            try:
+                for name, (setup, kind, max_rows) in selected.items():
+                    if kind is None or (max_rows is not None and rows > max_rows):
+                        continue
+                    if kind not in storages:
+                        storages[kind] = create_storage(kind, os.path.join(temp_dir, f'{kind}-{rows}.sqlite'), rows,
+                                                        storage_backend, schema_version)
+                    results[f'{name}[rows={rows}]'] = time_function(setup(storages[kind], rows), repeat)
+                    if isinstance(storages[kind], ServerStorage):  # background writes must not slow down the next one
+                        storages[kind].flush()
+            finally:
+                for storage in storages.values():
+                    if isinstance(storage, ServerStorage):  # background writes must end before files are removed
+                        storage.close()
+    return {'format': RESULTS_FORMAT, 'python': platform.python_version(), 'platform': platform.platform(),
+            'storage_backend': storage_backend, 'schema_version': schema_version, 'results': results}
+
+
+def create_storage(kind: str, database: str, rows: int, storage_backend=STORAGE_SQLITE, schema_version=None):
+    if kind == 'server':
+        storage = DBStorageServer(database, schema_version=schema_version)
+        populate_server_storage(storage, rows)
+        if storage_backend != STORAGE_SQLITE:
+            storage = create_server_storage(storage_backend, database)
+    elif kind == 'server_group':
+        storage = DBStorageServer(database, durability=DURABILITY_GROUP, schema_version=schema_version)
+        populate_server_storage(storage, rows)
+    elif kind == 'client':
+        storage = DBStorageClient(database, schema_version=schema_version)
+        populate_client_storage(storage, rows)
+    else:
+        raise ValueError(f'Unknown storage kind: {kind}')
+    return storage
+
+
+def compare_results(baseline: dict, current: dict, threshold=DEFAULT_THRESHOLD) -> list:
+    """
+    Compares time per call of benchmarks present in both results.
+    Slowdown by more than threshold (0.1 is 10%) is a regression, speedup by more than threshold is an improvement.
+    """
+    for results in (baseline, current):
+        if results.get('format') != RESULTS_FORMAT:
+            raise ValueError(f'Unsupported benchmark results format: {results.get("format")}')
+    comparison = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['seconds_per_op'] / baseline['results'][name]['seconds_per_op']
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        else:
+            status = 'same'
+        comparison.append({'name': name, 'baseline': baseline['results'][name]['seconds_per_op'],
+                           'current': result['seconds_per_op'], 'ratio': ratio, 'status': status})
+    return comparison
+
+
+def format_comparison(comparison: list) -> str:
+    lines = [f'{"benchmark":<64} {"baseline, us":>14} {"current, us":>14} {"ratio":>7}  status']
+    for item in comparison:
+        lines.append(f'{item["name"]:<64} {item["baseline"] * 1e6:>14.2f} {item["current"] * 1e6:>14.2f} '
+                     f'{item["ratio"]:>7.2f}  {item["status"]}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    args = parse_commandline_args(sys.argv[1:])
+    rows_list = [int(rows) for rows in args.rows.split(',') if rows]
+    results = run_benchmarks(rows_list, args.filter, args.repeat, storage_backend=args.storage_backend,
+                             schema_version=args.schema_version)
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(results_json)
+    elif not args.baseline:
+        print(results_json)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison = compare_results(json.load(baseline_file), results, args.threshold)
+        print(format_comparison(comparison))
+        if any(item['status'] == 'regression' for item in comparison):
+            sys.exit(1)
@@ -0,0 +1,212 @@
+import multiprocessing
+import os
+import struct
+import tempfile
+import socket as socket_module
+from socket import socket, AF_UNIX, SOCK_DGRAM, SOL_SOCKET, SO_SNDBUF, SO_RCVBUF
+
+import helpers
+from sessions import SessionRegistry
+from storage import DBStorageServer, DBPresenceDirectory, LockedStorage, DURABILITY_SYNC
+from storage_backends import STORAGE_SQLITE
+from server import Server
+
+# datagram between workers: login length, login of target client, then jim frame as received from sender
+ROUTED_FRAME_HEADER = struct.Struct('!H')
+ROUTED_LOGIN_LIMIT = 1024
+WORKER_START_TIMEOUT = 10
+
+
+class RemoteSession:
+    """ Session of client connected to another worker process, data sent to it is forwarded to that worker """
+    def __init__(self, router, login: str, worker_id: int):
+        self.router = router
+        self.login = login
+        self.worker_id = worker_id
+        self.close_reason = None
+
+    def send(self, data) -> bool:
+        return self.router.forward(self.worker_id, self.login, data)
+
+
+class ClusterSessionRegistry(SessionRegistry):
+    """ Session registry of one worker, which also knows about clients online on other workers """
+    def __init__(self, router, directory: DBPresenceDirectory, max_sessions_per_login=helpers.MAX_SESSIONS_PER_LOGIN):
+        super().__init__(max_sessions_per_login)
+        self._router = router
+        self._directory = directory
+
+    def remove(self, session):
+        with self._lock:  # keeps directory updates in the same order as registry ones
+            login = session.login
+            removed = super().remove(session)
+            if removed and login is not None:
+                self._directory.remove_session(login, self._router.worker_id)
+            return removed
+
+    def bind_login(self, session, login: str):
+        with self._lock:
+            previous_login = session.login
+            super().bind_login(session, login)
+            if previous_login is not None:
+                self._directory.remove_session(previous_login, self._router.worker_id)
+            self._directory.add_session(login, self._router.worker_id)
+
+    def get_local_sessions(self, login: str) -> list:
+        return super().get_sessions(login)
+
+    def get_sessions(self, login: str) -> list:
+        """ Local sessions of client and one remote session per other worker, which delivers to all its sessions """
+        sessions = super().get_sessions(login)
+        for worker_id in self._directory.get_workers(login):
+            if worker_id != self._router.worker_id:
+                sessions.append(RemoteSession(self._router, login, worker_id))
+        return sessions
+
+    def count_sessions(self, login: str) -> int:
+        return self._directory.count_sessions(login)
+
+    def is_online(self, login: str) -> bool:
+        return super().is_online(login) or bool(self._directory.get_workers(login))
+
+
+class ClusterRouter:
+    """
+    Delivers messages between worker processes over unix datagram sockets, one socket per worker in run_dir.
+    Socket is opened by Server.start(), registry with presence directory is created in server worker thread.
+    """
+    def __init__(self, worker_id: int, run_dir: str, storage_name: str,
+                 max_message_size=helpers.MAX_MESSAGE_SIZE, wal=False):
+        self.worker_id = worker_id
+        self.run_dir = run_dir
+        self.storage_name = storage_name
+        self.wal = wal
+        self.max_datagram_size = ROUTED_FRAME_HEADER.size + ROUTED_LOGIN_LIMIT + max_message_size
+        self.socket = None
+
+    def worker_path(self, worker_id: int) -> str:
+        return os.path.join(self.run_dir, f'worker-{worker_id}.sock')
+
+    def open(self):
+        path = self.worker_path(self.worker_id)
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket(AF_UNIX, SOCK_DGRAM)
+        self.socket.setsockopt(SOL_SOCKET, SO_SNDBUF, self.max_datagram_size)
+        self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, self.max_datagram_size)
+        self.socket.bind(path)
+        self.socket.setblocking(False)
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.socket.close()
+        self.socket = None
+        os.remove(self.worker_path(self.worker_id))
+
+    def create_registry(self, max_sessions_per_login=helpers.MAX_SESSIONS_PER_LOGIN) -> ClusterSessionRegistry:
+        directory = LockedStorage(DBPresenceDirectory(self.storage_name, check_same_thread=False, wal=self.wal))
+        directory.clear_worker(self.worker_id)  # left from previous run of this worker
+        return ClusterSessionRegistry(self, directory, max_sessions_per_login)
+
+    def forward(self, worker_id: int, login: str, frame) -> bool:
+        login_bytes = login.encode('utf-8')
+        if len(login_bytes) > ROUTED_LOGIN_LIMIT:
+            return False
+        try:
+            self.socket.sendmsg([ROUTED_FRAME_HEADER.pack(len(login_bytes)), login_bytes, frame], [], 0,
+                                self.worker_path(worker_id))
+        except OSError:  # worker is gone, its queue is full or message is too large for datagram
+            return False
+        return True
+
+    def receive(self, sessions: ClusterSessionRegistry):
+        """ Delivers all messages forwarded by other workers to local sessions """
+        while True:
+            try:
+                datagram = self.socket.recv(self.max_datagram_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            login_end = ROUTED_FRAME_HEADER.size + ROUTED_FRAME_HEADER.unpack_from(datagram)[0]
+            login = datagram[ROUTED_FRAME_HEADER.size:login_end].decode('utf-8')
+            frame = memoryview(datagram)[login_end:]
+            for session in sessions.get_local_sessions(login):  # client may have disconnected meanwhile
+                session.send(frame)
+
+
+def run_worker(worker_id: int, host, port, storage, run_dir: str, print_queue, ready_event, stop_event,
+               server_settings: dict):
+    max_message_size = server_settings.get('max_message_size', helpers.MAX_MESSAGE_SIZE)
+    router = ClusterRouter(worker_id, run_dir, storage, max_message_size, server_settings.get('wal', False))
+    if server_settings.get('metrics_port'):  # every worker serves its own metrics on the next port
+        server_settings = dict(server_settings, metrics_port=server_settings['metrics_port'] + worker_id)
+    # open group commit transaction would lock shared database for other workers and presence directory,
+    # and changes of workers must be seen by each other, so they are not kept in memory
+    server = Server(host, port, storage, reuse_port=True, router=router, print_queue=print_queue,
+                    cache_rooms=False, durability=DURABILITY_SYNC, storage_backend=STORAGE_SQLITE, **server_settings)
+    server.start()
+    ready_event.set()
+    stop_event.wait()
+    server.close_server()
+    print_queue.cancel_join_thread()  # nobody may read print queue anymore, do not block process exit on it
+
+
+class ClusterServer:
+    """
+    Runs several Server worker processes on the same port with SO_REUSEPORT, each owns its own connections.
+    Messages to clients of other workers are routed by ClusterRouter, presence is shared via database file.
+    With metrics_port set, worker i serves its metrics on metrics_port + i.
+    """
+    def __init__(self, host, port, storage, workers=os.cpu_count(), run_dir=None, **server_settings):
+        if storage == ':memory:':
+            raise ValueError('Cluster workers need shared database file, not :memory:')
+        if not hasattr(socket_module, 'SO_REUSEPORT'):
+            raise RuntimeError('Cluster mode requires SO_REUSEPORT support')
+        self.__host = host
+        self.__port = port
+        self.__storage_name = storage
+        self.__workers_count = workers
+        self.__run_dir = run_dir
+        self.__server_settings = server_settings
+
+        self.__processes = []
+        self.__stop_event = None
+        self.__print_queue = multiprocessing.Queue()
+
+    def start(self):
+        if self.__processes:
+            raise RuntimeError('Already started')
+        # create schema and switch journal mode before workers open database
+        DBStorageServer(self.__storage_name, wal=self.__server_settings.get('wal', False))
+        DBPresenceDirectory(self.__storage_name).clear()
+        run_dir = self.__run_dir if self.__run_dir else tempfile.mkdtemp(prefix=f'{helpers.APP_NAME}-')
+        self.__stop_event = multiprocessing.Event()
+        ready_events = []
+        for worker_id in range(self.__workers_count):
+            ready_event = multiprocessing.Event()
+            process = multiprocessing.Process(target=run_worker, daemon=True, args=(
+                worker_id, self.__host, self.__port, self.__storage_name, run_dir, self.__print_queue,
+                ready_event, self.__stop_event, self.__server_settings))
+            process.start()
+            self.__processes.append(process)
+            ready_events.append(ready_event)
+        for ready_event in ready_events:
+            if not ready_event.wait(WORKER_START_TIMEOUT):
+                self.close_server()
+                raise RuntimeError('Cluster worker failed to start')
+
+    def close_server(self):
+        if not self.__processes:
+            raise RuntimeError('Not running')
+        self.__stop_event.set()
+        for process in self.__processes:
+            process.join()
+        self.__processes = []
+
+    @property
+    def print_queue(self):
+        return self.__print_queue
+
+    @property
+    def workers(self) -> int:
+        return self.__workers_count
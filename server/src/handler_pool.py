@@ -0,0 +1,70 @@
+from collections import deque
+from queue import SimpleQueue
+from threading import Thread, Lock
+import logging
+
+import helpers
+
+log = logging.getLogger(helpers.SERVER_LOGGER_NAME)
+
+
+class OrderedThreadPool:
+    """
+    Runs tasks on worker threads. Tasks submitted with the same key run one at a time in submission order,
+    tasks with different keys run in parallel. Server uses session as key, so requests of one client
+    are handled in the order they came.
+    """
+    def __init__(self, threads: int):
+        if threads <= 0:
+            raise ValueError(f'Incorrect number of threads: {threads}')
+        self._ready = SimpleQueue()  # (key, func, args) of tasks which can run right now
+        self._lock = Lock()
+        self._waiting = {}  # key -> tasks waiting for the running task of this key, key is here while it runs
+        self._threads = [Thread(target=self._worker_thread_function, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def threads(self) -> int:
+        return len(self._threads)
+
+    @property
+    def pending_tasks(self) -> int:
+        """ Tasks submitted and not started yet """
+        with self._lock:
+            return self._ready.qsize() + sum(len(waiting) for waiting in self._waiting.values())
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting is not None:  # task of this key is running, this one starts after it
+                waiting.append((func, args))
+                return
+            self._waiting[key] = deque()
+        self._ready.put((key, func, args))
+
+    def shutdown(self):
+        """ Waits for running tasks to finish and stops threads, tasks which have not started are dropped """
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._waiting.clear()
+
+    def _worker_thread_function(self):
+        while True:
+            task = self._ready.get()
+            if task is None:
+                return
+            key, func, args = task
+            try:
+                func(*args)
+            except BaseException as e:
+                log.error(f'Task failed: {e}')
+            with self._lock:
+                waiting = self._waiting[key]
+                if not waiting:
+                    del self._waiting[key]
+                    continue
+                func, args = waiting.popleft()
+            self._ready.put((key, func, args))
@@ -0,0 +1,401 @@
+from time import perf_counter
+from threading import Lock
+
+from jim import JimRequest, JimResponse, JimRelayMessage, auth_server_message, contacts_batch_response, \
+    request_from_frame, is_room_name, FEATURE_CONTACTS_BATCH, FEATURE_REQUEST_ID
+from rooms import RoomMembersCache
+from metrics import ServerMetrics, LatencyHistogram
+import helpers
+import security
+
+# optional protocol features supported by handlers, advertised to client after successful presence
+SERVER_FEATURES = [FEATURE_CONTACTS_BATCH, FEATURE_REQUEST_ID]
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')  # admin actions are accepted only from connections of server host
+
+
+class RequestContext:
+    """
+    Everything handler may need to process one request: client session, all sessions, storage, room members
+    and server metrics
+    """
+    def __init__(self, session, sessions, storage, rooms=None, metrics=None):
+        self.session = session
+        self.sessions = sessions
+        self.storage = storage
+        self.rooms = rooms if rooms is not None else RoomMembersCache(enabled=False)
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+
+    def deliver(self, session, data) -> bool:
+        """ Sends data to session of another client, returns False if it cannot receive data """
+        return session.send(data)
+
+
+class HandlerStats:
+    """ Timing statistics of one action handler """
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = LatencyHistogram()
+
+    def add(self, duration: float):
+        self.calls += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.histogram.add(duration)
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def as_dict(self) -> dict:
+        return {'calls': self.calls, 'total_time': self.total_time,
+                'mean_time': self.mean_time, 'max_time': self.max_time, 'histogram': self.histogram.as_dict()}
+
+
+class ActionDispatcher:
+    """
+    Maps JIM action names to handlers.
+    Handler is called as handler(request, context) and returns list of responses for the client,
+    request id is copied to all of them.
+    """
+    def __init__(self, timing=True):
+        self.timing = timing
+        self._handlers = {}
+        self._stats = {}
+        self._stats_lock = Lock()  # handlers may run on several threads
+
+    def register(self, action: str, handler=None):
+        """ Registers handler for action, can be used as decorator: @dispatcher.register('action') """
+        if handler is None:
+            def register_decorator(func):
+                self.register(action, func)
+                return func
+            return register_decorator
+        self._handlers[action] = handler
+        self._stats[action] = HandlerStats()
+        return handler
+
+    def unregister(self, action: str):
+        del self._handlers[action]
+        del self._stats[action]
+
+    def actions(self) -> list:
+        return list(self._handlers)
+
+    def dispatch(self, request: JimRequest, context: RequestContext) -> list:
+        try:
+            handler = self._handlers[request.action]
+        except KeyError:
+            raise RuntimeError(f'Unknown JIM action: {request.action}')
+        if not self.timing:
+            return self.set_request_id(handler(request, context), request.request_id)
+        start_time = perf_counter()
+        try:
+            return self.set_request_id(handler(request, context), request.request_id)
+        finally:
+            duration = perf_counter() - start_time
+            with self._stats_lock:
+                self._stats[request.action].add(duration)
+
+    @staticmethod
+    def set_request_id(responses: list, request_id) -> list:
+        if request_id is not None:
+            for resp in responses:
+                if isinstance(resp, JimResponse):  # not messages from other clients sent along, e.g. offline ones
+                    resp.request_id = request_id
+        return responses
+
+    @property
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {action: stats.as_dict() for action, stats in self._stats.items() if stats.calls}
+
+
+def handle_presence(request: JimRequest, context: RequestContext) -> list:
+    client_login = request.datadict['user']['account_name']
+    session = context.session
+    resp = JimResponse()
+    if not context.storage.check_client_exists(client_login):  # unknown client - error
+        resp.response = 400
+        resp.set_field('error', f'No such client: {client_login}')
+    elif session.login == client_login:  # existing client from same connection - ok
+        context.storage.update_client(client_login, request.datadict['time'], session.ip)
+        resp.response = 200
+        resp.set_field('features', SERVER_FEATURES)
+    elif not context.sessions.can_bind_login(client_login):  # client has too many connections already
+        resp.response = 400
+        resp.set_field('error', 'Client already online, sessions limit reached')
+    else:  # known client arrived, maybe from one more device - need auth
+        session.auth_token = security.create_auth_token()
+        resp = auth_server_message(session.auth_token)
+    return [resp]
+
+
+def handle_authenticate(request: JimRequest, context: RequestContext) -> list:
+    client_login = request.datadict['user']['account_name']
+    session = context.session
+    client_hash = context.storage.get_client_hash(client_login)
+    auth_token = session.auth_token
+    session.auth_token = None
+    expected_digest = security.create_auth_digest(client_hash, auth_token)
+    client_digest = request.datadict['user']['password']
+    resp = JimResponse()
+    if not security.check_auth_digest_equal(expected_digest, client_digest):
+        context.metrics.increment('auth_failures')
+        resp.response = 402
+        resp.set_field('error', 'Access denied')
+    elif not context.sessions.can_bind_login(client_login):  # other sessions were authenticated meanwhile
+        resp.response = 400
+        resp.set_field('error', 'Client already online, sessions limit reached')
+    else:  # bind client login to session, update client in database, deliver messages queued while it was offline
+        context.sessions.bind_login(session, client_login)
+        context.metrics.increment('auth_successes')
+        context.storage.update_client(client_login, request.datadict['time'], session.ip)
+        resp.response = 200
+        resp.set_field('features', SERVER_FEATURES)
+        offline_frames = context.storage.pop_offline_messages(client_login, helpers.OFFLINE_MESSAGE_TTL)
+        return [resp] + [request_from_frame(frame) for frame in offline_frames]
+    return [resp]
+
+
+def handle_add_contact(request: JimRequest, context: RequestContext) -> list:
+    client_login = context.session.login
+    contact_login = request.datadict['user_id']
+    resp = JimResponse()
+    if not context.storage.check_client_exists(contact_login):
+        resp.response = 400
+        resp.set_field('error', f'No such client: {contact_login}')
+    elif context.storage.check_client_in_contacts(client_login, contact_login):
+        resp.response = 400
+        resp.set_field('error', f'Client already in contacts: {contact_login}')
+    else:
+        context.storage.add_client_to_contacts(client_login, contact_login)
+        resp.response = 200
+    return [resp]
+
+
+def handle_del_contact(request: JimRequest, context: RequestContext) -> list:
+    client_login = context.session.login
+    contact_login = request.datadict['user_id']
+    resp = JimResponse()
+    if not context.storage.check_client_exists(contact_login):
+        resp.response = 400
+        resp.set_field('error', f'No such client: {contact_login}')
+    elif not context.storage.check_client_in_contacts(client_login, contact_login):
+        resp.response = 400
+        resp.set_field('error', f'Client not in contacts: {contact_login}')
+    else:
+        context.storage.del_client_from_contacts(client_login, contact_login)
+        resp.response = 200
+    return [resp]
+
+
+def handle_get_contacts(request: JimRequest, context: RequestContext) -> list:
+    if request.datadict.get('batch'):
+        return handle_get_contacts_batch(request, context)
+    client_contacts = context.storage.get_client_contacts(context.session.login)
+    quantity_resp = JimResponse()
+    quantity_resp.response = 202
+    quantity_resp.set_field('quantity', len(client_contacts))
+    responses = [quantity_resp]
+    for contact in client_contacts:
+        contact_resp = JimResponse()
+        contact_resp.set_field('action', 'contact_list')
+        contact_resp.set_field('user_id', contact)
+        responses.append(contact_resp)
+    return responses
+
+
+def handle_get_contacts_batch(request: JimRequest, context: RequestContext) -> list:
+    """ All contacts in one response, or one page of them if client asked for limit """
+    limit = request.datadict.get('limit')
+    cursor = request.datadict.get('cursor')
+    if limit is None and cursor is None:
+        return [contacts_batch_response(context.storage.get_client_contacts(context.session.login))]
+    if cursor is not None and not isinstance(cursor, str):
+        resp = JimResponse(400)
+        resp.set_field('error', f'Incorrect cursor: {cursor}')
+        return [resp]
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool)):
+        resp = JimResponse(400)
+        resp.set_field('error', f'Incorrect limit: {limit}')
+        return [resp]
+    limit = min(limit, helpers.CONTACTS_PAGE_LIMIT) if limit is not None else helpers.CONTACTS_PAGE_LIMIT
+    if limit <= 0:
+        resp = JimResponse(400)
+        resp.set_field('error', f'Incorrect limit: {limit}')
+        return [resp]
+    client_contacts = context.storage.get_client_contacts(context.session.login, limit + 1, cursor)
+    if len(client_contacts) > limit:  # there are more contacts after this page
+        client_contacts = client_contacts[:limit]
+        return [contacts_batch_response(client_contacts, client_contacts[-1])]
+    return [contacts_batch_response(client_contacts)]
+
+
+def handle_msg(request: JimRequest, context: RequestContext) -> list:
+    """
+    Forwards message to all sessions of target client, relay messages are forwarded as received, without re-encoding.
+    Message to client which is not online is queued and delivered when it authenticates.
+    Only authenticated clients may send messages, and only on their own behalf.
+    """
+    if isinstance(request, JimRelayMessage):
+        target_client_login, sender_login = request.login_to, request.login_from
+    else:
+        target_client_login, sender_login = request.datadict['to'], request.datadict.get('from')
+    if context.session.login is None:
+        resp = JimResponse(401)
+        resp.set_field('error', 'Not authenticated')
+        return [resp]
+    if sender_login != context.session.login:
+        resp = JimResponse(403)
+        resp.set_field('error', f'Message sender must be {context.session.login}, not {sender_login}')
+        return [resp]
+    if is_room_name(target_client_login):
+        return [send_room_message(target_client_login, request, context)]
+    target_sessions = context.sessions.get_sessions(target_client_login)
+    if not target_sessions:
+        return [queue_offline_message(target_client_login, request, context)]
+    resp = JimResponse()
+    if not deliver_to_sessions(target_sessions, request.to_frame(), context):  # reads too slow or connection is broken
+        resp.response = 400
+        resp.set_field('error', f'Client cannot receive messages: {target_client_login}')
+    else:
+        resp.response = 200
+    return [resp]
+
+
+def deliver_to_sessions(sessions: list, frame, context: RequestContext) -> bool:
+    """ Writes the same frame to all sessions of client, returns False if none of them could take it """
+    if len(sessions) > 1:
+        frame = bytes(frame)  # one buffer for outboxes of all sessions instead of a copy per session
+    delivered = 0
+    for session in sessions:
+        if context.deliver(session, frame):
+            delivered += 1
+    context.metrics.increment('messages_delivered', delivered)
+    return delivered > 0
+
+
+def queue_offline_message(target_client_login: str, request: JimRequest, context: RequestContext) -> JimResponse:
+    resp = JimResponse()
+    if not context.storage.check_client_exists(target_client_login):
+        resp.response = 400
+        resp.set_field('error', f'No such client: {target_client_login}')
+    elif not context.storage.add_offline_message(target_client_login, request.to_frame(),
+                                                 helpers.OFFLINE_QUEUE_LIMIT, helpers.OFFLINE_MESSAGE_TTL):
+        resp.response = 400
+        resp.set_field('error', f'Client not online and its message queue is full: {target_client_login}')
+    else:
+        context.metrics.increment('messages_queued_offline')
+        resp.response = 200
+        resp.set_field('queued', True)
+    return resp
+
+
+def send_room_message(room: str, request: JimRequest, context: RequestContext) -> JimResponse:
+    """
+    Writes the same frame to all sessions of online room members except sending one,
+    offline members get it queued
+    """
+    resp = JimResponse()
+    members = context.rooms.get_members(context.storage, room)
+    if context.session.login not in members:
+        resp.response = 400
+        if context.storage.check_room_exists(room):
+            resp.set_field('error', f'Not a member of room: {room}')
+        else:
+            resp.set_field('error', f'No such room: {room}')
+        return resp
+    frame = bytes(request.to_frame())  # one buffer shared by all members
+    offline_members = []
+    for member in members:
+        member_sessions = [member_session for member_session in context.sessions.get_sessions(member)
+                           if member_session is not context.session]
+        if member == context.session.login:  # other devices of sender just get a copy
+            deliver_to_sessions(member_sessions, frame, context)
+        elif not member_sessions or not deliver_to_sessions(member_sessions, frame, context):
+            offline_members.append(member)
+    if offline_members:
+        rejected = context.storage.add_offline_messages(offline_members, frame, helpers.OFFLINE_QUEUE_LIMIT,
+                                                        helpers.OFFLINE_MESSAGE_TTL)
+        context.metrics.increment('messages_queued_offline', len(offline_members) - len(rejected))
+    resp.response = 200
+    return resp
+
+
+def handle_create_room(request: JimRequest, context: RequestContext) -> list:
+    room = request.datadict['room']
+    resp = JimResponse()
+    if not is_room_name(room):
+        resp.response = 400
+        resp.set_field('error', f'Incorrect room name: {room}')
+    elif context.storage.check_room_exists(room):
+        resp.response = 400
+        resp.set_field('error', f'Room already exists: {room}')
+    else:
+        context.storage.add_room(room, context.session.login)
+        resp.response = 200
+    return [resp]
+
+
+def handle_join_room(request: JimRequest, context: RequestContext) -> list:
+    room = request.datadict['room']
+    client_login = context.session.login
+    resp = JimResponse()
+    if not context.storage.check_room_exists(room):
+        resp.response = 400
+        resp.set_field('error', f'No such room: {room}')
+    elif context.storage.check_client_in_room(room, client_login):
+        resp.response = 400
+        resp.set_field('error', f'Already a member of room: {room}')
+    else:
+        context.storage.add_room_member(room, client_login)
+        context.rooms.add_member(room, client_login)
+        resp.response = 200
+    return [resp]
+
+
+def handle_leave_room(request: JimRequest, context: RequestContext) -> list:
+    room = request.datadict['room']
+    client_login = context.session.login
+    resp = JimResponse()
+    if not context.storage.check_room_exists(room):
+        resp.response = 400
+        resp.set_field('error', f'No such room: {room}')
+    elif not context.storage.check_client_in_room(room, client_login):
+        resp.response = 400
+        resp.set_field('error', f'Not a member of room: {room}')
+    else:
+        context.storage.del_room_member(room, client_login)
+        context.rooms.remove_member(room, client_login)
+        resp.response = 200
+    return [resp]
+
+
+def handle_get_stats(request: JimRequest, context: RequestContext) -> list:
+    """ Admin action: server metrics snapshot, only for connections from server host """
+    if context.session.ip not in LOCAL_ADDRESSES:
+        resp = JimResponse(403)
+        resp.set_field('error', 'Stats are available only from server host')
+        return [resp]
+    resp = JimResponse(200)
+    resp.set_field('stats', context.metrics.snapshot(context.sessions))
+    return [resp]
+
+
+def default_dispatcher(timing=True) -> ActionDispatcher:
+    """ Dispatcher with handlers for all JIM actions supported by server """
+    dispatcher = ActionDispatcher(timing)
+    dispatcher.register('presence', handle_presence)
+    dispatcher.register('authenticate', handle_authenticate)
+    dispatcher.register('add_contact', handle_add_contact)
+    dispatcher.register('del_contact', handle_del_contact)
+    dispatcher.register('get_contacts', handle_get_contacts)
+    dispatcher.register('msg', handle_msg)
+    dispatcher.register('create_room', handle_create_room)
+    dispatcher.register('join_room', handle_join_room)
+    dispatcher.register('leave_room', handle_leave_room)
+    dispatcher.register('get_stats', handle_get_stats)
+    return dispatcher
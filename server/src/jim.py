@@ -1,6 +1,20 @@
 import json
+import re
+import struct
 import time
 
+import helpers
+
+# framed wire format: 4-byte big-endian payload length, then json payload
+FRAME_HEADER = struct.Struct('!I')
+
+# optional protocol features, server lists supported ones in "features" field of successful presence response
+FEATURE_CONTACTS_BATCH = 'contacts_batch'  # whole (or paginated) contact list in one get_contacts response
+FEATURE_REQUEST_ID = 'request_id'  # "id" of request is echoed in its responses, so requests can be pipelined
+
+# msg with "to" starting with this prefix is sent to all members of the room
+ROOM_PREFIX = '#'
+
 
 class JimMessage:
     def __init__(self):
@@ -16,14 +30,26 @@ class JimMessage:
     def datadict(self):
         return self._datadict
 
+    @property
+    def request_id(self):
+        """ Optional id of request, server copies it to all responses to this request """
+        return self._datadict.get('id')
+
+    @request_id.setter
+    def request_id(self, value: int):
+        self.set_field('id', value)
+
     def to_bytes(self):
         self_json = json.dumps(self._datadict)
         return self_json.encode('utf-8')
 
     def from_bytes(self, bytedata):
-        json_data = bytedata.decode('utf-8')
+        json_data = str(bytedata, 'utf-8')  # works for bytes and memoryview without copying
         self._datadict = json.loads(json_data)
 
+    def to_frame(self):
+        return frame_bytes(self.to_bytes())
+
     def __str__(self):
         return json.dumps(self._datadict, indent=1)
 
@@ -47,6 +73,14 @@ class JimRequest(JimMessage):
         self._action = value
         self.set_field('action', self._action)
 
+    @JimMessage.request_id.setter
+    def request_id(self, value: int):
+        # id goes right after action, so that msg routing header is still matched without json parsing
+        action = self._datadict.pop('action', None)
+        self._datadict.pop('id', None)
+        head = {'action': action, 'id': value} if action is not None else {'id': value}
+        self._datadict = {**head, **self._datadict}
+
     def from_bytes(self, bytedata):
         super().from_bytes(bytedata)
         if 'action' in self._datadict:
@@ -87,6 +121,153 @@ def response_from_bytes(bytedata: bytes) -> JimResponse:
     return ret
 
 
+def frame_bytes(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+# routing header of msg as serialized by message_request(), logins with escaped chars fall back to full parsing
+MSG_ROUTING_PATTERN = re.compile(
+    rb'\{"action": "msg", (?:"id": (-?\d+), )?(?:"time": "\d*", )?"to": "([^"\\]*)", "from": "([^"\\]*)"')
+# json string, with "key" group set when it is followed by colon
+JSON_STRING_PATTERN = re.compile(rb'"((?:[^"\\]|\\.)*)"(?P<key>\s*:)?')
+ROUTING_KEYS = {'action', 'to', 'from'}
+
+
+class JimRelayMessage:
+    """
+    Message to another client with only routing header parsed.
+    Keeps the frame exactly as it was received, so it can be forwarded without json decode and encode.
+    """
+    action = 'msg'
+
+    def __init__(self, frame, login_to: str, login_from: str, request_id: int=None):
+        self._frame = frame
+        self.login_to = login_to
+        self.login_from = login_from
+        self.request_id = request_id
+
+    def to_frame(self):
+        return self._frame
+
+    @property
+    def datadict(self):
+        return request_from_bytes(self._frame[FRAME_HEADER.size:]).datadict
+
+    def __str__(self):
+        return str(self._frame[FRAME_HEADER.size:], 'utf-8')
+
+
+def has_routing_key(payload, start: int) -> bool:
+    """
+    Checks whether payload repeats routing key after start: json parser keeps the last value of duplicate key,
+    so recipients would see other sender or target than the one message is routed by
+    """
+    for string in JSON_STRING_PATTERN.finditer(payload, start):
+        if string.group('key') is None:
+            continue
+        key = string.group(1)
+        if b'\\' in key:  # escaped key, e.g. "\u0066rom"
+            key = json.loads(b'"' + key + b'"')
+        else:
+            key = key.decode('utf-8')
+        if key in ROUTING_KEYS:
+            return True
+    return False
+
+
+def request_from_frame(frame):
+    """ Returns JimRelayMessage for msg with recognized routing header, otherwise fully parsed JimRequest """
+    payload = frame[FRAME_HEADER.size:]
+    routing = MSG_ROUTING_PATTERN.match(payload)
+    if routing is None or has_routing_key(payload, routing.end()):
+        return request_from_bytes(payload)
+    request_id = int(routing.group(1)) if routing.group(1) is not None else None
+    return JimRelayMessage(frame, routing.group(2).decode('utf-8'), routing.group(3).decode('utf-8'), request_id)
+
+
+class JimStreamDecoder:
+    """
+    Incremental decoder for framed JIM stream.
+    Takes byte chunks of any size and returns whole messages, so several messages can come in one chunk
+    and one message can be split between several chunks.
+    Data is kept in one reusable buffer: it is compacted in place and grows only up to max_message_size.
+    Message factory gets memoryview of message payload, or of the whole frame if pass_frames is set.
+    These views are valid only until the next feed() or recv_into() call.
+    """
+    def __init__(self, message_factory=request_from_bytes, max_message_size=helpers.MAX_MESSAGE_SIZE,
+                 buffer_size=helpers.TCP_MSG_BUFFER_SIZE, pass_frames=False):
+        self._message_factory = message_factory
+        self._pass_frames = pass_frames
+        self._max_message_size = max_message_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte not decoded yet
+        self._end = 0  # first free byte
+        self._wanted = FRAME_HEADER.size  # bytes needed to complete next frame or its header
+        self.received_bytes = 0
+
+    def feed(self, data: bytes) -> list:
+        data_len = len(data)
+        self._reserve(data_len)
+        self._view[self._end:self._end + data_len] = data
+        self._end += data_len
+        self.received_bytes += data_len
+        return self._decode()
+
+    def recv_into(self, sock) -> list:
+        """ Receives data from socket directly into decoder buffer, returns decoded messages """
+        self._reserve(self._wanted)
+        received = sock.recv_into(self._view[self._end:])
+        if not received:
+            raise EOFError('connection closed by peer')
+        self._end += received
+        self.received_bytes += received
+        return self._decode()
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._end - self._start
+
+    @property
+    def buffer_size(self) -> int:
+        return len(self._buffer)
+
+    def _reserve(self, size: int):
+        if self._end + size <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):  # compacting is not enough, need bigger buffer
+            new_size = max(len(self._buffer) * 2, pending + size)
+            new_buffer = bytearray(new_size)
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = new_buffer
+            self._view = memoryview(self._buffer)
+        elif pending:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def _decode(self) -> list:
+        messages = []
+        while True:
+            pending = self._end - self._start
+            if pending < FRAME_HEADER.size:
+                self._wanted = FRAME_HEADER.size - pending
+                break
+            payload_len = FRAME_HEADER.unpack_from(self._buffer, self._start)[0]
+            if payload_len > self._max_message_size:
+                raise ValueError(f'JIM message too large: {payload_len} bytes, limit {self._max_message_size}')
+            frame_end = self._start + FRAME_HEADER.size + payload_len
+            if self._end < frame_end:  # rest of the message has not arrived yet
+                self._wanted = frame_end - self._end
+                break
+            data_start = self._start if self._pass_frames else self._start + FRAME_HEADER.size
+            messages.append(self._message_factory(self._view[data_start:frame_end]))
+            self._start = frame_end
+        if self._start == self._end:  # everything decoded, start filling buffer from the beginning
+            self._start = self._end = 0
+        return messages
+
+
 def presence_request(username: str) -> JimRequest:
     message = JimRequest()
     message.set_field('action', 'presence')
@@ -95,10 +276,24 @@ def presence_request(username: str) -> JimRequest:
     return message
 
 
-def get_contacts_request() -> JimRequest:
+def get_contacts_request(batch: bool=False, limit: int=None, cursor: str=None) -> JimRequest:
     message = JimRequest()
     message.set_field('action', 'get_contacts')
     message.set_time()
+    if batch:  # server must support FEATURE_CONTACTS_BATCH
+        message.set_field('batch', True)
+        if limit is not None:
+            message.set_field('limit', limit)
+        if cursor is not None:
+            message.set_field('cursor', cursor)
+    return message
+
+
+def contacts_batch_response(contacts: list, next_cursor: str=None) -> JimResponse:
+    message = JimResponse(202)
+    message.set_field('quantity', len(contacts))
+    message.set_field('contacts', contacts)
+    message.set_field('cursor', next_cursor)
     return message
 
 
@@ -118,6 +313,34 @@ def delete_contact_request(login: str) -> JimRequest:
     return message
 
 
+def is_room_name(name: str) -> bool:
+    return isinstance(name, str) and len(name) > len(ROOM_PREFIX) and name.startswith(ROOM_PREFIX)
+
+
+def create_room_request(room: str) -> JimRequest:
+    message = JimRequest()
+    message.set_field('action', 'create_room')
+    message.set_field('room', room)
+    message.set_time()
+    return message
+
+
+def join_room_request(room: str) -> JimRequest:
+    message = JimRequest()
+    message.set_field('action', 'join_room')
+    message.set_field('room', room)
+    message.set_time()
+    return message
+
+
+def leave_room_request(room: str) -> JimRequest:
+    message = JimRequest()
+    message.set_field('action', 'leave_room')
+    message.set_field('room', room)
+    message.set_time()
+    return message
+
+
 def message_request(login_from: str, login_to: str, text: str) -> JimRequest:
     message = JimRequest()
     message.set_field('action', 'msg')
@@ -129,6 +352,13 @@ def message_request(login_from: str, login_to: str, text: str) -> JimRequest:
     return message
 
 
+def stats_request() -> JimRequest:
+    message = JimRequest()
+    message.set_field('action', 'get_stats')
+    message.set_time()
+    return message
+
+
 def auth_server_message(auth_token: str) -> JimResponse:
     message = JimResponse(401)
     message.set_field('error', 'Authentication required')
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+from time import perf_counter
+
+import helpers
+import jim
+import security
+from storage import DBStorageServer, DURABILITY_SYNC, DURABILITY_POLICIES
+from storage_backends import STORAGE_SQLITE, STORAGE_BACKENDS
+from server import Server
+from async_server import AsyncServer
+from cluster import ClusterServer
+
+SERVER_ENGINES = ['selectors', 'async', 'cluster']
+DEFAULT_MIX = 'msg=70,get_contacts=20,add_contact=10'
+PERCENTILES = {'p50': 50, 'p95': 95, 'p99': 99, 'p999': 99.9}
+LOGIN_PREFIX = 'LoadTestUser'
+PASSWORD = 'LoadTestPassword'
+READ_SIZE = 64 * 1024
+
+# expected response code of every action, other codes are counted as errors
+EXPECTED_RESPONSES = {'presence': 401, 'authenticate': 200, 'msg': 200, 'get_contacts': 202, 'add_contact': 200}
+
+
+def parse_commandline_args(cmd_args):
+    parser = argparse.ArgumentParser(description='Runs simulated JIM clients against local server, '
+                                                 'prints throughput and latency percentiles per action as JSON')
+    parser.add_argument('-c', dest='clients', type=int, default=100, help='number of simulated clients, default 100')
+    parser.add_argument('-r', dest='requests', type=int, default=100,
+                        help='requests sent by every client after login, default 100')
+    parser.add_argument('-m', dest='mix', type=str, default=DEFAULT_MIX,
+                        help=f'relative weights of actions, default {DEFAULT_MIX}')
+    parser.add_argument('-e', dest='engine', choices=SERVER_ENGINES, default='selectors',
+                        help='server engine, default selectors')
+    parser.add_argument('-t', dest='handler_threads', type=int, default=0,
+                        help='number of threads handling requests in selectors and cluster engines, default 0')
+    parser.add_argument('-w', dest='workers', type=int, default=2, help='cluster worker processes, default 2')
+    parser.add_argument('-d', dest='durability', choices=DURABILITY_POLICIES, default=DURABILITY_SYNC,
+                        help='storage durability of selectors and async engines, default sync')
+    parser.add_argument('-b', dest='storage_backend', choices=STORAGE_BACKENDS, default=STORAGE_SQLITE,
+                        help='storage backend of selectors and async engines, default sqlite')
+    parser.add_argument('-s', dest='seed', type=int, default=None, help='random seed of traffic, default random')
+    parser.add_argument('-o', dest='output', type=str, default=None, help='file to write report to, default stdout')
+    return parser.parse_args(cmd_args)
+
+
+def parse_mix(mix: str) -> dict:
+    """ Parses "action=weight,..." into {action: weight} """
+    weights = {}
+    for item in mix.split(','):
+        action, _, weight = item.strip().partition('=')
+        if action not in TRAFFIC_REQUESTS:
+            raise ValueError(f'Unknown action in mix: {action}, supported: {", ".join(TRAFFIC_REQUESTS)}')
+        weights[action] = float(weight)
+    if sum(weights.values()) <= 0 or min(weights.values()) < 0:
+        raise ValueError(f'Action weights must not be negative and must not all be zero: {mix}')
+    return weights
+
+
+def percentile(sorted_values: list, percent: float):
+    """ Nearest-rank percentile of sorted values, None for empty list """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LatencyStats:
+    """ Latencies of one action in seconds and count of unexpected responses """
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    def add(self, latency: float, ok: bool):
+        self.latencies.append(latency)
+        if not ok:
+            self.errors += 1
+
+    def as_dict(self, duration: float) -> dict:
+        latencies = sorted(self.latencies)
+        result = {'requests': len(latencies), 'errors': self.errors,
+                  'throughput': len(latencies) / duration if duration else 0.0}
+        for name, percent in PERCENTILES.items():
+            value = percentile(latencies, percent)
+            result[f'{name}_ms'] = value * 1000 if value is not None else None
+        result['max_ms'] = latencies[-1] * 1000 if latencies else None
+        return result
+
+
+class SimulatedClient:
+    """ One client connection sending one request at a time, messages from other clients are skipped """
+    def __init__(self, login: str, password_hash: str, stats: dict):
+        self.login = login
+        self.password_hash = password_hash
+        self.stats = stats  # action -> LatencyStats, shared by all clients
+        self.decoder = jim.JimStreamDecoder(jim.response_from_bytes)
+        self.received = []
+        self.received_messages = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, address):
+        self.reader, self.writer = await asyncio.open_connection(*address)
+        response = await self.request('presence', jim.presence_request(self.login))
+        digest = security.create_auth_digest(self.password_hash, response.datadict['token'])
+        await self.request('authenticate', jim.auth_client_message(self.login, digest))
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def request(self, action: str, request: jim.JimRequest) -> jim.JimResponse:
+        start_time = perf_counter()
+        self.writer.write(request.to_frame())
+        response = await self.receive_response()
+        latency = perf_counter() - start_time
+        ok = response.response == EXPECTED_RESPONSES[action]
+        self.stats.setdefault(action, LatencyStats()).add(latency, ok)
+        if not ok and action in ('presence', 'authenticate'):
+            raise RuntimeError(f'{self.login} failed to log in: {response}')
+        return response
+
+    async def receive_response(self) -> jim.JimResponse:
+        while True:
+            while self.received:
+                msg = self.received.pop(0)
+                if msg.datadict.get('action') == 'msg':
+                    self.received_messages += 1
+                else:
+                    return msg
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError(f'{self.login}: connection closed by server')
+            self.received += self.decoder.feed(data)
+
+
+TRAFFIC_REQUESTS = {
+    'msg': lambda login, target: jim.message_request(login, target, 'load test message'),
+    'get_contacts': lambda login, target: jim.get_contacts_request(batch=True),
+    'add_contact': lambda login, target: jim.add_contact_request(target),
+}
+
+
+def plan_traffic(index: int, logins: list, requests: int, weights: dict, rnd: random.Random) -> list:
+    """
+    Returns [(action, target login)] of client logins[index], targets are other clients.
+    add_contact picks clients not in contacts yet, get_contacts is sent instead when there are none left.
+    """
+    others = logins[:index] + logins[index + 1:]
+    new_contacts = rnd.sample(others, len(others))
+    plan = []
+    for action in rnd.choices(list(weights), list(weights.values()), k=requests):
+        if action == 'add_contact':
+            if new_contacts:
+                plan.append((action, new_contacts.pop()))
+                continue
+            action = 'get_contacts'
+        plan.append((action, rnd.choice(others)))
+    return plan
+
+
+async def run_clients(address, logins: list, password_hash: str, requests: int, weights: dict,
+                      rnd: random.Random) -> dict:
+    login_stats, traffic_stats = {}, {}
+    clients = [SimulatedClient(login, password_hash, login_stats) for login in logins]
+    login_start = perf_counter()
+    await asyncio.gather(*(client.connect(address) for client in clients))
+    login_duration = perf_counter() - login_start
+
+    plans = [plan_traffic(index, logins, requests, weights, rnd) for index in range(len(clients))]
+
+    async def run_plan(client: SimulatedClient, plan: list):
+        client.stats = traffic_stats
+        for action, target in plan:
+            await client.request(action, TRAFFIC_REQUESTS[action](client.login, target))
+
+    traffic_start = perf_counter()
+    await asyncio.gather(*(run_plan(client, plan) for client, plan in zip(clients, plans)))
+    traffic_duration = perf_counter() - traffic_start
+    await asyncio.gather(*(client.close() for client in clients))
+
+    total_requests = sum(len(stats.latencies) for stats in traffic_stats.values())
+    return {
+        'login': {'duration': login_duration,
+                  'actions': {action: stats.as_dict(login_duration) for action, stats in login_stats.items()}},
+        'traffic': {'duration': traffic_duration, 'requests': total_requests,
+                    'throughput': total_requests / traffic_duration if traffic_duration else 0.0,
+                    'received_messages': sum(client.received_messages for client in clients),
+                    'actions': {action: stats.as_dict(traffic_duration) for action, stats in traffic_stats.items()}},
+    }
+
+
+def get_free_port() -> int:
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def create_server(engine: str, storage_file: str, clients: int, handler_threads: int, workers: int,
+                  durability=DURABILITY_SYNC, storage_backend=STORAGE_SQLITE):
+    """
+    Returns started server and its address,
+    cluster workers always commit storage changes of sqlite backend one by one
+    """
+    if engine == 'selectors':
+        server = Server('127.0.0.1', 0, storage_file, clients_limit=clients, handler_threads=handler_threads,
+                        durability=durability, storage_backend=storage_backend)
+    elif engine == 'async':
+        server = AsyncServer('127.0.0.1', 0, storage_file, clients_limit=clients, durability=durability,
+                             storage_backend=storage_backend)
+    elif engine == 'cluster':
+        port = get_free_port()
+        server = ClusterServer('127.0.0.1', port, storage_file, workers=workers, clients_limit=clients,
+                               handler_threads=handler_threads)
+        server.start()
+        return server, ('127.0.0.1', port)
+    else:
+        raise ValueError(f'Unknown server engine: {engine}')
+    server.start()
+    return server, server.address
+
+
+def drain_queue(queue):
+    """ Server logs every request to print queue, it must be read so that it does not grow """
+    while queue.get() is not helpers.QUEUE_STOP:
+        pass
+
+
+def run_load_test(clients=100, requests=100, mix=DEFAULT_MIX, engine='selectors', handler_threads=0, workers=2,
+                  seed=None, durability=DURABILITY_SYNC, storage_backend=STORAGE_SQLITE) -> dict:
+    """
+    Starts server on temporary database with provisioned users, runs simulated clients against it
+    and returns report. Simulated clients share one process with selectors and async servers.
+    """
+    weights = parse_mix(mix)
+    if clients < 2:
+        raise ValueError('At least 2 clients are needed to send messages')
+    rnd = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix=f'{helpers.APP_NAME}-loadtest-') as temp_dir:
+        storage_file = os.path.join(temp_dir, 'server.sqlite')
+        password_hash = security.create_password_hash(PASSWORD)
+        logins = [f'{LOGIN_PREFIX}{i}' for i in range(clients)]
+        storage = DBStorageServer(storage_file)
+        for login in logins:
+            storage.add_client(login, password_hash)
+        storage.close()
+        server, address = create_server(engine, storage_file, clients, handler_threads, workers, durability,
+                                        storage_backend)
+        print_drainer = Thread(target=drain_queue, args=(server.print_queue,))
+        print_drainer.daemon = True
+        print_drainer.start()
+        try:
+            results = asyncio.run(run_clients(address, logins, password_hash, requests, weights, rnd))
+        finally:
+            server.close_server()
+            server.print_queue.put(helpers.QUEUE_STOP)
+    settings = {'clients': clients, 'requests': requests, 'mix': weights, 'engine': engine,
+                'handler_threads': handler_threads, 'workers': workers if engine == 'cluster' else None,
+                'durability': durability if engine != 'cluster' else DURABILITY_SYNC,
+                'storage_backend': storage_backend if engine != 'cluster' else STORAGE_SQLITE, 'seed': seed}
+    return {'settings': settings, **results}
+
+
+if __name__ == '__main__':
+    args = parse_commandline_args(sys.argv[1:])
+    report = run_load_test(args.clients, args.requests, args.mix, args.engine, args.handler_threads, args.workers,
+                           args.seed, args.durability, args.storage_backend)
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report_json)
+    else:
+        print(report_json)
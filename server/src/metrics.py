@@ -0,0 +1,110 @@
+from bisect import bisect_left
+from threading import Lock
+
+import helpers
+
+# upper bounds of handler latency histogram buckets in seconds, the last bucket counts longer calls
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+METRICS_PREFIX = helpers.APP_NAME
+
+COUNTERS = (
+    'connections_opened',
+    'connections_closed',
+    'auth_successes',
+    'auth_failures',
+    'messages_delivered',  # message frames written to sessions of online clients
+    'messages_queued_offline',
+    'bytes_in',  # of closed connections, open ones are added when snapshot is taken
+    'bytes_out',
+)
+
+
+class LatencyHistogram:
+    """ Counts of durations by buckets, bucket i counts durations up to bounds[i] """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, duration: float):
+        self.counts[bisect_left(self.bounds, duration)] += 1
+
+    def as_dict(self) -> dict:
+        return {'bounds': list(self.bounds), 'counts': list(self.counts)}
+
+
+class ServerMetrics:
+    """
+    Counters of server events, gauges of server queues and handler stats of dispatcher.
+    Counters may be incremented by handler threads, so they are changed under a lock.
+    Per-connection traffic is counted by sessions themselves and added here when they close.
+    """
+    def __init__(self, dispatcher=None):
+        self.dispatcher = dispatcher
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._gauges = {}  # name -> function returning current value
+        self._gauge_groups = {}  # name prefix -> function returning dict of current values
+        self._lock = Lock()
+
+    def increment(self, name: str, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def add_gauge(self, name: str, func):
+        self._gauges[name] = func
+
+    def add_gauge_group(self, prefix: str, func):
+        """ func returns {name: value}, every item becomes gauge prefix_name """
+        self._gauge_groups[prefix] = func
+
+    def session_closed(self, session):
+        with self._lock:
+            self._counters['connections_closed'] += 1
+            self._counters['bytes_in'] += session.bytes_received
+            self._counters['bytes_out'] += session.bytes_sent
+
+    @property
+    def counters(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    def snapshot(self, sessions) -> dict:
+        """ Current values of all metrics, sessions are all open connections """
+        counters = self.counters
+        open_sessions = list(sessions)
+        counters['bytes_in'] += sum(session.bytes_received for session in open_sessions)
+        counters['bytes_out'] += sum(session.bytes_sent for session in open_sessions)
+        gauges = {
+            'connections': len(open_sessions),
+            'authenticated_clients': len(sessions.logins()),
+            'outbox_bytes': sum(session.outbox_size for session in open_sessions),
+            'queued_requests': sum(session.queued_requests for session in open_sessions),
+        }
+        for name, func in self._gauges.items():
+            gauges[name] = func()
+        for prefix, func in self._gauge_groups.items():
+            for name, value in func().items():
+                gauges[f'{prefix}_{name}'] = value
+        actions = self.dispatcher.stats if self.dispatcher is not None else {}
+        return {'counters': counters, 'gauges': gauges, 'actions': actions}
+
+
+def format_metrics_text(snapshot: dict, prefix=METRICS_PREFIX) -> str:
+    """ Renders metrics snapshot in Prometheus text exposition format """
+    lines = []
+    for name, value in snapshot['counters'].items():
+        lines.append(f'# TYPE {prefix}_{name}_total counter')
+        lines.append(f'{prefix}_{name}_total {value}')
+    for name, value in snapshot['gauges'].items():
+        lines.append(f'# TYPE {prefix}_{name} gauge')
+        lines.append(f'{prefix}_{name} {value}')
+    if snapshot['actions']:
+        lines.append(f'# TYPE {prefix}_action_latency_seconds histogram')
+    for action, stats in snapshot['actions'].items():
+        histogram = stats['histogram']
+        cumulative = 0
+        for bound, bucket_count in zip(histogram['bounds'] + ['+Inf'], histogram['counts']):
+            cumulative += bucket_count
+            lines.append(f'{prefix}_action_latency_seconds_bucket{{action="{action}",le="{bound}"}} {cumulative}')
+        lines.append(f'{prefix}_action_latency_seconds_sum{{action="{action}"}} {stats["total_time"]}')
+        lines.append(f'{prefix}_action_latency_seconds_count{{action="{action}"}} {stats["calls"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,39 @@
+from threading import Lock
+
+
+class RoomMembersCache:
+    """
+    Logins of room members by room name. Room is loaded from storage on first message to it
+    and then kept in sync by join and leave handlers, so fan-out does not query database.
+    Disabled cache always reads storage, e.g. in cluster where other workers change membership.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._members = {}  # room name -> frozenset of logins
+        self._lock = Lock()  # handlers may run on several threads
+
+    def get_members(self, storage, room: str) -> frozenset:
+        members = self._members.get(room)
+        if members is not None:
+            return members
+        if not self.enabled:
+            return frozenset(storage.get_room_members(room))
+        with self._lock:  # join or leave handled meanwhile updates cache only after room is loaded
+            members = self._members.get(room)
+            if members is None:
+                members = frozenset(storage.get_room_members(room))
+                if members:  # room may not be created yet
+                    self._members[room] = members
+            return members
+
+    def add_member(self, room: str, login: str):
+        with self._lock:
+            members = self._members.get(room)
+            if members is not None:  # not loaded rooms are read from storage later
+                self._members[room] = members | {login}
+
+    def remove_member(self, room: str, login: str):
+        with self._lock:
+            members = self._members.get(room)
+            if members is not None:
+                self._members[room] = members - {login}
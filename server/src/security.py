@@ -5,6 +5,7 @@ import hmac
 from helpers import bytes_to_hexstring, hexstring_to_bytes
 
 HASH_ALGORITHM = 'sha256'
+AUTH_DIGEST_ALGORITHM = 'md5'  # hmac default before python 3.8, keeps digests compatible
 HASH_SALT = b'\xca\xfe\xbe\xef\xca\xfe\xbe\xef\xca\xfe\xbe\xef\xca\xfe\xbe\xef\xca\xfe\xbe\xef\xca\xfe\xbe\xef'
 HASH_ITERATIONS = 100000
 AUTH_TOKEN_LEN = 16
@@ -24,7 +25,7 @@ def create_auth_token() -> str:
 def create_auth_digest(secret: str, token: str) -> str:
     if not secret or not token:
         raise RuntimeError('secret or token value empty or incorrect')
-    digest = hmac.new(hexstring_to_bytes(secret), hexstring_to_bytes(token)).digest()
+    digest = hmac.new(hexstring_to_bytes(secret), hexstring_to_bytes(token), AUTH_DIGEST_ALGORITHM).digest()
     return bytes_to_hexstring(digest)
 
 
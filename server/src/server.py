@@ -1,18 +1,23 @@
 import argparse
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET
 import sys
-import select
+import selectors
+from socket import socketpair
 import logging
 import inspect
 import os
-from time import sleep
 from threading import Thread
-from queue import Queue
+from queue import Queue, SimpleQueue, Empty
 
 import helpers
-from jim import request_from_bytes, JimResponse, auth_server_message
-from storage import DBStorageServer
-import security
+from jim import JimStreamDecoder, request_from_frame
+from storage import LockedStorage, DURABILITY_SYNC, DURABILITY_POLICIES
+from storage_backends import create_server_storage, STORAGE_SQLITE, STORAGE_BACKENDS
+from sessions import Session, SessionRegistry
+from handlers import RequestContext, default_dispatcher
+from handler_pool import OrderedThreadPool
+from rooms import RoomMembersCache
+from metrics import ServerMetrics, format_metrics_text
 import log_confing
 
 log = logging.getLogger(helpers.SERVER_LOGGER_NAME)
@@ -24,7 +29,26 @@ def parse_commandline_args(cmd_args):
                         help='ip-address to listen on, default empty')
     parser.add_argument('-p', dest='listen_port', type=int, default=helpers.DEFAULT_SERVER_PORT,
                         help=f'tcp port to listen on, default {str(helpers.DEFAULT_SERVER_PORT)}')
-    return parser.parse_args(cmd_args)
+    parser.add_argument('-t', dest='handler_threads', type=int, default=0,
+                        help='number of threads handling requests, default 0 - handle in network thread')
+    parser.add_argument('-m', dest='metrics_port', type=int, default=None,
+                        help='local tcp port serving metrics as text, default none')
+    parser.add_argument('-d', dest='durability', choices=DURABILITY_POLICIES, default=DURABILITY_SYNC,
+                        help='sync - commit every storage change, group - commit changes together '
+                             'every few hundred milliseconds, default sync')
+    parser.add_argument('-w', dest='wal', action='store_true',
+                        help='open database in WAL mode with read connection per thread')
+    parser.add_argument('-s', dest='storage_backend', choices=STORAGE_BACKENDS, default=STORAGE_SQLITE,
+                        help='sqlite - read and write database file, memory - keep data in memory only, '
+                             'hybrid - keep data in memory and write changes to database file in background, '
+                             'default sqlite')
+    parser.add_argument('-c', dest='workers', type=int, default=0,
+                        help='number of worker processes sharing the port, default 0 - single process; '
+                             'workers always use sqlite storage with sync durability')
+    args = parser.parse_args(cmd_args)
+    if args.workers and (args.storage_backend != STORAGE_SQLITE or args.durability != DURABILITY_SYNC):
+        parser.error('worker processes (-c) support only sqlite storage (-s) with sync durability (-d)')
+    return args
 
 
 class ServerVerifierMeta(type):
@@ -48,28 +72,93 @@ class ServerVerifierMeta(type):
         type.__init__(cls, clsname, bases, clsdict)
 
 
+class ThreadedRequestContext(RequestContext):
+    """ Context of request handled on pool thread: data for other clients is passed to network thread to send """
+    def __init__(self, session, sessions, storage, rooms, metrics, post):
+        super().__init__(session, sessions, storage, rooms, metrics)
+        self._post = post
+
+    def deliver(self, session, data) -> bool:
+        if session.close_reason is not None:
+            return False
+        self._post(session, data)
+        return True
+
+
 class Server(metaclass=ServerVerifierMeta):
+    """
+    Serves all connections from one network thread driven by selector.
+    Requests are handled on the same thread, or by handler_threads pool threads if it is set:
+    then network thread only reads and writes sockets, requests of one client are still handled in order.
+    """
     def __init__(self, host, port, storage,
-                 clients_limit=helpers.CLIENTS_COUNT_LIMIT, timeout=helpers.SERVER_SOCKET_TIMEOUT):
+                 clients_limit=helpers.CLIENTS_COUNT_LIMIT, timeout=helpers.SERVER_SOCKET_TIMEOUT,
+                 max_message_size=helpers.MAX_MESSAGE_SIZE, dispatcher=None,
+                 outbox_high_watermark=helpers.OUTBOX_HIGH_WATERMARK, outbox_low_watermark=helpers.OUTBOX_LOW_WATERMARK,
+                 outbox_limit=helpers.OUTBOX_LIMIT, selector_class=selectors.DefaultSelector,
+                 reuse_port=False, router=None, print_queue=None, handler_threads=0, cache_rooms=True,
+                 max_sessions_per_login=helpers.MAX_SESSIONS_PER_LOGIN, metrics_port=None,
+                 durability=DURABILITY_SYNC, wal=False, storage_backend=STORAGE_SQLITE):
         self.__host = host
         self.__port = port
         self.__storage_name = storage
         self.__clients_limit = clients_limit
         self.__timeout = timeout
+        self.__max_message_size = max_message_size
+        self.__outbox_settings = {'high_watermark': outbox_high_watermark, 'low_watermark': outbox_low_watermark,
+                                  'outbox_limit': outbox_limit}
+        self.__dispatcher = dispatcher if dispatcher is not None else default_dispatcher()
+        self.__selector_class = selector_class
+        self.__reuse_port = reuse_port
+        self.__router = router  # delivers messages to clients of other cluster workers, see cluster.py
+        self.__handler_threads = handler_threads
+        self.__cache_rooms = cache_rooms  # cluster workers must read room members from shared database
+        self.__max_sessions_per_login = max_sessions_per_login
+        self.__metrics_port = metrics_port  # serves metrics text to connections from server host, if set
+        self.__durability = durability  # group commit of storage changes is flushed by main loop
+        self.__wal = wal  # storage reads use connections of their threads and do not wait for writes
+        self.__storage_backend = storage_backend  # cluster workers must share sqlite database
 
         self.__socket = None
         self.__storage = None
         self.__need_terminate = False
         self.__worker_thread = None
-        self.__print_queue = Queue()
+        self.__wakeup_sockets = None
+        self.__handler_pool = None
+        self.__rooms = None
+        self.__completions = SimpleQueue()  # (session, data, error, request_done) from handler threads
+        self.__print_queue = print_queue if print_queue is not None else Queue()
+        self.__metrics_socket = None
+        self.__metrics = ServerMetrics(self.__dispatcher)
+        self.__metrics.add_gauge('print_queue', self.__print_queue.qsize)
+        self.__metrics.add_gauge('handler_completions', self.__completions.qsize)
+        self.__metrics.add_gauge('handler_tasks',
+                                 lambda: self.__handler_pool.pending_tasks if self.__handler_pool is not None else 0)
+        self.__metrics.add_gauge_group(
+            'client_id_cache', lambda: self.__storage.client_id_cache_stats if self.__storage is not None else {})
+        self.__metrics.add_gauge_group(
+            'storage', lambda: self.__storage.write_stats if self.__storage is not None else {})
 
     def start(self):
         if self.__socket:
             raise RuntimeError('Already started')
         self.__socket = socket(AF_INET, SOCK_STREAM)
+        if self.__reuse_port:  # several worker processes listen on the same port
+            from socket import SO_REUSEPORT  # not available on windows
+            self.__socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.__socket.bind((self.__host, self.__port))
         self.__socket.listen(self.__clients_limit)
-        self.__socket.settimeout(self.__timeout)
+        self.__socket.setblocking(False)
+        self.__wakeup_sockets = socketpair()  # lets close_server() and handler threads interrupt waiting for events
+        self.__wakeup_sockets[1].setblocking(False)
+        if self.__metrics_port is not None:
+            self.__metrics_socket = socket(AF_INET, SOCK_STREAM)
+            self.__metrics_socket.bind(('127.0.0.1', self.__metrics_port))
+            self.__metrics_socket.listen()
+            self.__metrics_socket.setblocking(False)
+        if self.__router is not None:
+            self.__router.open()
+        self.__need_terminate = False
         self.__worker_thread = Thread(target=self.worker_thread_function)
         self.__worker_thread.daemon = True
         self.__worker_thread.start()
@@ -77,16 +166,31 @@ class Server(metaclass=ServerVerifierMeta):
     def close_server(self):
         if not self.__socket:
             raise RuntimeError('Not running')
-        self.__socket.close()
-        self.__socket = None
         self.__need_terminate = True
+        self.wake_up()
         self.__worker_thread.join()
         self.__worker_thread = None
+        self.__socket.close()
+        self.__socket = None
+        for wakeup_socket in self.__wakeup_sockets:
+            wakeup_socket.close()
+        self.__wakeup_sockets = None
+        if self.__metrics_socket is not None:
+            self.__metrics_socket.close()
+            self.__metrics_socket = None
+        if self.__router is not None:
+            self.__router.close()
 
     def worker_thread_function(self):
-        self.__storage = DBStorageServer(self.__storage_name)
-        self.mainloop()
-        self.__storage = None
+        storage = create_server_storage(self.__storage_backend, self.__storage_name,
+                                        check_same_thread=not self.__handler_threads, durability=self.__durability,
+                                        wal=self.__wal)
+        self.__storage = LockedStorage(storage) if self.__handler_threads else storage  # shared by handler threads
+        try:
+            self.mainloop()
+        finally:
+            self.__storage.close()
+            self.__storage = None
 
     @property
     def print_queue(self):
@@ -96,161 +200,226 @@ class Server(metaclass=ServerVerifierMeta):
     def storage(self):
         return self.__storage
 
+    @property
+    def dispatcher(self):
+        return self.__dispatcher
+
+    @property
+    def handler_threads(self) -> int:
+        return self.__handler_threads
+
+    @property
+    def metrics(self) -> ServerMetrics:
+        return self.__metrics
+
+    @property
+    def metrics_address(self):
+        return self.__metrics_socket.getsockname() if self.__metrics_socket else None
+
+    @property
+    def address(self):
+        """ Actual (host, port) the server listens on, useful when started with port 0 """
+        return self.__socket.getsockname() if self.__socket else None
+
     def mainloop(self):
-        clients = []
-        logins = {}
-        auth_tokens = {}
+        if self.__router is None:
+            sessions = SessionRegistry(self.__max_sessions_per_login)
+        else:
+            sessions = self.__router.create_registry(self.__max_sessions_per_login)
+        changed_sessions = set()  # sessions which may need another set of events to wait for
+        self.__rooms = RoomMembersCache(self.__cache_rooms)
+        selector = self.__selector_class()
+        selector.register(self.__socket, selectors.EVENT_READ)
+        selector.register(self.__wakeup_sockets[0], selectors.EVENT_READ)
+        if self.__router is not None:
+            selector.register(self.__router.socket, selectors.EVENT_READ)
+        if self.__metrics_socket is not None:
+            selector.register(self.__metrics_socket, selectors.EVENT_READ)
+        if self.__handler_threads:
+            self.__handler_pool = OrderedThreadPool(self.__handler_threads)
+        try:
+            while not self.__need_terminate:
+                for key, events in selector.select(self.__timeout):
+                    if key.fileobj is self.__socket:
+                        self.accept_clients(selector, sessions, changed_sessions)
+                    elif key.fileobj is self.__wakeup_sockets[0]:
+                        key.fileobj.recv(helpers.TCP_MSG_BUFFER_SIZE)
+                        self.process_completions(changed_sessions)
+                    elif self.__router is not None and key.fileobj is self.__router.socket:
+                        self.__router.receive(sessions)
+                    elif key.fileobj is self.__metrics_socket:
+                        self.send_metrics_text(sessions)
+                    else:
+                        self.handle_session_events(key.data, events, sessions)
+                        changed_sessions.add(key.data)
+                self.storage.flush_if_due()
+
+                for session in changed_sessions:
+                    if session.connection not in sessions:  # already closed
+                        continue
+                    if session.close_reason is not None:  # failed to receive data, e.g. too slow consumer
+                        self.close_session(selector, sessions, session, session.close_reason)
+                    else:
+                        self.update_session_events(selector, session)
+                changed_sessions.clear()
+        finally:
+            if self.__handler_pool is not None:
+                self.__handler_pool.shutdown()
+                self.__handler_pool = None
+                self.process_completions(changed_sessions)
+            for session in sessions:
+                self.close_session(selector, sessions, session, 'server stopped')
+            selector.close()
 
+    def accept_clients(self, selector, sessions: SessionRegistry, changed_sessions: set):
         while True:
-            if self.__need_terminate:
+            try:
+                conn, addr = self.__socket.accept()
+            except (BlockingIOError, InterruptedError):
                 return
+            self.__print_queue.put(f'Client connected: {str(addr)}')
+            self.__metrics.increment('connections_opened')
+            conn.setblocking(False)
+            # requests handled on pool threads must not refer to decoder buffer, which is reused for next ones
+            message_factory = request_from_frame if self.__handler_pool is None else \
+                lambda frame: request_from_frame(bytes(frame))
+            decoder = JimStreamDecoder(message_factory, self.__max_message_size, pass_frames=True)
+            session = Session(conn, addr, decoder, **self.__outbox_settings)
+            session.state_callback = changed_sessions.add
+            sessions.add(session)
+            selector.register(conn, selectors.EVENT_READ, session)
 
+    def handle_session_events(self, session: Session, events: int, sessions: SessionRegistry):
+        if session.connection not in sessions:  # closed while handling other events
+            return
+        try:
+            if events & selectors.EVENT_WRITE:
+                session.flush()
+            if events & selectors.EVENT_READ:
+                if self.__handler_pool is None:
+                    context = RequestContext(session, sessions, self.storage, self.__rooms, self.__metrics)
+                    for request in session.decoder.recv_into(session.connection):
+                        session.send(self.handle_request(request, context))
+                else:
+                    context = ThreadedRequestContext(session, sessions, self.storage, self.__rooms, self.__metrics,
+                                                     self.post_to_mainloop)
+                    for request in session.decoder.recv_into(session.connection):
+                        session.queued_requests += 1
+                        self.__handler_pool.submit(session, self.run_request, request, context)
+        except BlockingIOError:
+            pass  # nothing to read yet
+        except BaseException as e:
+            session.close_reason = e
+
+    def send_metrics_text(self, sessions: SessionRegistry):
+        """ Writes metrics to every connection of metrics port and closes it, text fits in socket buffer """
+        while True:
             try:
-                conn, addr = self.__socket.accept()  # check for new connections
-            except OSError:
-                pass  # timeout, do nothing
-            else:
-                self.__print_queue.put(f'Client connected: {str(addr)}')
-                clients.append(conn)
-            finally:  # check for incoming requests
-                readable, writable, erroneous = [], [], []
+                conn, _ = self.__metrics_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            with conn:
+                conn.settimeout(helpers.SERVER_SOCKET_TIMEOUT)
                 try:
-                    readable, writable, erroneous = select.select(clients, clients, clients, 0)
-                except:
-                    pass  # if some client unexpectedly disconnected, do nothing
-
-                for client_socket in readable:
-                    try:
-                        if client_socket not in writable:
-                            continue
-                        request = request_from_bytes(client_socket.recv(helpers.TCP_MSG_BUFFER_SIZE))
-                        self.__print_queue.put(f'Request:\n{request}')
-                        responses = []
-                        if request.action == 'presence':
-                            client_login = request.datadict['user']['account_name']
-                            resp = JimResponse()
-                            if not self.storage.check_client_exists(client_login):  # unknown client - error
-                                resp.response = 400
-                                resp.set_field('error', f'No such client: {client_login}')
-                            elif client_login not in logins.values():  # known client arrived - need auth
-                                token = security.create_auth_token()
-                                auth_tokens[client_socket] = token
-                                resp = auth_server_message(token)
-                            elif client_socket in logins.keys() and \
-                                    logins[client_socket] == client_login:  # existing client from same socket - ok
-                                client_time = request.datadict['time']
-                                client_ip = client_socket.getpeername()[0]
-                                self.storage.update_client(client_login, client_time, client_ip)
-                                resp.response = 200
-                            else:  # existing client from different ip - not correct
-                                resp.response = 400
-                                resp.set_field('error', 'Client already online')
-                            responses.append(resp)
-                        elif request.action == 'authenticate':
-                            client_login = request.datadict['user']['account_name']
-                            client_hash = self.storage.get_client_hash(client_login)
-                            auth_token = auth_tokens[client_socket]
-                            del auth_tokens[client_socket]
-                            expected_digest = security.create_auth_digest(client_hash, auth_token)
-                            client_digest = request.datadict['user']['password']
-                            resp = JimResponse()
-                            if not security.check_auth_digest_equal(expected_digest, client_digest):
-                                resp.response = 402
-                                resp.set_field('error', 'Access denied')
-                            else:  # add client login to dict, update client in database
-                                logins[client_socket] = client_login
-                                client_time = request.datadict['time']
-                                client_ip = client_socket.getpeername()[0]
-                                self.storage.update_client(client_login, client_time, client_ip)
-                                resp.response = 200
-                            responses.append(resp)
-                        elif request.action == 'add_contact':
-                            client_login = logins[client_socket]
-                            contact_login = request.datadict['user_id']
-                            resp = JimResponse()
-                            if not self.storage.check_client_exists(contact_login):
-                                resp.response = 400
-                                resp.set_field('error', f'No such client: {contact_login}')
-                            elif self.storage.check_client_in_contacts(client_login, contact_login):
-                                resp.response = 400
-                                resp.set_field('error', f'Client already in contacts: {contact_login}')
-                            else:
-                                self.storage.add_client_to_contacts(client_login, contact_login)
-                                resp.response = 200
-                            responses.append(resp)
-                        elif request.action == 'del_contact':
-                            client_login = logins[client_socket]
-                            contact_login = request.datadict['user_id']
-                            resp = JimResponse()
-                            if not self.storage.check_client_exists(contact_login):
-                                resp.response = 400
-                                resp.set_field('error', f'No such client: {contact_login}')
-                            elif not self.storage.check_client_in_contacts(client_login, contact_login):
-                                resp.response = 400
-                                resp.set_field('error', f'Client not in contacts: {contact_login}')
-                            else:
-                                self.storage.del_client_from_contacts(client_login, contact_login)
-                                resp.response = 200
-                            responses.append(resp)
-                        elif request.action == 'get_contacts':
-                            client_login = logins[client_socket]
-                            client_contacts = self.storage.get_client_contacts(client_login)
-                            quantity_resp = JimResponse()
-                            quantity_resp.response = 202
-                            quantity_resp.set_field('quantity', len(client_contacts))
-                            responses.append(quantity_resp)
-                            for contact in client_contacts:
-                                contact_resp = JimResponse()
-                                contact_resp.set_field('action', 'contact_list')
-                                contact_resp.set_field('user_id', contact)
-                                responses.append(contact_resp)
-                        elif request.action == 'msg':
-                            target_client_login = request.datadict['to']
-                            resp = JimResponse()
-                            for key, val in logins.items():
-                                if val == target_client_login:
-                                    key.send(request.to_bytes())
-                                    resp.response = 200
-                                    break
-                            else:
-                                resp.response = 400
-                                resp.set_field('error', f'Client not online: {target_client_login}')
-                            responses.append(resp)
-                        else:
-                            raise RuntimeError(f'Unknown JIM action: {request.action}')
-                        self.__print_queue.put('Response:')
-                        for resp in responses:
-                            self.__print_queue.put(str(resp))
-                            sleep(0.001)  # this magic solves problem with multiple jim messages in one socket message!!
-                            client_socket.send(resp.to_bytes())
-                    except BaseException as e:
-                        self.__print_queue.put(f'Client disconnected: {client_socket.getpeername()}, {e}')
-                        client_socket.close()
-                        clients.remove(client_socket)
-                        try:
-                            del logins[client_socket]
-                        except:
-                            pass
-                        if client_socket in writable:
-                            writable.remove(client_socket)
+                    conn.sendall(format_metrics_text(self.__metrics.snapshot(sessions)).encode('utf-8'))
+                except OSError:
+                    pass  # reader went away or is too slow
+
+    def handle_request(self, request, context: RequestContext) -> bytes:
+        """ Dispatches request to its handler, returns frames of all responses """
+        self.__print_queue.put(f'Request:\n{request}')
+        responses = self.__dispatcher.dispatch(request, context)
+        self.__print_queue.put('Response:')
+        for resp in responses:
+            self.__print_queue.put(str(resp))
+        return b''.join(resp.to_frame() for resp in responses)
+
+    def run_request(self, request, context: RequestContext):
+        """ Handles request on pool thread, responses are sent by network thread """
+        try:
+            self.post_to_mainloop(context.session, self.handle_request(request, context), request_done=True)
+        except BaseException as e:
+            self.post_to_mainloop(context.session, b'', e, request_done=True)
+
+    def post_to_mainloop(self, session, data, error=None, request_done=False):
+        self.__completions.put((session, data, error, request_done))
+        self.wake_up()
+
+    def process_completions(self, changed_sessions: set):
+        """ Sends data posted by handler threads, closes sessions whose requests failed """
+        while True:
+            try:
+                session, data, error, request_done = self.__completions.get_nowait()
+            except Empty:
+                return
+            if request_done:  # reading from client may be resumed
+                session.queued_requests -= 1
+                changed_sessions.add(session)
+            if error is not None:
+                session.close_reason = error
+            elif data:
+                session.send(data)
+
+    def wake_up(self):
+        try:
+            self.__wakeup_sockets[1].send(b'\0')
+        except OSError:
+            pass  # socket buffer is full so wakeup is already pending, or server is closed
+
+    @staticmethod
+    def update_session_events(selector, session: Session):
+        """
+        Waits for write only when there is pending output, stops reading while client is throttled.
+        Session with nothing to wait for is unregistered until its queued requests are handled.
+        """
+        events = selectors.EVENT_WRITE if session.has_pending_output else 0
+        if not session.reading_paused:
+            events |= selectors.EVENT_READ
+        key = selector.get_map().get(session.connection)
+        registered_events = key.events if key is not None else 0
+        if events == registered_events:
+            return
+        if not events:
+            selector.unregister(session.connection)
+        elif not registered_events:
+            selector.register(session.connection, events, session)
+        else:
+            selector.modify(session.connection, events, session)
+
+    def close_session(self, selector, sessions: SessionRegistry, session: Session, reason):
+        self.__print_queue.put(f'Client disconnected: {session.address}, {reason}')
+        if session.connection in selector.get_map():
+            selector.unregister(session.connection)
+        session.connection.close()
+        if sessions.remove(session):
+            self.__metrics.session_closed(session)
 
 
 def check_new_print_data_thread_function(print_queue: Queue):
     while True:
-        if print_queue:
-            print(print_queue.get())
+        data = print_queue.get()
+        if data is helpers.QUEUE_STOP:
+            return
+        print(data)
 
 
 if __name__ == '__main__':
     try:
         args = parse_commandline_args(sys.argv[1:])
         storage_file = os.path.join(helpers.get_this_script_full_dir(), 'server.sqlite')
-        server = Server(args.listen_address, args.listen_port, storage_file)
+        if args.workers:
+            from cluster import ClusterServer  # cluster module imports this one
+            server = ClusterServer(args.listen_address, args.listen_port, storage_file, workers=args.workers,
+                                   handler_threads=args.handler_threads, metrics_port=args.metrics_port, wal=args.wal)
+        else:
+            server = Server(args.listen_address, args.listen_port, storage_file, handler_threads=args.handler_threads,
+                            metrics_port=args.metrics_port, durability=args.durability, wal=args.wal,
+                            storage_backend=args.storage_backend)
         print_monitor = Thread(target=check_new_print_data_thread_function,
                                args=(server.print_queue,))
         print_monitor.daemon = True
         print_monitor.start()
-        supported_commands = ['start', 'stop']
+        supported_commands = ['start', 'stop', 'exit']
         main_menu = helpers.Menu(supported_commands)
         while True:
             user_choice = int(input(main_menu))
@@ -259,7 +428,15 @@ if __name__ == '__main__':
                 server.start()
             if command == 'stop':
                 server.close_server()
+            if command == 'exit':
+                break
     except BaseException as e:
         print(f'Error: {str(e)}')
         log.critical(str(e))
         raise e
+    try:
+        server.close_server()
+    except RuntimeError:  # not running
+        pass
+    server.print_queue.put(helpers.QUEUE_STOP)  # messages of stopped server are printed before monitor returns
+    print_monitor.join()
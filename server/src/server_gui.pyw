@@ -10,6 +10,7 @@ import server_pyqt
 from server import Server
 import helpers
 from storage import DBStorageServer
+from jim import ROOM_PREFIX
 from security import create_password_hash
 import log_confing
 
@@ -88,6 +89,9 @@ class MainWindow(QtWidgets.QMainWindow):
             if not client_password or not client_password:
                 self.print_info('Login and password must be non-empty')
                 return
+            if client_login.startswith(ROOM_PREFIX):
+                self.print_info(f'Login cannot start with {ROOM_PREFIX}, such names are for rooms')
+                return
             if self.storage.check_client_exists(client_login):
                 self.print_info(f'Client with this login already exists: {client_login}')
                 return
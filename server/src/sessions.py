@@ -0,0 +1,177 @@
+from collections import deque
+from threading import RLock
+
+import helpers
+
+
+class Session:
+    """
+    One client connection and its protocol state.
+    Outgoing data goes through outbox: it is sent right away while socket accepts it,
+    the rest waits for flush() when socket becomes writable again.
+    """
+    def __init__(self, connection, address, decoder=None, high_watermark=helpers.OUTBOX_HIGH_WATERMARK,
+                 low_watermark=helpers.OUTBOX_LOW_WATERMARK, outbox_limit=helpers.OUTBOX_LIMIT,
+                 queued_requests_limit=helpers.QUEUED_REQUESTS_LIMIT):
+        self.connection = connection
+        self.address = address
+        self.decoder = decoder
+        self.login = None
+        self.auth_token = None
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.outbox_limit = outbox_limit
+        self.outbox = deque()
+        self.outbox_size = 0
+        self.bytes_sent = 0
+        self.queued_requests_limit = queued_requests_limit
+        self.queued_requests = 0  # requests passed to handler threads and not answered yet
+        self.close_reason = None  # set when session must be closed, e.g. client reads too slow
+        self.state_callback = None  # called with session when it gets queued output or must be closed
+        self._reading_paused = False
+
+    @property
+    def ip(self):
+        return self.address[0]
+
+    @property
+    def has_pending_output(self) -> bool:
+        return bool(self.outbox)
+
+    @property
+    def bytes_received(self) -> int:
+        return self.decoder.received_bytes if self.decoder is not None else 0
+
+    @property
+    def reading_paused(self) -> bool:
+        """
+        Stop reading client requests while its outbox is above high watermark, until it drains to low one,
+        and while too many of its requests wait for handler threads
+        """
+        if self.outbox_size >= self.high_watermark:
+            self._reading_paused = True
+        elif self.outbox_size <= self.low_watermark:
+            self._reading_paused = False
+        return self._reading_paused or self.queued_requests >= self.queued_requests_limit
+
+    def send(self, data) -> bool:
+        """ Sends data or queues it, returns False if it cannot be delivered and session must be closed """
+        if self.close_reason is not None:
+            return False
+        if not self.outbox:  # nothing queued, try to send right away
+            try:
+                sent = self.connection.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError as e:
+                self.close_reason = str(e)
+                self._notify_state_changed()
+                return False
+            self.bytes_sent += sent
+            if sent == len(data):
+                return True
+            data = memoryview(data)[sent:]
+        if self.outbox_size + len(data) > self.outbox_limit:
+            self.close_reason = f'outbox limit exceeded: {self.outbox_limit} bytes'
+            self._notify_state_changed()
+            return False
+        if not self.outbox:
+            self._notify_state_changed()
+        self.outbox.append(bytes(data))  # data may be a view of receive buffer, so keep a copy
+        self.outbox_size += len(data)
+        return True
+
+    def flush(self):
+        """ Sends queued data while socket accepts it """
+        while self.outbox:
+            chunk = self.outbox[0]
+            try:
+                sent = self.connection.send(chunk)
+            except BlockingIOError:
+                return
+            self.outbox_size -= sent
+            self.bytes_sent += sent
+            if sent < len(chunk):
+                self.outbox[0] = memoryview(chunk)[sent:]
+                return
+            self.outbox.popleft()
+
+    def _notify_state_changed(self):
+        if self.state_callback is not None:
+            self.state_callback(self)
+
+
+class SessionRegistry:
+    """
+    All connected sessions with a bidirectional login <-> sessions index, one login may have several sessions
+    (e.g. desktop and console clients), so routing by login, online checks and removal on disconnect are O(1).
+    Changes are made under a lock, as handler threads bind logins while I/O thread removes sessions.
+    """
+    def __init__(self, max_sessions_per_login=helpers.MAX_SESSIONS_PER_LOGIN):
+        self.max_sessions_per_login = max_sessions_per_login
+        self._sessions = {}  # connection -> session
+        self._logins = {}  # login -> {session: None}, dict keeps sessions in login order
+        self._lock = RLock()
+
+    def add(self, session: Session):
+        with self._lock:
+            if session.connection in self._sessions:
+                raise RuntimeError(f'Session already registered: {session.address}')
+            self._sessions[session.connection] = session
+
+    def remove(self, session: Session):
+        """ Forgets session and its login, returns False if session was not registered """
+        with self._lock:
+            if self._sessions.pop(session.connection, None) is None:
+                return False
+            self._unbind_login(session)
+            return True
+
+    def get(self, connection) -> Session:
+        return self._sessions[connection]
+
+    def bind_login(self, session: Session, login: str):
+        """ Marks session as authenticated with login """
+        with self._lock:
+            if session.connection not in self._sessions:  # disconnected while its request was handled
+                raise RuntimeError(f'Session is not registered: {session.address}')
+            self._unbind_login(session)
+            session.login = login
+            self._logins.setdefault(login, {})[session] = None
+
+    def _unbind_login(self, session: Session):
+        login_sessions = self._logins.get(session.login)
+        if login_sessions is None or session not in login_sessions:
+            return
+        del login_sessions[session]
+        if not login_sessions:
+            del self._logins[session.login]
+
+    def get_sessions(self, login: str) -> list:
+        """ Returns all sessions of online client, or empty list if client is not online """
+        return list(self._logins.get(login, ()))
+
+    def count_sessions(self, login: str) -> int:
+        return len(self._logins.get(login, ()))
+
+    def can_bind_login(self, login: str) -> bool:
+        """ Checks that one more session of client is allowed """
+        return self.count_sessions(login) < self.max_sessions_per_login
+
+    def is_online(self, login: str) -> bool:
+        return login in self._logins
+
+    def logins(self):
+        return self._logins.keys()
+
+    def connections(self) -> list:
+        return list(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, connection):
+        return connection in self._sessions
@@ -1,13 +1,196 @@
+import math
 import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock, local, get_ident
+
+from jim import ROOM_PREFIX, is_room_name
+
+CLIENT_ID_CACHE_SIZE = 10000  # login <-> id pairs kept in memory by server storage
+LOGINS_FILTER_MIN_CAPACITY = 1024
+LOGINS_FILTER_ERROR_RATE = 0.01
+LOGINS_FILTER_REFRESH_INTERVAL = 1.0  # seconds between checks for clients added by other connections
+DURABILITY_SYNC = 'sync'  # every change is committed before storage method returns
+DURABILITY_GROUP = 'group'  # changes are committed together by flush(), the last ones are lost on crash
+DURABILITY_POLICIES = [DURABILITY_SYNC, DURABILITY_GROUP]
+FLUSH_INTERVAL = 0.5  # seconds changes may wait for group commit
+FLUSH_LIMIT = 1000  # changes committed at once at most
+WAL_SYNCHRONOUS = 'NORMAL'  # commits do not wait for fsync, WAL checkpoints do
+WAL_CACHE_SIZE_KB = 16 * 1024  # page cache of every connection
+WAL_MMAP_SIZE = 256 * 1024 * 1024
+# methods of server storage which only read database, in WAL mode with sync durability threads call them without lock
+CONCURRENT_READ_METHODS = ('get_client_id', 'get_client_login', 'get_client_hash', 'check_client_exists',
+                           'check_client_in_contacts', 'get_client_contacts', 'get_room_id', 'check_room_exists',
+                           'check_client_in_room', 'get_room_members')
+
+# schema changes of server database in order of their versions, database keeps number of applied ones,
+# tables of the first one may exist already in databases created before schema was versioned
+SERVER_MIGRATIONS = (
+    '''
+    CREATE TABLE IF NOT EXISTS `Clients`(
+        `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, 
+        `login` TEXT NOT NULL UNIQUE, 
+        `info`  TEXT,
+        `last_connect_time`	INTEGER,
+        `last_connect_ip`	TEXT
+    );
+    CREATE TABLE IF NOT EXISTS `ClientContacts` (
+        `owner_id`	    INTEGER,
+        `contact_id`	INTEGER,
+        PRIMARY KEY(`owner_id`,`contact_id`),
+        FOREIGN KEY(`owner_id`) REFERENCES `Clients`(`id`),
+        FOREIGN KEY(`contact_id`) REFERENCES `Clients`(`id`)
+    );
+    CREATE TABLE IF NOT EXISTS `OfflineMessages`(
+        `id`	        INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+        `recipient_id`	INTEGER NOT NULL,
+        `time`	        REAL NOT NULL,
+        `frame`	        BLOB NOT NULL,
+        FOREIGN KEY(`recipient_id`) REFERENCES `Clients`(`id`)
+    );
+    CREATE INDEX IF NOT EXISTS `OfflineMessagesRecipient` ON `OfflineMessages`(`recipient_id`, `id`);
+    CREATE TABLE IF NOT EXISTS `Rooms`(
+        `id`	    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+        `name`	    TEXT NOT NULL UNIQUE,
+        `owner_id`	INTEGER NOT NULL,
+        FOREIGN KEY(`owner_id`) REFERENCES `Clients`(`id`)
+    );
+    CREATE TABLE IF NOT EXISTS `RoomMembers`(
+        `room_id`	INTEGER NOT NULL,
+        `client_id`	INTEGER NOT NULL,
+        PRIMARY KEY(`room_id`, `client_id`),
+        FOREIGN KEY(`room_id`) REFERENCES `Rooms`(`id`),
+        FOREIGN KEY(`client_id`) REFERENCES `Clients`(`id`)
+    );
+    ''',
+    # get_clients() reads the index in order instead of sorting the table
+    '''
+    CREATE INDEX IF NOT EXISTS `ClientsLastConnect` ON `Clients`(`last_connect_time`, `login`, `last_connect_ip`);
+    ''',
+    # sessions of clients on cluster workers, see DBPresenceDirectory
+    '''
+    CREATE TABLE IF NOT EXISTS `Presence`(
+        `login`	    TEXT NOT NULL,
+        `worker_id`	INTEGER NOT NULL,
+        `sessions`	INTEGER NOT NULL,
+        PRIMARY KEY(`login`, `worker_id`)
+    );
+    ''',
+)
+
+CLIENT_MIGRATIONS = (
+    '''
+    CREATE TABLE IF NOT EXISTS `Contacts`(
+        `id`	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+        `login`	TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS `Messages` (
+        `id`	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+        `contact_id`	INTEGER NOT NULL,
+        `incoming`	INTEGER NOT NULL,
+        `text`	TEXT NOT NULL,
+        FOREIGN KEY(`contact_id`) REFERENCES `Contacts`(`id`) ON DELETE CASCADE
+    );
+    ''',
+    # get_messages() and cascade delete of contact read messages of one contact only
+    '''
+    CREATE INDEX IF NOT EXISTS `MessagesContact` ON `Messages`(`contact_id`, `id`);
+    ''',
+)
 
 
 class DBStorage:
-    def __init__(self, database):
-        self._conn = sqlite3.connect(database)
+    """
+    Database connection with one shared cursor. In WAL mode this connection is the only writer,
+    and reads go to read-only connections opened per thread, so they run in parallel with each other
+    and with writes, reading the last committed data. Thread which writes to storage reads its uncommitted
+    changes from the writer connection.
+    """
+    def __init__(self, database, check_same_thread=True, wal=False):
+        if wal and database == ':memory:':
+            raise ValueError('WAL mode needs database file, in-memory database cannot be shared by connections')
+        self._database = database
+        self._conn = sqlite3.connect(database, check_same_thread=check_same_thread)
         self._cursor = self._conn.cursor()
+        self._writer_thread = get_ident() if check_same_thread else None  # None - used by any thread under a lock
+        self._readers = None  # connections opened by threads for reading, in WAL mode
+        self._uncommitted_reads = True  # writing thread reads its changes from writer connection until commit
+        if wal:
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute(f'PRAGMA synchronous = {WAL_SYNCHRONOUS}')
+            self._set_cache_pragmas(self._conn)
+            self._readers = []
+            self._readers_lock = Lock()
+            self._local = local()
 
     def __del__(self):
+        if not hasattr(self, '_writer_thread'):  # __init__ failed, connections were not opened
+            return
+        if self._writer_thread in (None, get_ident()):  # otherwise connection is released by its own finalizer
+            self._close_connections()
+
+    def _close_connections(self):
         self._conn.close()
+        if self._readers is not None:
+            with self._readers_lock:
+                for reader in self._readers:
+                    reader.close()
+                self._readers.clear()
+
+    @staticmethod
+    def _set_cache_pragmas(conn):
+        conn.execute(f'PRAGMA cache_size = {-WAL_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {WAL_MMAP_SIZE}')
+
+    @property
+    def wal(self) -> bool:
+        return self._readers is not None
+
+    def _read_cursor(self):
+        """ Cursor of read connection of this thread, or writer cursor if it is not WAL mode or changes are pending """
+        if self._readers is None or (self._uncommitted_reads and self._conn.in_transaction and
+                                     self._writer_thread in (None, get_ident())):
+            return self._cursor
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            reader = sqlite3.connect(self._database, check_same_thread=False)  # closed by close() of storage
+            reader.execute('PRAGMA query_only = ON')
+            self._set_cache_pragmas(reader)
+            with self._readers_lock:
+                self._readers.append(reader)
+            cursor = self._local.cursor = reader.cursor()
+        return cursor
+
+    def _select(self, query: str, parameters=()) -> list:
+        cursor = self._read_cursor()
+        cursor.execute(query, parameters)
+        return cursor.fetchall()
+
+    @property
+    def schema_version(self) -> int:
+        return self._cursor.execute('PRAGMA user_version').fetchone()[0]
+
+    def _migrate(self, migrations: tuple, version=None):
+        """
+        Applies migrations database has not got yet up to version, all by default, each one in its own transaction.
+        Number of applied migrations is kept in user_version of database.
+        """
+        current_version = self.schema_version
+        if current_version > len(migrations):
+            raise RuntimeError(f'Database schema version {current_version} is newer than supported {len(migrations)}')
+        version = len(migrations) if version is None else version
+        for number in range(current_version + 1, version + 1):
+            script = migrations[number - 1]
+            try:
+                self._cursor.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;')
+            except sqlite3.Error:
+                self._conn.rollback()
+                raise
+
+    def close(self):
+        """ Closes writer and reader connections, must be called by thread owning the storage """
+        self._close_connections()
 
     @property
     def conn(self):
@@ -18,69 +201,342 @@ class DBStorage:
         return self._cursor
 
 
-class DBStorageServer(DBStorage):
-    def __init__(self, database):
-        super().__init__(database)
-        self._cursor.executescript('''
-        CREATE TABLE IF NOT EXISTS `Clients`(
-            `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, 
-            `login` TEXT NOT NULL UNIQUE, 
-            `info`  TEXT,
-            `last_connect_time`	INTEGER,
-            `last_connect_ip`	TEXT
-        );
-        ''')
+class BloomFilter:
+    """
+    Set of strings which may answer "maybe present" for absent ones, but never "absent" for added ones.
+    False positive rate stays about error_rate while at most capacity strings are added.
+    """
+    def __init__(self, capacity: int, error_rate=LOGINS_FILTER_ERROR_RATE):
+        self.capacity = capacity
+        self.size = 0
+        self.bits_count = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes_count = max(1, round(self.bits_count / capacity * math.log(2)))
+        self._bits = bytearray((self.bits_count + 7) // 8)
+
+    def _positions(self, item: str):
+        # str hash is salted per process, so filter must not be saved or shared with other processes
+        item_hash = hash(item) & 0xFFFFFFFFFFFFFFFF
+        position, step = item_hash & 0xFFFFFFFF, (item_hash >> 32) | 1
+        for _ in range(self.hashes_count):
+            yield position % self.bits_count
+            position += step
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.size += 1
+
+    def __contains__(self, item: str) -> bool:
+        for position in self._positions(item):  # absent items usually stop at the first or second position
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ClientIdentityCache:
+    """
+    login <-> id of recently used clients, the least recently used pair is evicted when cache is full.
+    Storage readers on several threads share the cache, so it is changed under a lock.
+    """
+    def __init__(self, capacity=CLIENT_ID_CACHE_SIZE):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()  # login -> id, least recently used first
+        self._logins = {}  # id -> login
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get_id(self, login: str):
+        """ Returns id of client, or None if it is not cached """
+        with self._lock:
+            client_id = self._ids.get(login)
+            if client_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._ids.move_to_end(login)
+            return client_id
+
+    def get_login(self, client_id: int):
+        """ Returns login of client, or None if it is not cached """
+        with self._lock:
+            login = self._logins.get(client_id)
+            if login is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._ids.move_to_end(login)
+            return login
+
+    def put(self, login: str, client_id: int):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            if login in self._ids:
+                self._ids.move_to_end(login)
+                return
+            self._ids[login] = client_id
+            self._logins[client_id] = login
+            if len(self._ids) > self.capacity:
+                _, evicted_id = self._ids.popitem(last=False)
+                del self._logins[evicted_id]
+
+
+class ServerStorage(ABC):
+    """
+    Interface of server storage backends: clients, contacts, offline messages and rooms.
+    Methods of clients raise IndexError for unknown logins, see DBStorageServer for the rest of their semantics.
+    Owner of storage calls flush_if_due() regularly and close() before it is dropped.
+    """
+    @abstractmethod
+    def get_client_id(self, login: str):
+        pass
+
+    @abstractmethod
+    def get_client_login(self, client_id: int) -> str:
+        pass
+
+    @abstractmethod
+    def get_clients(self):
+        """ Returns [(login, last connect time, last connect ip)], the latest connected first """
+
+    @abstractmethod
+    def get_client_hash(self, login: str) -> str:
+        pass
+
+    @abstractmethod
+    def check_client_exists(self, login: str) -> bool:
+        pass
+
+    @abstractmethod
+    def add_client(self, login: str, password_hash: str):
+        pass
+
+    @abstractmethod
+    def update_client(self, login: str, connection_time: float, connection_ip: str):
+        pass
+
+    @abstractmethod
+    def check_client_in_contacts(self, owner_login: str, client_login: str) -> bool:
+        pass
+
+    @abstractmethod
+    def add_client_to_contacts(self, owner_login: str, client_login: str):
+        pass
+
+    @abstractmethod
+    def del_client_from_contacts(self, owner_login: str, client_login: str):
+        pass
+
+    @abstractmethod
+    def get_client_contacts(self, client_login: str, limit: int=None, after: str=None) -> list:
+        pass
+
+    def add_offline_message(self, login: str, frame: bytes, queue_limit: int, ttl: float) -> bool:
+        """
+        Appends jim frame to offline queue of client, messages older than ttl seconds are dropped first.
+        Returns False if queue already holds queue_limit messages.
+        """
+        return not self.add_offline_messages([login], frame, queue_limit, ttl)
+
+    @abstractmethod
+    def add_offline_messages(self, logins: list, frame: bytes, queue_limit: int, ttl: float) -> list:
+        pass
+
+    @abstractmethod
+    def pop_offline_messages(self, login: str, ttl: float) -> list:
+        pass
+
+    @abstractmethod
+    def get_room_id(self, name: str):
+        """ Returns room id by name, or None if there is no such room """
+
+    def check_room_exists(self, name: str) -> bool:
+        return self.get_room_id(name) is not None
+
+    @abstractmethod
+    def add_room(self, name: str, owner_login: str):
+        pass
+
+    @abstractmethod
+    def check_client_in_room(self, name: str, login: str) -> bool:
+        pass
+
+    @abstractmethod
+    def add_room_member(self, name: str, login: str):
+        pass
+
+    @abstractmethod
+    def del_room_member(self, name: str, login: str):
+        pass
+
+    @abstractmethod
+    def get_room_members(self, name: str) -> list:
+        pass
+
+    @property
+    def client_id_cache_stats(self) -> dict:
+        return {}
+
+    @property
+    def write_stats(self) -> dict:
+        return {}
+
+    @property
+    def concurrent_read_methods(self) -> tuple:
+        """ Names of methods threads may call while other thread is in any method of storage """
+        return ()
+
+    def flush_if_due(self):
+        pass
+
+    def flush(self):
+        """ Makes all changes made so far durable """
+
+    def close(self):
+        self.flush()
+
+
+class DBStorageServer(DBStorage, ServerStorage):
+    """
+    Clients never change login and are never deleted, so login <-> id pairs are cached once read.
+    Logins of all clients are also kept in a Bloom filter, so checks of unknown logins do not search Clients table.
+    Clients must be added with add_client(): clients inserted by other connections (server GUI, cluster workers)
+    are read into the filter at most once per logins_refresh_interval, when some login is not found in it,
+    inserts made through cursor of this storage are not noticed at all.
+
+    With group durability changes stay in open transaction, and last connect updates are only kept in memory,
+    one per client, until flush() commits them all at once. Owner of storage must call flush_if_due() regularly
+    and close() before storage is dropped. Transaction holds write lock of database file meanwhile,
+    so other processes writing to it (e.g. cluster workers) must not use group durability.
+    """
+    def __init__(self, database, check_same_thread=True, client_id_cache_size=CLIENT_ID_CACHE_SIZE,
+                 logins_refresh_interval=LOGINS_FILTER_REFRESH_INTERVAL, durability=DURABILITY_SYNC,
+                 flush_interval=FLUSH_INTERVAL, flush_limit=FLUSH_LIMIT, wal=False, schema_version=None):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f'Unknown durability policy: {durability}, supported: {", ".join(DURABILITY_POLICIES)}')
+        super().__init__(database, check_same_thread, wal)
+        self._uncommitted_reads = durability != DURABILITY_SYNC  # synced changes are committed before method returns
+        self._durability = durability
+        self._flush_interval = flush_interval
+        self._flush_limit = flush_limit
+        self._client_updates = {}  # client id -> (last connect time, last connect ip) not written yet
+        self._unflushed_changes = 0
+        self._first_unflushed_time = None
+        self._flushes = 0
+        self._client_ids = ClientIdentityCache(client_id_cache_size)
+        self._logins_refresh_interval = logins_refresh_interval
+        self._logins_filter = None  # filled on first existence check
+        self._logins_filter_max_id = 0
+        self._logins_filter_lock = Lock()
+        self._logins_filter_check_time = 0.0
+        self._filtered_logins = 0
         self._cursor.execute('PRAGMA foreign_keys = ON;')
-        self._cursor.executescript('''
-        CREATE TABLE IF NOT EXISTS `ClientContacts` (
-            `owner_id`	    INTEGER,
-            `contact_id`	INTEGER,
-            PRIMARY KEY(`owner_id`,`contact_id`),
-            FOREIGN KEY(`owner_id`) REFERENCES `Clients`(`id`),
-            FOREIGN KEY(`contact_id`) REFERENCES `Clients`(`id`)
-        );
-        ''')
-        self._conn.commit()
+        self._migrate(SERVER_MIGRATIONS, schema_version)
 
     def get_client_id(self, login: str):
-        """ Returns client id by login from Clients table, or None if there is no such client """
-        self._cursor.execute('SELECT `id` FROM `Clients` WHERE `login` == ?', (login,))
-        return self._cursor.fetchall()[0][0]
+        """ Returns client id by login from cache or Clients table, raises IndexError if there is no such client """
+        client_id = self._client_ids.get_id(login) if isinstance(login, str) else None
+        return client_id if client_id is not None else self._select_client_id(login)
+
+    def _select_client_id(self, login: str):
+        client_id = self._select('SELECT `id` FROM `Clients` WHERE `login` == ?', (login,))[0][0]
+        self._client_ids.put(login, client_id)
+        return client_id
+
+    def get_client_login(self, client_id: int) -> str:
+        """ Returns client login by id from cache or Clients table, raises IndexError if there is no such client """
+        login = self._client_ids.get_login(client_id)
+        if login is None:
+            login = self._select('SELECT `login` FROM `Clients` WHERE `id` == ?', (client_id,))[0][0]
+            self._client_ids.put(login, client_id)
+        return login
+
+    @property
+    def client_id_cache_stats(self) -> dict:
+        return {'size': len(self._client_ids), 'hits': self._client_ids.hits, 'misses': self._client_ids.misses,
+                'filtered_logins': self._filtered_logins}
 
     def get_clients(self):
-        self._cursor.execute(
+        self._write_client_updates()
+        result = self._select(
             '''
             SELECT `login`, `last_connect_time`, `last_connect_ip`
             FROM `Clients`
             ORDER BY `last_connect_time` DESC
             '''
         )
-        result = self._cursor.fetchall()
         return result if result else []
 
     def get_client_hash(self, login: str) -> str:
-        self._cursor.execute('SELECT `info` FROM `Clients` WHERE `login` == ?', (login,))
-        return self._cursor.fetchall()[0][0]
+        return self._select('SELECT `info` FROM `Clients` WHERE `login` == ?', (login,))[0][0]
 
     def check_client_exists(self, login: str) -> bool:
+        if isinstance(login, str) and self._client_ids.get_id(login) is not None:
+            return True
+        if not self._may_client_exist(login):
+            self._filtered_logins += 1
+            return False
         try:
-            self.get_client_id(login)
+            self._select_client_id(login)
             return True
         except IndexError:
             return False
 
+    def _may_client_exist(self, login: str) -> bool:
+        """ Checks login in Bloom filter, filter is brought up to date when login is not found in it """
+        if not isinstance(login, str):
+            return True
+        if self._logins_filter is None:
+            self._fill_logins_filter()
+        if login in self._logins_filter:
+            return True
+        now = time.monotonic()
+        if now - self._logins_filter_check_time < self._logins_refresh_interval:
+            return False
+        self._logins_filter_check_time = now
+        self._fill_logins_filter()
+        return login in self._logins_filter
+
+    def _fill_logins_filter(self):
+        """ Adds clients created since the last call to logins filter, full filter is rebuilt twice as large """
+        with self._logins_filter_lock:
+            new_clients = self._select('SELECT `id`, `login` FROM `Clients` WHERE `id` > ?',
+                                       (self._logins_filter_max_id,))
+            logins_filter = self._logins_filter
+            if logins_filter is None or logins_filter.size + len(new_clients) > logins_filter.capacity:
+                new_clients = self._select('SELECT `id`, `login` FROM `Clients`')
+                logins_filter = BloomFilter(max(LOGINS_FILTER_MIN_CAPACITY, 2 * len(new_clients)))
+            for client_id, login in new_clients:
+                logins_filter.add(login)
+                self._logins_filter_max_id = max(self._logins_filter_max_id, client_id)
+            self._logins_filter = logins_filter  # readers on other threads see either old or filled filter
+
     def add_client(self, login: str, password_hash: str):
         if not login:
             raise ValueError('login cannot be None or empty')
+        if login.startswith(ROOM_PREFIX):
+            raise ValueError(f'login cannot start with {ROOM_PREFIX}, such names are for rooms')
         if not password_hash:
             raise ValueError('password hash cannot be None or empty')
         if self.check_client_exists(login) is True:
             raise RuntimeError(f'client with this login already exists: {login}')
         self._cursor.execute('INSERT INTO `Clients` VALUES (NULL, ?, ?, NULL, NULL)', (login, password_hash))
         self._conn.commit()
+        client_id = self._cursor.lastrowid
+        self._client_ids.put(login, client_id)
+        if self._logins_filter is not None:
+            self._fill_logins_filter()
 
     def update_client(self, login: str, connection_time: float, connection_ip: str):
         client_id = self.get_client_id(login)
+        if self._durability == DURABILITY_GROUP:  # only the last update of client is written
+            self._client_updates[client_id] = (connection_time, connection_ip)
+            self._written()
+            return
         self._cursor.execute(
             """
             UPDATE `Clients` SET 
@@ -91,57 +547,255 @@ class DBStorageServer(DBStorage):
         )
         self._conn.commit()
 
+    def _write_client_updates(self):
+        if not self._client_updates:
+            return
+        self._cursor.executemany('UPDATE `Clients` SET `last_connect_time` = ?, `last_connect_ip` = ? WHERE `id` == ?',
+                                 [(*update, client_id) for client_id, update in self._client_updates.items()])
+        self._client_updates.clear()
+
+    def _written(self):
+        """ Commits change made by storage method, or leaves it to group commit """
+        if self._durability == DURABILITY_SYNC:
+            self._conn.commit()
+            return
+        if self._first_unflushed_time is None:
+            self._first_unflushed_time = time.monotonic()
+        self._unflushed_changes += 1
+        if self._unflushed_changes >= self._flush_limit:
+            self.flush()
+
+    def flush_if_due(self):
+        """ Commits changes if the oldest of them waited for flush_interval """
+        if self._first_unflushed_time is not None and \
+                time.monotonic() - self._first_unflushed_time >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Commits all changes waiting for group commit in one transaction """
+        if self._first_unflushed_time is None:
+            return
+        self._write_client_updates()
+        self._conn.commit()
+        self._flushes += 1
+        self._unflushed_changes = 0
+        self._first_unflushed_time = None
+
+    @property
+    def write_stats(self) -> dict:
+        return {'unflushed_changes': self._unflushed_changes, 'flushes': self._flushes}
+
+    @property
+    def concurrent_read_methods(self) -> tuple:
+        """ In WAL mode reads use connections of their threads, with group durability they must see pending changes """
+        return CONCURRENT_READ_METHODS if self.wal and self._durability == DURABILITY_SYNC else ()
+
+    def close(self):
+        self.flush()
+        super().close()
+
     def check_client_in_contacts(self, owner_login: str, client_login: str) -> bool:
         owner_id = self.get_client_id(owner_login)
         client_id = self.get_client_id(client_login)
-        self._cursor.execute('SELECT COUNT() FROM `ClientContacts` WHERE `owner_id` == ? AND `contact_id` == ?;',
-                             (owner_id, client_id))
-        return True if self._cursor.fetchall()[0][0] == 1 else False
+        result = self._select('SELECT COUNT() FROM `ClientContacts` WHERE `owner_id` == ? AND `contact_id` == ?;',
+                              (owner_id, client_id))
+        return True if result[0][0] == 1 else False
 
     def add_client_to_contacts(self, owner_login: str, client_login: str):
         owner_id = self.get_client_id(owner_login)
         client_id = self.get_client_id(client_login)
         self._cursor.execute('INSERT INTO `ClientContacts` VALUES (?, ?);', (owner_id, client_id))
-        self._conn.commit()
+        self._written()
 
     def del_client_from_contacts(self, owner_login: str, client_login: str):
         owner_id = self.get_client_id(owner_login)
         client_id = self.get_client_id(client_login)
         self._cursor.execute('DELETE FROM `ClientContacts` WHERE `owner_id` == ? AND `contact_id` == ?',
                              (owner_id, client_id))
-        self._conn.commit()
+        self._written()
 
-    def get_client_contacts(self, client_login: str) -> list:
+    def get_client_contacts(self, client_login: str, limit: int=None, after: str=None) -> list:
+        """
+        Returns contact logins of client.
+        If limit or after is set, contacts are sorted by login and only page of them is returned:
+        at most limit contacts with logins greater than after
+        """
         client_id = self.get_client_id(client_login)
-        query = '''select `Clients`.login from `ClientContacts` join `Clients` 
-        where (`ClientContacts`.contact_id == `Clients`.id and `ClientContacts`.owner_id == ?);'''
-        self._cursor.execute(query, (client_id,))
-        result = self._cursor.fetchall()
+        if limit is None and after is None:
+            query = '''
+            SELECT `Clients`.`login` FROM `ClientContacts`
+            JOIN `Clients` ON `Clients`.`id` == `ClientContacts`.`contact_id`
+            WHERE `ClientContacts`.`owner_id` == ?
+            '''
+            result = self._select(query, (client_id,))
+        else:
+            query = '''
+            SELECT `Clients`.`login` FROM `ClientContacts`
+            JOIN `Clients` ON `Clients`.`id` == `ClientContacts`.`contact_id`
+            WHERE `ClientContacts`.`owner_id` == ? AND `Clients`.`login` > ?
+            ORDER BY `Clients`.`login`
+            LIMIT ?
+            '''
+            result = self._select(query, (client_id, after if after is not None else '', -1 if limit is None else limit))
         return [item[0] for item in result] if result is not None else []
 
+    def add_offline_messages(self, logins: list, frame: bytes, queue_limit: int, ttl: float) -> list:
+        """ Appends the same jim frame to offline queues of several clients at once, returns logins with full queues """
+        now = time.time()
+        frame = bytes(frame)
+        rejected = []
+        for login in logins:
+            client_id = self.get_client_id(login)
+            self._cursor.execute('DELETE FROM `OfflineMessages` WHERE `recipient_id` == ? AND `time` < ?',
+                                 (client_id, now - ttl))
+            self._cursor.execute('SELECT COUNT() FROM `OfflineMessages` WHERE `recipient_id` == ?', (client_id,))
+            if self._cursor.fetchall()[0][0] >= queue_limit:
+                rejected.append(login)
+                continue
+            self._cursor.execute('INSERT INTO `OfflineMessages` VALUES (NULL, ?, ?, ?)', (client_id, now, frame))
+        self._written()
+        return rejected
+
+    def pop_offline_messages(self, login: str, ttl: float) -> list:
+        """ Removes offline queue of client and returns its jim frames not older than ttl seconds, oldest first """
+        client_id = self.get_client_id(login)
+        self._cursor.execute(
+            '''
+            SELECT `id`, `frame` FROM `OfflineMessages`
+            WHERE `recipient_id` == ? AND `time` >= ?
+            ORDER BY `id`
+            ''', (client_id, time.time() - ttl)
+        )
+        result = self._cursor.fetchall()
+        if result:
+            self._cursor.execute('DELETE FROM `OfflineMessages` WHERE `recipient_id` == ? AND `id` <= ?',
+                                 (client_id, result[-1][0]))
+        else:  # only expired messages may be left
+            self._cursor.execute('DELETE FROM `OfflineMessages` WHERE `recipient_id` == ?', (client_id,))
+        self._written()
+        return [item[1] for item in result]
+
+    def get_room_id(self, name: str):
+        """ Returns room id by name, or None if there is no such room """
+        result = self._select('SELECT `id` FROM `Rooms` WHERE `name` == ?', (name,))
+        return result[0][0] if result else None
+
+    def add_room(self, name: str, owner_login: str):
+        """ Creates room, its owner becomes the first member """
+        if not name:
+            raise ValueError('room name cannot be None or empty')
+        if self.check_room_exists(name):
+            raise RuntimeError(f'room with this name already exists: {name}')
+        owner_id = self.get_client_id(owner_login)
+        self._cursor.execute('INSERT INTO `Rooms` VALUES (NULL, ?, ?)', (name, owner_id))
+        self._cursor.execute('INSERT INTO `RoomMembers` VALUES (?, ?)', (self._cursor.lastrowid, owner_id))
+        self._written()
+
+    def check_client_in_room(self, name: str, login: str) -> bool:
+        result = self._select(
+            '''
+            SELECT COUNT() FROM `RoomMembers`
+            JOIN `Rooms` ON `Rooms`.`id` == `RoomMembers`.`room_id`
+            JOIN `Clients` ON `Clients`.`id` == `RoomMembers`.`client_id`
+            WHERE `Rooms`.`name` == ? AND `Clients`.`login` == ?
+            ''', (name, login)
+        )
+        return result[0][0] == 1
+
+    def add_room_member(self, name: str, login: str):
+        self._cursor.execute('INSERT INTO `RoomMembers` VALUES (?, ?)',
+                             (self.get_room_id(name), self.get_client_id(login)))
+        self._written()
+
+    def del_room_member(self, name: str, login: str):
+        self._cursor.execute('DELETE FROM `RoomMembers` WHERE `room_id` == ? AND `client_id` == ?',
+                             (self.get_room_id(name), self.get_client_id(login)))
+        self._written()
+
+    def get_room_members(self, name: str) -> list:
+        """ Returns logins of all room members """
+        result = self._select(
+            '''
+            SELECT `Clients`.`login` FROM `RoomMembers`
+            JOIN `Rooms` ON `Rooms`.`id` == `RoomMembers`.`room_id`
+            JOIN `Clients` ON `Clients`.`id` == `RoomMembers`.`client_id`
+            WHERE `Rooms`.`name` == ?
+            ''', (name,)
+        )
+        return [item[0] for item in result]
+
+
+class DBPresenceDirectory(DBStorage):
+    """
+    Which server worker process holds sessions of which client.
+    Shared by all workers of the cluster through the server database file.
+    """
+    def __init__(self, database, check_same_thread=True, wal=False):
+        super().__init__(database, check_same_thread, wal)
+        self._migrate(SERVER_MIGRATIONS)
+
+    def add_session(self, login: str, worker_id: int):
+        self._cursor.execute(
+            '''
+            INSERT INTO `Presence` VALUES (?, ?, 1)
+            ON CONFLICT(`login`, `worker_id`) DO UPDATE SET `sessions` = `sessions` + 1
+            ''', (login, worker_id)
+        )
+        self._conn.commit()
+
+    def remove_session(self, login: str, worker_id: int):
+        self._cursor.execute(
+            'UPDATE `Presence` SET `sessions` = `sessions` - 1 WHERE `login` == ? AND `worker_id` == ?',
+            (login, worker_id)
+        )
+        self._cursor.execute('DELETE FROM `Presence` WHERE `login` == ? AND `worker_id` == ? AND `sessions` <= 0',
+                             (login, worker_id))
+        self._conn.commit()
+
+    def get_workers(self, login: str) -> list:
+        return [item[0] for item in self._select('SELECT `worker_id` FROM `Presence` WHERE `login` == ?', (login,))]
+
+    def count_sessions(self, login: str) -> int:
+        """ Sessions of client on all workers """
+        return int(self._select('SELECT TOTAL(`sessions`) FROM `Presence` WHERE `login` == ?', (login,))[0][0])
+
+    def clear_worker(self, worker_id: int):
+        self._cursor.execute('DELETE FROM `Presence` WHERE `worker_id` == ?', (worker_id,))
+        self._conn.commit()
+
+    def clear(self):
+        self._cursor.execute('DELETE FROM `Presence`')
+        self._conn.commit()
+
+
+class LockedStorage:
+    """
+    Lets several threads share one storage: its methods are called one at a time under a lock,
+    except concurrent read methods of storage, which may run in parallel with each other and with locked ones.
+    Storage must be created with check_same_thread=False.
+    """
+    def __init__(self, storage):
+        self._storage = storage
+        self._lock = Lock()
+        self._unlocked_methods = frozenset(getattr(storage, 'concurrent_read_methods', ()))
+
+    def __getattr__(self, name):
+        attribute = getattr(self._storage, name)
+        if not callable(attribute) or name in self._unlocked_methods:
+            return attribute
+
+        def locked_call(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return locked_call
+
 
 class DBStorageClient(DBStorage):
-    def __init__(self, database):
-        # connect to database, create it if not exists,
-        # create db schema if not exists (tables Contacts, Messages)
+    def __init__(self, database, schema_version=None):
+        # connect to database, create it if not exists, bring its schema up to date (tables Contacts, Messages)
         super().__init__(database)
-        self._cursor.executescript('''
-        CREATE TABLE IF NOT EXISTS `Contacts`(
-            `id`	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-            `login`	TEXT NOT NULL UNIQUE
-        );
-        ''')
         self._cursor.execute('PRAGMA foreign_keys = ON;')
-        self._cursor.executescript('''
-        CREATE TABLE IF NOT EXISTS `Messages` (
-            `id`	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-            `contact_id`	INTEGER NOT NULL,
-            `incoming`	INTEGER NOT NULL,
-            `text`	TEXT NOT NULL,
-            FOREIGN KEY(`contact_id`) REFERENCES `Contacts`(`id`) ON DELETE CASCADE
-        );
-        ''')
-        self._conn.commit()
+        self._migrate(CLIENT_MIGRATIONS, schema_version)
 
     def add_contact(self, login: str):
         self._cursor.execute('INSERT INTO `Contacts` VALUES(NULL, ?)', (login,))
@@ -181,10 +835,11 @@ class DBStorageClient(DBStorage):
         """
         If contact in client list, but not in server list - delete from client list
         If contact in server list, but not in client list - add to client list
+        Rooms are kept: they are chats of client, not contacts on server
         """
         client_contacts = self.get_contacts()
         for contact in client_contacts:
-            if contact not in server_contacts:
+            if contact not in server_contacts and not is_room_name(contact):
                 self.delete_contact(contact)
         for contact in server_contacts:
             if contact not in client_contacts:
@@ -0,0 +1,316 @@
+import logging
+import sqlite3
+import time
+from collections import deque
+from queue import Queue, Empty
+from threading import Event, Thread
+
+import helpers
+from jim import ROOM_PREFIX
+from storage import ServerStorage, DBStorageServer, DURABILITY_SYNC, DURABILITY_GROUP, FLUSH_INTERVAL, FLUSH_LIMIT
+
+STORAGE_SQLITE = 'sqlite'  # every call reads or writes database file
+STORAGE_MEMORY = 'memory'  # database file is read once at start, changes are never written to it
+STORAGE_HYBRID = 'hybrid'  # database file is read once at start, changes are written to it by background thread
+STORAGE_BACKENDS = [STORAGE_SQLITE, STORAGE_MEMORY, STORAGE_HYBRID]
+WRITE_QUEUE_LIMIT = 10000  # changes waiting for hybrid storage writer, further changes wait for queue to shrink
+
+log = logging.getLogger(helpers.SERVER_LOGGER_NAME)
+
+
+def create_server_storage(backend: str, database, check_same_thread=True, durability=DURABILITY_SYNC,
+                          wal=False) -> ServerStorage:
+    """ Returns storage of backend on database file, durability only applies to sqlite backend """
+    if backend == STORAGE_SQLITE:
+        return DBStorageServer(database, check_same_thread, durability=durability, wal=wal)
+    if backend == STORAGE_MEMORY:
+        return MemoryStorageServer(database)
+    if backend == STORAGE_HYBRID:
+        return HybridStorageServer(database, wal=wal)
+    raise ValueError(f'Unknown storage backend: {backend}, supported: {", ".join(STORAGE_BACKENDS)}')
+
+
+class ClientRecord:
+    __slots__ = ('id', 'login', 'info', 'last_connect_time', 'last_connect_ip')
+
+    def __init__(self, client_id: int, login: str, info: str, last_connect_time=None, last_connect_ip=None):
+        self.id = client_id
+        self.login = login
+        self.info = info
+        self.last_connect_time = last_connect_time
+        self.last_connect_ip = last_connect_ip
+
+
+class RoomRecord:
+    __slots__ = ('id', 'owner_id', 'members')
+
+    def __init__(self, room_id: int, owner_id: int):
+        self.id = room_id
+        self.owner_id = owner_id
+        self.members = {}  # client id -> None, in order of joining
+
+
+class MemoryStorageServer(ServerStorage):
+    """
+    All server data kept in dicts, every call is a few dict lookups.
+    If database is set, its contents are read at start, but changes are never written back, so they are lost
+    when server stops, and clients added to database by other processes (server GUI) are not seen until restart.
+    """
+    def __init__(self, database=None):
+        self._clients = {}  # login -> ClientRecord
+        self._logins = {}  # client id -> login
+        self._contacts = {}  # owner id -> {contact id: None}, in order of adding
+        self._offline_messages = {}  # recipient id -> deque of (time, frame), oldest first
+        self._rooms = {}  # name -> RoomRecord
+        self._last_client_id = 0
+        self._last_room_id = 0
+        if database is not None:
+            storage = DBStorageServer(database)
+            self._load(storage)
+            storage.close()
+
+    def _load(self, storage: DBStorageServer):
+        cursor = storage.cursor
+        for client_id, login, info, last_connect_time, last_connect_ip in cursor.execute(
+                'SELECT `id`, `login`, `info`, `last_connect_time`, `last_connect_ip` FROM `Clients`'):
+            self._clients[login] = ClientRecord(client_id, login, info, last_connect_time, last_connect_ip)
+            self._logins[client_id] = login
+            self._last_client_id = max(self._last_client_id, client_id)
+        for owner_id, contact_id in cursor.execute('SELECT `owner_id`, `contact_id` FROM `ClientContacts`'):
+            self._contacts.setdefault(owner_id, {})[contact_id] = None
+        for recipient_id, message_time, frame in cursor.execute(
+                'SELECT `recipient_id`, `time`, `frame` FROM `OfflineMessages` ORDER BY `id`'):
+            self._offline_messages.setdefault(recipient_id, deque()).append((message_time, frame))
+        room_names = {}
+        for room_id, name, owner_id in cursor.execute('SELECT `id`, `name`, `owner_id` FROM `Rooms`'):
+            self._rooms[name] = RoomRecord(room_id, owner_id)
+            room_names[room_id] = name
+            self._last_room_id = max(self._last_room_id, room_id)
+        for room_id, client_id in cursor.execute('SELECT `room_id`, `client_id` FROM `RoomMembers`'):
+            self._rooms[room_names[room_id]].members[client_id] = None
+
+    def _client(self, login: str) -> ClientRecord:
+        client = self._clients.get(login)
+        if client is None:
+            raise IndexError(f'No such client: {login}')
+        return client
+
+    def _room(self, name: str) -> RoomRecord:
+        room = self._rooms.get(name)
+        if room is None:
+            raise IndexError(f'No such room: {name}')
+        return room
+
+    def get_client_id(self, login: str):
+        return self._client(login).id
+
+    def get_client_login(self, client_id: int) -> str:
+        login = self._logins.get(client_id)
+        if login is None:
+            raise IndexError(f'No such client id: {client_id}')
+        return login
+
+    def get_clients(self):
+        clients = sorted(self._clients.values(), reverse=True,
+                         key=lambda client: (client.last_connect_time is not None, client.last_connect_time or 0))
+        return [(client.login, client.last_connect_time, client.last_connect_ip) for client in clients]
+
+    def get_client_hash(self, login: str) -> str:
+        return self._client(login).info
+
+    def check_client_exists(self, login: str) -> bool:
+        return login in self._clients
+
+    def add_client(self, login: str, password_hash: str):
+        if not login:
+            raise ValueError('login cannot be None or empty')
+        if login.startswith(ROOM_PREFIX):
+            raise ValueError(f'login cannot start with {ROOM_PREFIX}, such names are for rooms')
+        if not password_hash:
+            raise ValueError('password hash cannot be None or empty')
+        if login in self._clients:
+            raise RuntimeError(f'client with this login already exists: {login}')
+        self._last_client_id += 1
+        self._clients[login] = ClientRecord(self._last_client_id, login, password_hash)
+        self._logins[self._last_client_id] = login
+
+    def update_client(self, login: str, connection_time: float, connection_ip: str):
+        client = self._client(login)
+        client.last_connect_time = int(connection_time)  # time of request is a string, database column keeps integer
+        client.last_connect_ip = connection_ip
+
+    def check_client_in_contacts(self, owner_login: str, client_login: str) -> bool:
+        contacts = self._contacts.get(self.get_client_id(owner_login), {})
+        return self.get_client_id(client_login) in contacts
+
+    def add_client_to_contacts(self, owner_login: str, client_login: str):
+        contacts = self._contacts.setdefault(self.get_client_id(owner_login), {})
+        client_id = self.get_client_id(client_login)
+        if client_id in contacts:
+            raise RuntimeError(f'client is already in contacts: {client_login}')
+        contacts[client_id] = None
+
+    def del_client_from_contacts(self, owner_login: str, client_login: str):
+        self._contacts.get(self.get_client_id(owner_login), {}).pop(self.get_client_id(client_login), None)
+
+    def get_client_contacts(self, client_login: str, limit: int=None, after: str=None) -> list:
+        logins = [self._logins[contact_id] for contact_id in self._contacts.get(self.get_client_id(client_login), ())]
+        if limit is None and after is None:
+            return logins
+        after = after if after is not None else ''
+        page = sorted(login for login in logins if login > after)
+        return page if limit is None else page[:limit]
+
+    def add_offline_messages(self, logins: list, frame: bytes, queue_limit: int, ttl: float) -> list:
+        now = time.time()
+        frame = bytes(frame)
+        rejected = []
+        for login in logins:
+            queue = self._offline_messages.setdefault(self.get_client_id(login), deque())
+            while queue and queue[0][0] < now - ttl:
+                queue.popleft()
+            if len(queue) >= queue_limit:
+                rejected.append(login)
+                continue
+            queue.append((now, frame))
+        return rejected
+
+    def pop_offline_messages(self, login: str, ttl: float) -> list:
+        queue = self._offline_messages.pop(self.get_client_id(login), ())
+        oldest_time = time.time() - ttl
+        return [frame for message_time, frame in queue if message_time >= oldest_time]
+
+    def get_room_id(self, name: str):
+        room = self._rooms.get(name)
+        return room.id if room is not None else None
+
+    def add_room(self, name: str, owner_login: str):
+        if not name:
+            raise ValueError('room name cannot be None or empty')
+        if name in self._rooms:
+            raise RuntimeError(f'room with this name already exists: {name}')
+        owner_id = self.get_client_id(owner_login)
+        self._last_room_id += 1
+        room = RoomRecord(self._last_room_id, owner_id)
+        room.members[owner_id] = None
+        self._rooms[name] = room
+
+    def check_client_in_room(self, name: str, login: str) -> bool:
+        room = self._rooms.get(name)
+        client = self._clients.get(login)
+        return room is not None and client is not None and client.id in room.members
+
+    def add_room_member(self, name: str, login: str):
+        room = self._room(name)
+        client_id = self.get_client_id(login)
+        if client_id in room.members:
+            raise RuntimeError(f'client is already a member of room {name}: {login}')
+        room.members[client_id] = None
+
+    def del_room_member(self, name: str, login: str):
+        self._room(name).members.pop(self.get_client_id(login), None)
+
+    def get_room_members(self, name: str) -> list:
+        room = self._rooms.get(name)
+        return [self._logins[client_id] for client_id in room.members] if room is not None else []
+
+
+class HybridStorageServer(MemoryStorageServer):
+    """
+    Memory storage read from database at start, whose changes are also written to database by background thread.
+    Reads never wait for database. Writes are queued and applied by writer thread with group commit,
+    so changes made less than flush_interval before a crash are lost. flush() waits until queue is written.
+    When writer falls behind by write_queue_limit changes, writes wait for it.
+    Like memory storage, it does not see clients added to database by other processes until restart.
+    """
+    def __init__(self, database, flush_interval=FLUSH_INTERVAL, flush_limit=FLUSH_LIMIT, wal=False,
+                 write_queue_limit=WRITE_QUEUE_LIMIT):
+        super().__init__(database)
+        self._writes = Queue(write_queue_limit)  # (method name, args) of DBStorageServer, flush events or QUEUE_STOP
+        self._write_errors = 0
+        self._writer = Thread(target=self._writer_thread_function,
+                              args=(database, flush_interval, flush_limit, wal), daemon=True)
+        self._writer.start()
+
+    def _writer_thread_function(self, database, flush_interval: float, flush_limit: int, wal: bool):
+        storage = DBStorageServer(database, durability=DURABILITY_GROUP, flush_interval=flush_interval,
+                                  flush_limit=flush_limit, wal=wal)
+        while True:
+            try:
+                item = self._writes.get(timeout=flush_interval)
+            except Empty:
+                storage.flush_if_due()
+                continue
+            if item is helpers.QUEUE_STOP:
+                storage.close()
+                return
+            if isinstance(item, Event):
+                storage.flush()
+                item.set()
+                continue
+            name, args = item
+            try:
+                getattr(storage, name)(*args)
+            except (sqlite3.Error, IndexError, RuntimeError, ValueError) as e:
+                self._write_errors += 1
+                log.error(f'Storage change {name}{args} was not written to database: {e}')
+            storage.flush_if_due()
+
+    def _queue_write(self, name: str, *args):
+        self._writes.put((name, args))
+
+    @property
+    def write_stats(self) -> dict:
+        return {'queued_changes': self._writes.qsize(), 'write_errors': self._write_errors}
+
+    def flush(self):
+        if not self._writer.is_alive():
+            return
+        written = Event()
+        self._writes.put(written)
+        written.wait()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._writes.put(helpers.QUEUE_STOP)
+            self._writer.join()
+
+    def add_client(self, login: str, password_hash: str):
+        super().add_client(login, password_hash)
+        self._queue_write('add_client', login, password_hash)
+
+    def update_client(self, login: str, connection_time: float, connection_ip: str):
+        super().update_client(login, connection_time, connection_ip)
+        self._queue_write('update_client', login, connection_time, connection_ip)
+
+    def add_client_to_contacts(self, owner_login: str, client_login: str):
+        super().add_client_to_contacts(owner_login, client_login)
+        self._queue_write('add_client_to_contacts', owner_login, client_login)
+
+    def del_client_from_contacts(self, owner_login: str, client_login: str):
+        super().del_client_from_contacts(owner_login, client_login)
+        self._queue_write('del_client_from_contacts', owner_login, client_login)
+
+    def add_offline_messages(self, logins: list, frame: bytes, queue_limit: int, ttl: float) -> list:
+        rejected = super().add_offline_messages(logins, frame, queue_limit, ttl)
+        rejected_logins = set(rejected)
+        accepted = [login for login in logins if login not in rejected_logins]
+        self._queue_write('add_offline_messages', accepted, bytes(frame), queue_limit, ttl)
+        return rejected
+
+    def pop_offline_messages(self, login: str, ttl: float) -> list:
+        frames = super().pop_offline_messages(login, ttl)
+        self._queue_write('pop_offline_messages', login, ttl)
+        return frames
+
+    def add_room(self, name: str, owner_login: str):
+        super().add_room(name, owner_login)
+        self._queue_write('add_room', name, owner_login)
+
+    def add_room_member(self, name: str, login: str):
+        super().add_room_member(name, login)
+        self._queue_write('add_room_member', name, login)
+
+    def del_room_member(self, name: str, login: str):
+        super().del_room_member(name, login)
+        self._queue_write('del_room_member', name, login)
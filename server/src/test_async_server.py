@@ -0,0 +1,85 @@
+import asyncio
+import os
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF
+
+import pytest
+
+from async_server import AsyncServer
+from storage import DBStorageServer
+from jim import presence_request, response_from_bytes, JimStreamDecoder, message_request
+import helpers
+import test_server
+
+
+class TestAsyncServer:
+    test_login = 'TestLogin'
+    test_hash = 'cafebeef'
+
+    @pytest.fixture(autouse=True)
+    def server(self, tmp_path):
+        storage_file = os.path.join(str(tmp_path), 'server.sqlite')
+        DBStorageServer(storage_file).add_client(self.test_login, self.test_hash)
+        self.server = AsyncServer('127.0.0.1', 0, storage_file)
+        self.server.start()
+        yield self.server
+        self.server.close_server()
+
+    def request(self, message):
+        with socket(AF_INET, SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(self.server.address)
+            sock.send(message.to_frame())
+            decoder = JimStreamDecoder(response_from_bytes)
+            while True:
+                responses = decoder.feed(sock.recv(helpers.TCP_MSG_BUFFER_SIZE))
+                if responses:
+                    return responses[0]
+
+    def test__start__already_started__raises(self):
+        with pytest.raises(RuntimeError):
+            self.server.start()
+
+    def test__presence__unknown_client__error_400(self):
+        response = self.request(presence_request('UnknownLogin'))
+        assert response.response == 400
+
+    def test__presence__known_client__auth_required_401(self):
+        response = self.request(presence_request(self.test_login))
+        assert response.response == 401
+        assert response.datadict['token']
+
+    def test__close_server__not_running__raises(self):
+        test_server = AsyncServer('127.0.0.1', 0, ':memory:')
+        with pytest.raises(RuntimeError):
+            test_server.close_server()
+
+    def test__handle_connection__task_cancelled__cancellation_propagates(self):
+        test_server = AsyncServer('127.0.0.1', 0, ':memory:')
+        server_sock, client_sock = socketpair()
+
+        async def cancel_connection_task() -> bool:
+            reader, writer = await asyncio.open_connection(sock=server_sock)
+            task = asyncio.create_task(test_server.handle_connection(reader, writer))
+            await asyncio.sleep(0.05)  # task waits for data
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return task.cancelled()
+        try:
+            assert asyncio.run(cancel_connection_task())
+        finally:
+            client_sock.close()
+
+
+class TestAsyncServerRequests(test_server.TestServerRequests):
+    server_class = AsyncServer
+
+    def test__msg__many_relayed_to_slow_reader__frames_not_corrupted(self):
+        receiver = self.connect()
+        receiver.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 4096)
+        assert receiver.login(self.test_logins[1], self.test_hash).response == 200
+        sender = self.connect(self.test_logins[0])
+        texts = [f'message {i} ' + str(i) * 500 for i in range(200)]
+        sender.socket.sendall(b''.join(message_request(self.test_logins[0], self.test_logins[1], text).to_frame()
+                                       for text in texts))  # decoder buffer holds many frames at once
+        assert [sender.receive().response for _ in texts] == [200] * len(texts)
+        assert [receiver.receive().datadict['message'] for _ in texts] == texts
@@ -0,0 +1,50 @@
+import pytest
+
+from benchmarks import BENCHMARKS, RESULTS_FORMAT, benchmark, compare_results, run_benchmarks
+
+
+def results(**seconds_per_op) -> dict:
+    return {'format': RESULTS_FORMAT, 'results': {name: {'seconds_per_op': value}
+                                                 for name, value in seconds_per_op.items()}}
+
+
+def test__benchmark__name_already_registered__raises():
+    with pytest.raises(RuntimeError):
+        benchmark('jim.to_bytes')(lambda: None)
+
+
+def test__compare_results__slowdown_over_threshold__regression():
+    comparison = compare_results(results(fast=1.0, slow=1.0, same=1.0, new=1.0),
+                                 results(fast=0.5, slow=1.5, same=1.05, added=1.0), threshold=0.1)
+    assert {item['name']: item['status'] for item in comparison} == \
+        {'fast': 'improvement', 'slow': 'regression', 'same': 'same'}
+
+
+def test__compare_results__unknown_format__raises():
+    with pytest.raises(ValueError):
+        compare_results({'format': RESULTS_FORMAT + 1, 'results': {}}, results())
+
+
+def test__run_benchmarks__storage_benchmarks_run_for_every_rows_count(tmp_path):
+    report = run_benchmarks([10, 20], name_filter='get_client_id', repeat=1, work_dir=str(tmp_path))
+    assert report['format'] == RESULTS_FORMAT
+    assert set(report['results']) == {'storage.server.get_client_id[rows=10]', 'storage.server.get_client_id[rows=20]'}
+    assert all(result['seconds_per_op'] > 0 for result in report['results'].values())
+
+
+def test__run_benchmarks__get_client_login__login_of_existing_client_read(tmp_path):
+    report = run_benchmarks([10], name_filter='get_client_login', repeat=1, work_dir=str(tmp_path))
+    assert set(report['results']) == {'storage.server.get_client_login[rows=10]'}
+
+
+def test__run_benchmarks__max_rows_exceeded__skipped(tmp_path):
+    _, _, max_rows = BENCHMARKS['storage.client.update_contacts']
+    report = run_benchmarks([max_rows + 1], name_filter='update_contacts', repeat=1, work_dir=str(tmp_path))
+    assert report['results'] == {}
+
+
+def test__run_benchmarks__hybrid_storage__server_benchmarks_run(tmp_path):
+    report = run_benchmarks([200], name_filter='storage.server.', repeat=1, work_dir=str(tmp_path),
+                            storage_backend='hybrid')
+    assert report['storage_backend'] == 'hybrid'
+    assert 'storage.server.get_room_members[rows=200]' in report['results']
@@ -0,0 +1,148 @@
+import os
+import time
+from socket import socket, socketpair, create_connection, AF_INET, SOCK_STREAM
+
+import pytest
+
+from cluster import ClusterRouter, ClusterServer, RemoteSession
+from sessions import Session
+from storage import DBStorageServer
+from jim import message_request, presence_request, auth_client_message, stats_request
+from security import create_auth_digest
+import test_server
+
+
+class TestClusterRouter:
+    test_login = 'TestLogin'
+
+    @pytest.fixture(autouse=True)
+    def routers(self, tmp_path):
+        storage_file = os.path.join(str(tmp_path), 'server.sqlite')
+        self.routers = [ClusterRouter(worker_id, str(tmp_path), storage_file) for worker_id in range(2)]
+        for router in self.routers:
+            router.open()
+        self.registries = [router.create_registry() for router in self.routers]
+        yield self.routers
+        for router in self.routers:
+            router.close()
+
+    def add_local_session(self, worker_id):
+        server_socket, client_socket = socketpair()
+        session = Session(server_socket, ('1.2.3.4', 5555))
+        self.registries[worker_id].add(session)
+        self.registries[worker_id].bind_login(session, self.test_login)
+        return session, client_socket
+
+    def test__get_sessions__client_on_other_worker__remote_session(self):
+        self.add_local_session(1)
+        assert self.registries[0].is_online(self.test_login)
+        sessions = self.registries[0].get_sessions(self.test_login)
+        assert len(sessions) == 1 and isinstance(sessions[0], RemoteSession)
+
+    def test__get_sessions__client_not_online_anywhere__empty(self):
+        assert self.registries[0].get_sessions(self.test_login) == []
+        assert not self.registries[0].is_online(self.test_login)
+
+    def test__count_sessions__sessions_on_both_workers__all_counted(self):
+        for worker_id in [0, 1, 1]:
+            self.add_local_session(worker_id)
+        assert self.registries[0].count_sessions(self.test_login) == 3
+        assert len(self.registries[0].get_sessions(self.test_login)) == 2  # local one and remote worker
+
+    def test__remove__client_disconnected_from_other_worker__not_online(self):
+        session, client_socket = self.add_local_session(1)
+        self.registries[1].remove(session)
+        client_socket.close()
+        assert not self.registries[0].is_online(self.test_login)
+
+    def test__remote_session_send__message_delivered_to_other_worker_client(self):
+        session, client_socket = self.add_local_session(1)
+        frame = message_request('Sender', self.test_login, 'text').to_frame()
+        second_session, second_client_socket = self.add_local_session(1)
+        assert self.registries[0].get_sessions(self.test_login)[0].send(frame)
+        self.routers[1].receive(self.registries[1])
+        with client_socket, second_client_socket:
+            assert client_socket.recv(len(frame)) == frame
+            assert second_client_socket.recv(len(frame)) == frame
+
+
+class TestClusterServer(test_server.TestServerRequests):
+    workers = 2
+
+    @pytest.fixture(autouse=True)
+    def server(self, tmp_path):
+        self.storage_file = os.path.join(str(tmp_path), 'server.sqlite')
+        storage = DBStorageServer(self.storage_file)
+        for login in self.test_logins:
+            storage.add_client(login, self.test_hash)
+        with socket(AF_INET, SOCK_STREAM) as free_port_socket:
+            free_port_socket.bind(('127.0.0.1', 0))
+            self.address = free_port_socket.getsockname()
+        self.server = ClusterServer(self.address[0], self.address[1], self.storage_file, self.workers)
+        self.server.start()
+        self.clients = []
+        yield self.server
+        for client in self.clients:
+            client.close()
+        self.server.close_server()
+
+    def connect(self, login=None):
+        client = test_server.JimTestClient(self.address)
+        self.clients.append(client)
+        if login is not None:
+            for _ in range(50):  # previous connection of this login may still be closing on another worker
+                response = client.request(presence_request(login))
+                if response.response == 401:
+                    break
+                time.sleep(0.05)
+            digest = create_auth_digest(self.test_hash, response.datadict['token'])
+            assert client.request(auth_client_message(login, digest)).response == 200
+        return client
+
+    def test__msg__many_connections_spread_over_workers__all_messages_delivered(self):
+        receivers = [self.connect(login) for login in self.test_logins[1:]]
+        for _ in range(5):
+            sender = self.connect(self.test_logins[0])
+            for login in self.test_logins[1:]:
+                assert sender.request(message_request(self.test_logins[0], login, 'text')).response == 200
+            sender.close()
+            self.clients.remove(sender)
+        for receiver in receivers:
+            for _ in range(5):
+                assert receiver.receive().datadict['message'] == 'text'
+
+    def test__dispatcher__handled_actions_timed(self):
+        # dispatcher of every worker process keeps its own stats, get_stats returns them for worker of connection
+        client = self.connect(self.test_logins[0])
+        actions = client.request(stats_request()).datadict['stats']['actions']
+        assert actions['presence']['calls'] >= 1
+        assert actions['authenticate']['calls'] >= 1
+
+
+def get_free_ports(count: int) -> int:
+    """ Returns the first of count consecutive free local tcp ports """
+    while True:
+        with socket(AF_INET, SOCK_STREAM) as first_socket:
+            first_socket.bind(('127.0.0.1', 0))
+            first_port = first_socket.getsockname()[1]
+            try:
+                for port in range(first_port + 1, first_port + count):
+                    with socket(AF_INET, SOCK_STREAM) as port_socket:
+                        port_socket.bind(('127.0.0.1', port))
+            except OSError:
+                continue
+        return first_port
+
+
+def test__cluster_server__metrics_port__every_worker_serves_metrics_on_own_port(tmp_path):
+    storage_file = os.path.join(str(tmp_path), 'server.sqlite')
+    metrics_port = get_free_ports(2)
+    server = ClusterServer('127.0.0.1', get_free_ports(1), storage_file, workers=2, metrics_port=metrics_port)
+    server.start()
+    try:
+        for port in (metrics_port, metrics_port + 1):
+            with create_connection(('127.0.0.1', port), timeout=5) as conn:
+                text = b''.join(iter(lambda: conn.recv(4096), b'')).decode()
+            assert '# TYPE messenger_connections gauge' in text
+    finally:
+        server.close_server()
@@ -0,0 +1,49 @@
+from threading import Event, Lock
+import time
+
+import pytest
+
+from handler_pool import OrderedThreadPool
+
+
+class TestOrderedThreadPool:
+    def setup_method(self):
+        self.pool = OrderedThreadPool(4)
+        self.results = {}
+        self.lock = Lock()
+
+    def teardown_method(self):
+        self.pool.shutdown()
+
+    def record(self, key, value, done=None):
+        with self.lock:
+            self.results.setdefault(key, []).append(value)
+        if done is not None:
+            done.set()
+
+    def test__init__no_threads__raises(self):
+        with pytest.raises(ValueError):
+            OrderedThreadPool(0)
+
+    def test__submit__same_key__tasks_run_in_submission_order(self):
+        done = Event()
+        for value in range(1000):
+            self.pool.submit('key', self.record, 'key', value, done if value == 999 else None)
+        assert done.wait(5)
+        assert self.results['key'] == list(range(1000))
+
+    def test__submit__task_of_one_key_blocked__other_keys_run(self):
+        blocker, done = Event(), Event()
+        self.pool.submit('slow', blocker.wait, 5)
+        self.pool.submit('slow', self.record, 'slow', 1)
+        self.pool.submit('fast', self.record, 'fast', 1, done)
+        assert done.wait(5)
+        assert 'slow' not in self.results
+        blocker.set()
+
+    def test__submit__task_raises__next_task_of_key_runs(self):
+        done = Event()
+        self.pool.submit('key', time.sleep, 'not a number')
+        self.pool.submit('key', self.record, 'key', 1, done)
+        assert done.wait(5)
+        assert self.results['key'] == [1]
@@ -0,0 +1,72 @@
+import pytest
+
+from handlers import ActionDispatcher, RequestContext, default_dispatcher, handle_get_stats, handle_get_contacts
+from jim import JimRequest, JimResponse, stats_request, get_contacts_request
+from sessions import Session, SessionRegistry
+
+
+class TestActionDispatcher:
+    def setup_method(self):
+        self.dispatcher = ActionDispatcher()
+        self.context = RequestContext(None, None, None)
+
+    def test__register__handler_called_with_request_and_context(self):
+        calls = []
+
+        @self.dispatcher.register('test_action')
+        def handler(request, context):
+            calls.append((request, context))
+            return [JimResponse(200)]
+
+        request = JimRequest('test_action')
+        assert self.dispatcher.dispatch(request, self.context) == [JimResponse(200)]
+        assert calls == [(request, self.context)]
+
+    def test__dispatch__request_with_id__id_copied_to_responses(self):
+        self.dispatcher.register('test_action', lambda request, context: [JimResponse(200), JimResponse(202)])
+        request = JimRequest('test_action')
+        request.request_id = 5
+        assert [resp.request_id for resp in self.dispatcher.dispatch(request, self.context)] == [5, 5]
+
+    def test__dispatch__unknown_action__raises(self):
+        with pytest.raises(RuntimeError):
+            self.dispatcher.dispatch(JimRequest('unknown'), self.context)
+
+    def test__dispatch__timing_on__stats_collected(self):
+        self.dispatcher.register('test_action', lambda request, context: [])
+        for _ in range(3):
+            self.dispatcher.dispatch(JimRequest('test_action'), self.context)
+        stats = self.dispatcher.stats['test_action']
+        assert stats['calls'] == 3
+        assert stats['max_time'] <= stats['total_time']
+
+    def test__dispatch__timing_off__no_stats(self):
+        self.dispatcher.timing = False
+        self.dispatcher.register('test_action', lambda request, context: [])
+        self.dispatcher.dispatch(JimRequest('test_action'), self.context)
+        assert self.dispatcher.stats == {}
+
+    def test__unregister__action_not_handled(self):
+        self.dispatcher.register('test_action', lambda request, context: [])
+        self.dispatcher.unregister('test_action')
+        assert 'test_action' not in self.dispatcher.actions()
+
+
+def test__default_dispatcher__all_jim_actions_registered():
+    actions = default_dispatcher().actions()
+    for action in ['presence', 'authenticate', 'add_contact', 'del_contact', 'get_contacts', 'msg',
+                   'create_room', 'join_room', 'leave_room', 'get_stats']:
+        assert action in actions
+
+
+def test__get_stats__not_local_connection__error_403():
+    session = Session(object(), ('1.2.3.4', 5555))
+    responses = handle_get_stats(stats_request(), RequestContext(session, SessionRegistry(), None))
+    assert [resp.response for resp in responses] == [403]
+
+
+@pytest.mark.parametrize('limit, cursor', [('5', None), ([1], None), (True, None), (2.5, None), (2, 5), (None, ['a'])])
+def test__get_contacts_batch__malformed_limit_or_cursor__error_400(limit, cursor):
+    request = get_contacts_request(batch=True, limit=limit, cursor=cursor)
+    responses = handle_get_contacts(request, RequestContext(Session(object(), ('127.0.0.1', 5555)), None, None))
+    assert [resp.response for resp in responses] == [400]
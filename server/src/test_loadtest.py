@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from loadtest import parse_mix, percentile, plan_traffic, run_load_test, PERCENTILES
+
+
+def test__percentile__nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99.9) == 100
+    assert percentile([7], 50) == 7
+    assert percentile([], 50) is None
+
+
+def test__parse_mix__weights_parsed():
+    assert parse_mix('msg=3, get_contacts=1') == {'msg': 3.0, 'get_contacts': 1.0}
+
+
+@pytest.mark.parametrize('mix', ['unknown=1', 'msg=0', 'msg=-1,add_contact=2'])
+def test__parse_mix__incorrect_mix__raises(mix):
+    with pytest.raises(ValueError):
+        parse_mix(mix)
+
+
+def test__plan_traffic__targets_are_other_clients_and_contacts_added_once():
+    logins = ['Login0', 'Login1', 'Login2']
+    plan = plan_traffic(0, logins, 100, {'msg': 1, 'add_contact': 1}, random.Random(1))
+    assert len(plan) == 100
+    assert all(target != 'Login0' for _, target in plan)
+    assert sorted(target for action, target in plan if action == 'add_contact') == ['Login1', 'Login2']
+
+
+@pytest.mark.parametrize('engine, durability, storage_backend', [
+    ('selectors', 'sync', 'sqlite'), ('async', 'sync', 'sqlite'), ('selectors', 'group', 'sqlite'),
+    ('selectors', 'sync', 'memory'), ('async', 'sync', 'hybrid')])
+def test__run_load_test__report_has_percentiles_and_no_errors(engine, durability, storage_backend):
+    report = run_load_test(clients=10, requests=20, engine=engine, seed=1, durability=durability,
+                           storage_backend=storage_backend)
+    assert report['settings']['engine'] == engine
+    assert report['settings']['durability'] == durability
+    assert report['settings']['storage_backend'] == storage_backend
+    assert report['traffic']['requests'] == 10 * 20
+    assert report['traffic']['throughput'] > 0
+    assert set(report['login']['actions']) == {'presence', 'authenticate'}
+    for stats in report['traffic']['actions'].values():
+        assert stats['errors'] == 0
+        assert all(stats[f'{name}_ms'] is not None for name in PERCENTILES)
@@ -0,0 +1,60 @@
+from socket import socketpair
+
+from handlers import ActionDispatcher, RequestContext
+from jim import JimRequest
+from metrics import LatencyHistogram, ServerMetrics, format_metrics_text
+from sessions import Session, SessionRegistry
+
+
+def test__latency_histogram__durations_counted_in_buckets():
+    histogram = LatencyHistogram((0.1, 1.0))
+    for duration in (0.05, 0.1, 0.5, 2.0):
+        histogram.add(duration)
+    assert histogram.as_dict() == {'bounds': [0.1, 1.0], 'counts': [2, 1, 1]}
+
+
+class TestServerMetrics:
+    def setup_method(self):
+        self.dispatcher = ActionDispatcher()
+        self.dispatcher.register('test_action', lambda request, context: [])
+        self.metrics = ServerMetrics(self.dispatcher)
+        self.sessions = SessionRegistry()
+        self.sockets = socketpair()
+        self.session = Session(self.sockets[0], ('127.0.0.1', 5555))
+        self.sessions.add(self.session)
+
+    def teardown_method(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def test__snapshot__counters_gauges_and_actions(self):
+        self.metrics.increment('auth_successes')
+        self.metrics.add_gauge('test_gauge', lambda: 7)
+        self.metrics.add_gauge_group('test_group', lambda: {'hits': 3})
+        self.sessions.bind_login(self.session, 'TestLogin')
+        self.session.send(b'data')
+        self.dispatcher.dispatch(JimRequest('test_action'), RequestContext(self.session, self.sessions, None))
+        snapshot = self.metrics.snapshot(self.sessions)
+        assert snapshot['counters']['auth_successes'] == 1
+        assert snapshot['counters']['bytes_out'] == 4
+        assert snapshot['gauges']['connections'] == 1
+        assert snapshot['gauges']['authenticated_clients'] == 1
+        assert snapshot['gauges']['test_gauge'] == 7
+        assert snapshot['gauges']['test_group_hits'] == 3
+        assert sum(snapshot['actions']['test_action']['histogram']['counts']) == 1
+
+    def test__session_closed__traffic_kept_in_counters(self):
+        self.session.send(b'data')
+        self.sessions.remove(self.session)
+        self.metrics.session_closed(self.session)
+        counters = self.metrics.snapshot(self.sessions)['counters']
+        assert counters['connections_closed'] == 1
+        assert counters['bytes_out'] == 4
+
+    def test__format_metrics_text__counters_gauges_and_cumulative_buckets(self):
+        self.dispatcher.dispatch(JimRequest('test_action'), RequestContext(self.session, self.sessions, None))
+        text = format_metrics_text(self.metrics.snapshot(self.sessions), 'test')
+        assert 'test_connections_opened_total 0\n' in text
+        assert 'test_connections 1\n' in text
+        assert 'test_action_latency_seconds_bucket{action="test_action",le="+Inf"} 1\n' in text
+        assert 'test_action_latency_seconds_count{action="test_action"} 1\n' in text
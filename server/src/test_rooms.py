@@ -0,0 +1,43 @@
+from rooms import RoomMembersCache
+
+
+class CountingStorage:
+    def __init__(self, members: dict):
+        self.members = members
+        self.queries = 0
+
+    def get_room_members(self, room: str) -> list:
+        self.queries += 1
+        return self.members.get(room, [])
+
+
+class TestRoomMembersCache:
+    test_room = '#test_room'
+
+    def setup_method(self):
+        self.storage = CountingStorage({self.test_room: ['TestLogin1']})
+        self.cache = RoomMembersCache()
+
+    def test__get_members__loaded_once(self):
+        for _ in range(3):
+            assert self.cache.get_members(self.storage, self.test_room) == {'TestLogin1'}
+        assert self.storage.queries == 1
+
+    def test__add_and_remove_member__cached_room_updated(self):
+        self.cache.get_members(self.storage, self.test_room)
+        self.cache.add_member(self.test_room, 'TestLogin2')
+        assert self.cache.get_members(self.storage, self.test_room) == {'TestLogin1', 'TestLogin2'}
+        self.cache.remove_member(self.test_room, 'TestLogin1')
+        assert self.cache.get_members(self.storage, self.test_room) == {'TestLogin2'}
+        assert self.storage.queries == 1
+
+    def test__get_members__unknown_room__not_cached(self):
+        assert self.cache.get_members(self.storage, '#unknown_room') == frozenset()
+        self.storage.members['#unknown_room'] = ['TestLogin1']
+        assert self.cache.get_members(self.storage, '#unknown_room') == {'TestLogin1'}
+
+    def test__get_members__disabled__storage_read_every_time(self):
+        cache = RoomMembersCache(enabled=False)
+        for _ in range(3):
+            cache.get_members(self.storage, self.test_room)
+        assert self.storage.queries == 3
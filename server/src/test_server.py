@@ -1,7 +1,20 @@
+import os
+import time
+from socket import create_connection
+from functools import partial
+from threading import Event
+import selectors
+
 import pytest
 
 from server import parse_commandline_args, Server
-from helpers import DEFAULT_SERVER_PORT
+from helpers import DEFAULT_SERVER_PORT, MAX_SESSIONS_PER_LOGIN
+from storage import DBStorageServer, DURABILITY_GROUP
+from storage_backends import STORAGE_MEMORY, STORAGE_HYBRID
+from security import create_password_hash, create_auth_digest
+from jim import JimStreamDecoder, JimRequest, JimResponse, response_from_bytes, presence_request, auth_client_message, \
+    add_contact_request, get_contacts_request, message_request, create_room_request, join_room_request, \
+    leave_room_request, stats_request, frame_bytes, FEATURE_CONTACTS_BATCH, FEATURE_REQUEST_ID
 
 
 # tests for: parse_commandline_args
@@ -38,6 +51,18 @@ def test_unknown_args__raises():
         parse_commandline_args(['-z', 'zzz'])
 
 
+def test_workers_arg_set__workers_count_set():
+    assert parse_commandline_args([]).workers == 0
+    assert parse_commandline_args(['-c', '4']).workers == 4
+
+
+def test_workers_arg_set_with_memory_storage_or_group_durability__raises():
+    with pytest.raises(SystemExit):
+        parse_commandline_args(['-c', '4', '-s', STORAGE_MEMORY])
+    with pytest.raises(SystemExit):
+        parse_commandline_args(['-c', '4', '-d', DURABILITY_GROUP])
+
+
 class TestServer:
     def test__init__no_errors(self):
         Server(':memory:')
@@ -45,3 +70,341 @@ class TestServer:
     def test__set_settings__correct_settings_no_errors(self):
         test_server = Server(':memory:')
         test_server.set_settings('', int(test_port), clients_limit=1000, timeout=1)
+
+    def test__metrics_port__metrics_text_served(self):
+        test_server = Server('127.0.0.1', 0, ':memory:', metrics_port=0)
+        test_server.start()
+        try:
+            client = JimTestClient(test_server.address)
+            client.request(presence_request('TestLogin'))  # answered, so connection is accepted and counted
+            client.close()
+            with create_connection(test_server.metrics_address, timeout=5) as conn:
+                text = b''.join(iter(lambda: conn.recv(4096), b'')).decode()
+        finally:
+            test_server.close_server()
+        assert 'messenger_connections_opened_total 1\n' in text
+        assert '# TYPE messenger_connections gauge' in text
+
+
+class JimTestClient:
+    """ Minimal blocking JIM client for server tests """
+    def __init__(self, address):
+        self.socket = create_connection(address, timeout=5)
+        self.decoder = JimStreamDecoder(response_from_bytes)
+        self.received = []
+
+    def close(self):
+        self.socket.close()
+
+    def receive(self):
+        while not self.received:
+            self.received += self.decoder.recv_into(self.socket)
+        return self.received.pop(0)
+
+    def request(self, message):
+        self.socket.sendall(message.to_frame())
+        return self.receive()
+
+    def login(self, login, password_hash):
+        response = self.request(presence_request(login))
+        assert response.response == 401
+        digest = create_auth_digest(password_hash, response.datadict['token'])
+        return self.request(auth_client_message(login, digest))
+
+
+class TestServerRequests:
+    test_hash = create_password_hash('TestPassword')
+    test_logins = ['TestLogin1', 'TestLogin2', 'TestLogin3', 'TestLogin4']
+    server_class = Server
+
+    @pytest.fixture(autouse=True)
+    def server(self, tmp_path):
+        self.storage_file = os.path.join(str(tmp_path), 'server.sqlite')
+        storage = DBStorageServer(self.storage_file)
+        for login in self.test_logins:
+            storage.add_client(login, self.test_hash)
+        self.server = self.server_class('127.0.0.1', 0, self.storage_file)
+        self.server.start()
+        self.clients = []
+        yield self.server
+        for client in self.clients:
+            client.close()
+        self.server.close_server()
+
+    def connect(self, login=None):
+        client = JimTestClient(self.server.address)
+        self.clients.append(client)
+        if login is not None:
+            assert client.login(login, self.test_hash).response == 200
+        return client
+
+    def add_offline_room_member(self, room, login):
+        """ Adds to room a client which is not online, as if it joined while online before """
+        DBStorageServer(self.storage_file).add_room_member(room, login)
+
+    def join_room_and_disconnect(self, room, login):
+        """ Adds offline room member through server, for storages which do not see changes of other connections """
+        observer = self.connect()
+        online_clients = observer.request(stats_request()).datadict['stats']['gauges']['authenticated_clients']
+        member = self.connect(login)
+        assert member.request(join_room_request(room)).response == 200
+        member.close()
+        for _ in range(50):
+            stats = observer.request(stats_request()).datadict['stats']
+            if stats['gauges']['authenticated_clients'] == online_clients:
+                break
+            time.sleep(0.05)
+        assert stats['gauges']['authenticated_clients'] == online_clients
+
+    def test__authenticate__wrong_password__error_402(self):
+        client = self.connect()
+        response = client.request(presence_request(self.test_logins[0]))
+        digest = create_auth_digest(create_password_hash('WrongPassword'), response.datadict['token'])
+        assert client.request(auth_client_message(self.test_logins[0], digest)).response == 402
+
+    def test__presence__sessions_limit_reached__error_400(self):
+        for _ in range(MAX_SESSIONS_PER_LOGIN):
+            self.connect(self.test_logins[0])
+        response = self.connect().request(presence_request(self.test_logins[0]))
+        assert response.response == 400
+
+    def test__msg__target_has_several_sessions__delivered_to_all(self):
+        sender = self.connect(self.test_logins[0])
+        receivers = [self.connect(self.test_logins[1]) for _ in range(3)]
+        assert sender.request(message_request(self.test_logins[0], self.test_logins[1], 'hello')).response == 200
+        for receiver in receivers:
+            assert receiver.receive().datadict['message'] == 'hello'
+        receivers[0].close()
+        self.clients.remove(receivers[0])
+        assert sender.request(message_request(self.test_logins[0], self.test_logins[1], 'again')).response == 200
+        for receiver in receivers[1:]:
+            assert receiver.receive().datadict['message'] == 'again'
+
+    def test__add_contact_then_get_contacts__contact_returned(self):
+        client = self.connect(self.test_logins[0])
+        assert client.request(add_contact_request(self.test_logins[1])).response == 200
+        response = client.request(get_contacts_request())
+        assert response.response == 202
+        assert response.datadict['quantity'] == 1
+        assert client.receive().datadict['user_id'] == self.test_logins[1]
+
+    def test__authenticate__ok__contacts_batch_feature_advertised(self):
+        response = self.connect().login(self.test_logins[0], self.test_hash)
+        assert FEATURE_CONTACTS_BATCH in response.datadict['features']
+
+    def test__requests_with_ids_pipelined__ids_echoed_in_order(self):
+        client = self.connect(self.test_logins[0])
+        requests = [add_contact_request(login) for login in self.test_logins[1:]]
+        requests.append(message_request(self.test_logins[0], self.test_logins[1], 'hello'))
+        for request_id, request in enumerate(requests, 1):
+            request.request_id = request_id
+        client.socket.sendall(b''.join(request.to_frame() for request in requests))
+        responses = [client.receive() for _ in requests]
+        assert [resp.request_id for resp in responses] == list(range(1, len(requests) + 1))
+        assert all(resp.response == 200 for resp in responses)
+
+    def test__authenticate__ok__request_id_feature_advertised(self):
+        response = self.connect().login(self.test_logins[0], self.test_hash)
+        assert FEATURE_REQUEST_ID in response.datadict['features']
+
+    def test__get_contacts_batch__all_contacts_in_one_response(self):
+        client = self.connect(self.test_logins[0])
+        for login in self.test_logins[1:]:
+            client.request(add_contact_request(login))
+        response = client.request(get_contacts_request(batch=True))
+        assert response.response == 202
+        assert sorted(response.datadict['contacts']) == self.test_logins[1:]
+        assert response.datadict['cursor'] is None
+
+    def test__get_contacts_batch__limit_set__contacts_paginated(self):
+        client = self.connect(self.test_logins[0])
+        for login in self.test_logins[1:]:
+            client.request(add_contact_request(login))
+        first_page = client.request(get_contacts_request(batch=True, limit=2))
+        assert first_page.datadict['contacts'] == self.test_logins[1:3]
+        second_page = client.request(get_contacts_request(batch=True, limit=2, cursor=first_page.datadict['cursor']))
+        assert second_page.datadict['contacts'] == self.test_logins[3:]
+        assert second_page.datadict['cursor'] is None
+
+    def test__msg__target_online__message_delivered(self):
+        sender = self.connect(self.test_logins[0])
+        receiver = self.connect(self.test_logins[1])
+        assert sender.request(message_request(self.test_logins[0], self.test_logins[1], 'hello')).response == 200
+        message = receiver.receive()
+        assert message.datadict['action'] == 'msg'
+        assert message.datadict['message'] == 'hello'
+
+    def test__msg__target_not_online__queued_and_delivered_after_authenticate(self):
+        sender = self.connect(self.test_logins[0])
+        for text in ['first', 'second']:
+            response = sender.request(message_request(self.test_logins[0], self.test_logins[1], text))
+            assert response.response == 200
+            assert response.datadict['queued'] is True
+        receiver = self.connect(self.test_logins[1])
+        assert [receiver.receive().datadict['message'] for _ in range(2)] == ['first', 'second']
+        assert receiver.request(get_contacts_request(batch=True)).response == 202  # nothing else was queued
+
+    def test__msg__target_unknown__error_400(self):
+        sender = self.connect(self.test_logins[0])
+        response = sender.request(message_request(self.test_logins[0], 'UnknownLogin', 'hello'))
+        assert response.response == 400
+
+    def test__msg__not_authenticated__error_401_and_not_queued(self):
+        sender = self.connect()
+        response = sender.request(message_request(self.test_logins[0], self.test_logins[1], 'hello'))
+        assert response.response == 401
+        receiver = self.connect(self.test_logins[1])
+        assert receiver.request(get_contacts_request(batch=True)).response == 202  # nothing was queued
+
+    def test__msg__duplicate_from_key_with_other_login__error_403_and_not_delivered(self):
+        sender = self.connect(self.test_logins[0])
+        receiver = self.connect(self.test_logins[1])
+        payload = f'{{"action": "msg", "time": "1", "to": "{self.test_logins[1]}", "from": "{self.test_logins[0]}", ' \
+                  f'"encoding": "utf-8", "message": "hello", "from": "{self.test_logins[2]}"}}'
+        sender.socket.sendall(frame_bytes(payload.encode('utf-8')))
+        assert sender.receive().response == 403
+        assert sender.request(message_request(self.test_logins[0], self.test_logins[1], 'again')).response == 200
+        message = receiver.receive()
+        assert (message.datadict['from'], message.datadict['message']) == (self.test_logins[0], 'again')
+
+    def test__msg__from_other_login__error_403_and_not_queued(self):
+        sender = self.connect(self.test_logins[0])
+        response = sender.request(message_request(self.test_logins[2], self.test_logins[1], 'hello'))
+        assert response.response == 403
+        receiver = self.connect(self.test_logins[1])
+        assert receiver.request(get_contacts_request(batch=True)).response == 202  # nothing was queued
+
+    def test__room_msg__members_online_and_offline__delivered_to_all_except_sender(self):
+        room = '#test_room'
+        sender = self.connect(self.test_logins[0])
+        assert sender.request(create_room_request(room)).response == 200
+        online_members = [self.connect(login) for login in self.test_logins[1:3]]
+        for member in online_members:
+            assert member.request(join_room_request(room)).response == 200
+        self.add_offline_room_member(room, self.test_logins[3])
+        assert sender.request(message_request(self.test_logins[0], room, 'hello')).response == 200
+        for member in online_members:
+            message = member.receive()
+            assert (message.datadict['to'], message.datadict['message']) == (room, 'hello')
+        assert self.connect(self.test_logins[3]).receive().datadict['message'] == 'hello'
+        assert sender.request(get_contacts_request(batch=True)).response == 202  # no echo to sender
+
+    def test__room_msg__not_member_or_left__error_400(self):
+        room = '#test_room'
+        owner = self.connect(self.test_logins[0])
+        assert owner.request(create_room_request(room)).response == 200
+        assert owner.request(create_room_request(room)).response == 400
+        client = self.connect(self.test_logins[1])
+        assert client.request(message_request(self.test_logins[1], room, 'hello')).response == 400
+        assert client.request(join_room_request(room)).response == 200
+        assert client.request(leave_room_request(room)).response == 200
+        assert client.request(message_request(self.test_logins[1], room, 'hello')).response == 400
+        assert client.request(join_room_request('#unknown_room')).response == 400
+
+    def test__dispatcher__handled_actions_timed(self):
+        self.connect(self.test_logins[0])
+        stats = self.server.dispatcher.stats
+        assert stats['presence']['calls'] == 1
+        assert stats['authenticate']['calls'] == 1
+
+    def test__get_stats__counters_and_action_histograms_returned(self):
+        client = self.connect(self.test_logins[0])
+        response = client.request(stats_request())
+        assert response.response == 200
+        stats = response.datadict['stats']
+        assert stats['counters']['auth_successes'] >= 1
+        assert stats['gauges']['authenticated_clients'] >= 1
+        assert sum(stats['actions']['authenticate']['histogram']['counts']) >= 1
+
+    def test__close_server_then_start__server_works_again(self):
+        self.server.close_server()
+        self.server.start()
+        self.connect(self.test_logins[0])
+
+    def test__msg__target_does_not_read__target_disconnected_then_messages_queued(self):
+        sender = self.connect(self.test_logins[0])
+        self.connect(self.test_logins[1])  # never reads incoming messages
+        text = 'x' * 32 * 1024
+        for _ in range(10000):
+            response = sender.request(message_request(self.test_logins[0], self.test_logins[1], text))
+            if response.response != 200 or 'queued' in response.datadict:
+                break
+        response = sender.request(message_request(self.test_logins[0], self.test_logins[1], text))
+        assert response.datadict['queued'] is True
+
+
+class TestServerRequestsSelectSelector(TestServerRequests):
+    server_class = staticmethod(partial(Server, selector_class=selectors.SelectSelector))
+
+
+class TestServerRequestsThreadPool(TestServerRequests):
+    server_class = staticmethod(partial(Server, handler_threads=4))
+
+    def test__requests_sent_at_once__responses_in_request_order(self):
+        client = self.connect(self.test_logins[0])
+        requests = [add_contact_request(login) for login in self.test_logins[1:]]
+        requests.append(get_contacts_request(batch=True))
+        client.socket.sendall(b''.join(request.to_frame() for request in requests))
+        assert [client.receive().response for _ in self.test_logins[1:]] == [200] * 3
+        assert sorted(client.receive().datadict['contacts']) == self.test_logins[1:]
+
+    def test__handler_blocks__other_clients_served(self):
+        release = Event()
+
+        def handle_wait(request, context):
+            release.wait(5)
+            return [JimResponse(200)]
+        self.server.dispatcher.register('wait', handle_wait)
+        waiting_client = self.connect()
+        wait_request = JimRequest()
+        wait_request.set_field('action', 'wait')
+        waiting_client.socket.sendall(wait_request.to_frame())
+        self.connect(self.test_logins[0])
+        release.set()
+        assert waiting_client.receive().response == 200
+
+
+class TestServerRequestsGroupCommit(TestServerRequests):
+    server_class = staticmethod(partial(Server, durability=DURABILITY_GROUP))
+
+    def test__authenticate__last_connect_committed_by_main_loop(self):
+        self.connect(self.test_logins[0])
+        reader = DBStorageServer(self.storage_file)
+        for _ in range(50):
+            last_connect_times = {login: connect_time for login, connect_time, _ in reader.get_clients()}
+            if last_connect_times[self.test_logins[0]] is not None:
+                break
+            time.sleep(0.05)
+        assert last_connect_times[self.test_logins[0]] is not None
+
+    def add_offline_room_member(self, room, login):
+        # other connection can write only when server has committed its changes and released the database
+        for _ in range(50):
+            if self.server.storage.write_stats['unflushed_changes'] == 0:
+                break
+            time.sleep(0.05)
+        super().add_offline_room_member(room, login)
+
+
+class TestServerRequestsWal(TestServerRequests):
+    server_class = staticmethod(partial(Server, handler_threads=4, wal=True))
+
+
+class TestServerRequestsMemoryStorage(TestServerRequests):
+    server_class = staticmethod(partial(Server, storage_backend=STORAGE_MEMORY))
+
+    def add_offline_room_member(self, room, login):
+        self.join_room_and_disconnect(room, login)  # member added to database is not seen by memory storage
+
+
+class TestServerRequestsHybridStorage(TestServerRequests):
+    server_class = staticmethod(partial(Server, handler_threads=4, storage_backend=STORAGE_HYBRID))
+
+    def test__add_contact__written_to_database_in_background(self):
+        client = self.connect(self.test_logins[0])
+        assert client.request(add_contact_request(self.test_logins[1])).response == 200
+        self.server.storage.flush()
+        assert DBStorageServer(self.storage_file).get_client_contacts(self.test_logins[0]) == self.test_logins[1:2]
+
+    def add_offline_room_member(self, room, login):
+        self.join_room_and_disconnect(room, login)  # member added to database is not seen by memory storage
@@ -0,0 +1,125 @@
+from socket import socketpair
+
+import pytest
+
+from sessions import Session, SessionRegistry
+
+
+class TestSessionRegistry:
+    test_login = 'TestLogin'
+
+    def setup_method(self):
+        self.registry = SessionRegistry()
+        self.session = Session(object(), ('1.2.3.4', 5555))
+        self.registry.add(self.session)
+
+    def test__add__session_can_be_found_by_connection(self):
+        assert self.session.connection in self.registry
+        assert self.registry.get(self.session.connection) is self.session
+        assert len(self.registry) == 1
+
+    def test__add__same_connection_twice__raises(self):
+        with pytest.raises(RuntimeError):
+            self.registry.add(self.session)
+
+    def test__bind_login__client_online_and_found_by_login(self):
+        self.registry.bind_login(self.session, self.test_login)
+        assert self.session.login == self.test_login
+        assert self.registry.is_online(self.test_login)
+        assert self.registry.get_sessions(self.test_login) == [self.session]
+
+    def test__bind_login__session_removed__raises(self):
+        self.registry.remove(self.session)
+        with pytest.raises(RuntimeError):
+            self.registry.bind_login(self.session, self.test_login)
+        assert not self.registry.is_online(self.test_login)
+
+    def test__get_sessions__client_not_online__empty(self):
+        assert self.registry.get_sessions(self.test_login) == []
+        assert not self.registry.is_online(self.test_login)
+
+    def test__bind_login__several_sessions__all_found_and_removed_independently(self):
+        other = Session(object(), ('1.2.3.5', 5555))
+        self.registry.add(other)
+        self.registry.bind_login(self.session, self.test_login)
+        self.registry.bind_login(other, self.test_login)
+        assert self.registry.get_sessions(self.test_login) == [self.session, other]
+        self.registry.remove(self.session)
+        assert self.registry.get_sessions(self.test_login) == [other]
+        self.registry.remove(other)
+        assert not self.registry.is_online(self.test_login)
+
+    def test__can_bind_login__sessions_limit_reached__false(self):
+        self.registry.max_sessions_per_login = 1
+        assert self.registry.can_bind_login(self.test_login)
+        self.registry.bind_login(self.session, self.test_login)
+        assert not self.registry.can_bind_login(self.test_login)
+
+    def test__remove__session_and_login_forgotten(self):
+        self.registry.bind_login(self.session, self.test_login)
+        assert self.registry.remove(self.session) is True
+        assert self.session.connection not in self.registry
+        assert not self.registry.is_online(self.test_login)
+        assert self.registry.remove(self.session) is False
+
+    def test__iter__all_sessions_returned(self):
+        other = Session(object(), ('1.2.3.5', 5555))
+        self.registry.add(other)
+        assert list(self.registry) == [self.session, other]
+        assert self.registry.connections() == [self.session.connection, other.connection]
+
+
+class TestSessionOutbox:
+    chunk = b'x' * 64 * 1024
+
+    def setup_method(self):
+        self.server_socket, self.client_socket = socketpair()
+        self.server_socket.setblocking(False)
+        self.session = Session(self.server_socket, ('1.2.3.4', 5555), high_watermark=len(self.chunk),
+                               low_watermark=0, outbox_limit=len(self.chunk) * 4)
+
+    def teardown_method(self):
+        self.server_socket.close()
+        self.client_socket.close()
+
+    def fill_socket_buffer(self):
+        while not self.session.has_pending_output:
+            assert self.session.send(self.chunk)
+
+    def test__send__socket_accepts_data__nothing_queued(self):
+        assert self.session.send(b'test')
+        assert not self.session.has_pending_output
+        assert self.client_socket.recv(4) == b'test'
+
+    def test__send__socket_buffer_full__data_queued_and_reading_paused(self):
+        self.fill_socket_buffer()
+        assert self.session.outbox_size > 0
+        self.session.send(self.chunk)
+        assert self.session.reading_paused
+
+    def test__send__outbox_limit_exceeded__returns_false_and_close_reason_set(self):
+        self.fill_socket_buffer()
+        results = [self.session.send(self.chunk) for _ in range(5)]
+        assert results[-1] is False
+        assert self.session.close_reason is not None
+        assert not self.session.send(b'test')
+
+    def test__flush__client_reads_data__outbox_drained(self):
+        self.fill_socket_buffer()
+        self.session.send(self.chunk)
+        self.client_socket.setblocking(False)
+        while self.session.has_pending_output:
+            try:
+                while self.client_socket.recv(len(self.chunk)):
+                    pass
+            except BlockingIOError:
+                pass
+            self.session.flush()
+        assert self.session.outbox_size == 0
+        assert not self.session.reading_paused
+
+    def test__reading_paused__too_many_queued_requests__paused(self):
+        self.session.queued_requests = self.session.queued_requests_limit
+        assert self.session.reading_paused
+        self.session.queued_requests -= 1
+        assert not self.session.reading_paused
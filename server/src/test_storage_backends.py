@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+from storage import DBStorageServer
+from storage_backends import create_server_storage, HybridStorageServer, STORAGE_BACKENDS
+
+TEST_LOGINS = ['TestLogin1', 'TestLogin2', 'TestLogin3']
+TEST_TTL = 60
+
+
+@pytest.fixture(params=STORAGE_BACKENDS)
+def storage(request, tmp_path):
+    storage = create_server_storage(request.param, os.path.join(str(tmp_path), 'server.sqlite'))
+    for login in TEST_LOGINS:
+        storage.add_client(login, 'test_hash')
+    yield storage
+    storage.close()
+
+
+def test__create_server_storage__unknown_backend__raises(tmp_path):
+    with pytest.raises(ValueError):
+        create_server_storage('unknown', os.path.join(str(tmp_path), 'server.sqlite'))
+
+
+@pytest.mark.parametrize('backend', STORAGE_BACKENDS)
+def test__get_clients__loaded_from_database_then_updated__clients_sorted(backend, tmp_path):
+    database = os.path.join(str(tmp_path), 'server.sqlite')
+    writer = DBStorageServer(database)
+    for login in TEST_LOGINS:
+        writer.add_client(login, 'test_hash')
+    writer.update_client(TEST_LOGINS[0], '1000', '1.2.3.4')
+    writer.close()
+    storage = create_server_storage(backend, database)
+    storage.update_client(TEST_LOGINS[1], '2000', '5.6.7.8')  # as got from request
+    assert storage.get_clients() == [(TEST_LOGINS[1], 2000, '5.6.7.8'), (TEST_LOGINS[0], 1000, '1.2.3.4'),
+                                     (TEST_LOGINS[2], None, None)]
+    storage.close()
+
+
+class TestServerStorageBackends:
+    """ Behaviour every backend must share with DBStorageServer """
+    def test__get_client_id__ids_and_logins_match(self, storage):
+        client_id = storage.get_client_id(TEST_LOGINS[1])
+        assert storage.get_client_login(client_id) == TEST_LOGINS[1]
+        assert storage.get_client_hash(TEST_LOGINS[1]) == 'test_hash'
+
+    def test__get_client_id__no_such_client__raises(self, storage):
+        with pytest.raises(IndexError):
+            storage.get_client_id('UnknownLogin')
+        assert not storage.check_client_exists('UnknownLogin')
+
+    def test__add_client__already_exists_or_empty__raises(self, storage):
+        with pytest.raises(RuntimeError):
+            storage.add_client(TEST_LOGINS[0], 'test_hash')
+        with pytest.raises(ValueError):
+            storage.add_client('', 'test_hash')
+        with pytest.raises(ValueError):
+            storage.add_client('#TestLogin', 'test_hash')
+
+    def test__get_clients__latest_connected_first(self, storage):
+        storage.update_client(TEST_LOGINS[0], 1.0, '1.2.3.4')
+        storage.update_client(TEST_LOGINS[2], 2.0, '5.6.7.8')
+        assert storage.get_clients() == [(TEST_LOGINS[2], 2.0, '5.6.7.8'), (TEST_LOGINS[0], 1.0, '1.2.3.4'),
+                                         (TEST_LOGINS[1], None, None)]
+
+    def test__add_client_to_contacts__contacts_paged_by_login(self, storage):
+        for login in reversed(TEST_LOGINS[1:]):
+            storage.add_client_to_contacts(TEST_LOGINS[0], login)
+        assert storage.check_client_in_contacts(TEST_LOGINS[0], TEST_LOGINS[1])
+        assert sorted(storage.get_client_contacts(TEST_LOGINS[0])) == TEST_LOGINS[1:]
+        assert storage.get_client_contacts(TEST_LOGINS[0], limit=1) == TEST_LOGINS[1:2]
+        assert storage.get_client_contacts(TEST_LOGINS[0], limit=1, after=TEST_LOGINS[1]) == TEST_LOGINS[2:]
+        storage.del_client_from_contacts(TEST_LOGINS[0], TEST_LOGINS[1])
+        assert not storage.check_client_in_contacts(TEST_LOGINS[0], TEST_LOGINS[1])
+        assert storage.get_client_contacts(TEST_LOGINS[1]) == []
+
+    def test__add_offline_messages__full_queues_rejected_and_frames_popped_in_order(self, storage):
+        assert storage.add_offline_message(TEST_LOGINS[0], b'first', 2, TEST_TTL)
+        assert storage.add_offline_messages(TEST_LOGINS[:2], b'second', 2, TEST_TTL) == []
+        assert storage.add_offline_messages(TEST_LOGINS[:2], b'third', 2, TEST_TTL) == TEST_LOGINS[:1]
+        assert storage.pop_offline_messages(TEST_LOGINS[0], TEST_TTL) == [b'first', b'second']
+        assert storage.pop_offline_messages(TEST_LOGINS[0], TEST_TTL) == []
+        assert storage.pop_offline_messages(TEST_LOGINS[1], TEST_TTL) == [b'second', b'third']
+
+    def test__pop_offline_messages__expired_messages_dropped(self, storage):
+        storage.add_offline_message(TEST_LOGINS[0], b'first', 10, TEST_TTL)
+        assert storage.pop_offline_messages(TEST_LOGINS[0], -1) == []
+        assert storage.pop_offline_messages(TEST_LOGINS[0], TEST_TTL) == []
+
+    def test__add_room__owner_is_member_and_members_updated(self, storage):
+        room = '#test_room'
+        assert not storage.check_room_exists(room)
+        storage.add_room(room, TEST_LOGINS[0])
+        assert storage.get_room_id(room) is not None
+        with pytest.raises(RuntimeError):
+            storage.add_room(room, TEST_LOGINS[1])
+        storage.add_room_member(room, TEST_LOGINS[1])
+        assert storage.check_client_in_room(room, TEST_LOGINS[1])
+        assert not storage.check_client_in_room(room, 'UnknownLogin')
+        assert sorted(storage.get_room_members(room)) == TEST_LOGINS[:2]
+        storage.del_room_member(room, TEST_LOGINS[1])
+        assert storage.get_room_members(room) == TEST_LOGINS[:1]
+        assert storage.get_room_members('#unknown_room') == []
+
+
+class TestHybridStorageServer:
+    @pytest.fixture(autouse=True)
+    def database(self, tmp_path):
+        self.database = os.path.join(str(tmp_path), 'server.sqlite')
+        DBStorageServer(self.database).add_client(TEST_LOGINS[0], 'test_hash')
+
+    def test__init__database_contents_loaded(self):
+        storage = HybridStorageServer(self.database)
+        assert storage.check_client_exists(TEST_LOGINS[0])
+        storage.close()
+
+    def test__flush__changes_written_to_database(self):
+        storage = HybridStorageServer(self.database)
+        storage.add_client(TEST_LOGINS[1], 'test_hash')
+        storage.add_client_to_contacts(TEST_LOGINS[0], TEST_LOGINS[1])
+        storage.update_client(TEST_LOGINS[0], 1.0, '1.2.3.4')
+        storage.add_offline_message(TEST_LOGINS[1], b'first', 10, TEST_TTL)
+        storage.flush()
+        reader = DBStorageServer(self.database)
+        assert reader.get_client_contacts(TEST_LOGINS[0]) == TEST_LOGINS[1:2]
+        assert reader.get_clients()[0] == (TEST_LOGINS[0], 1.0, '1.2.3.4')
+        assert reader.pop_offline_messages(TEST_LOGINS[1], TEST_TTL) == [b'first']
+        assert storage.write_stats == {'queued_changes': 0, 'write_errors': 0}
+        storage.close()
+
+    def test__close__reloaded_storage_has_the_same_data(self):
+        storage = HybridStorageServer(self.database)
+        storage.add_client(TEST_LOGINS[1], 'test_hash')
+        storage.add_room('#test_room', TEST_LOGINS[0])
+        storage.add_room_member('#test_room', TEST_LOGINS[1])
+        storage.close()
+        reloaded = HybridStorageServer(self.database)
+        assert sorted(reloaded.get_room_members('#test_room')) == TEST_LOGINS[:2]
+        reloaded.close()